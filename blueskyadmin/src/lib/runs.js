@@ -5,8 +5,14 @@ const publicPgv3UrlNoSlash = PUBLIC_PGV3_URL && PUBLIC_PGV3_URL.replace(/\/$/, '
 
 export const limit = 20
 
-export async function queryRuns(fetch, page, offset, runStatus, runId, queue) {
-    let apiUrl = `${publicApiUrlNoSlash}/runs/${runStatus || ''}?limit=${limit}&offset=${offset}`
+export async function queryRuns(fetch, page, offset, runStatus, runId, queue, cursor) {
+    // Paging with a cursor seeks directly to the page rather than
+    // skipping over all preceding runs
+    let apiUrl = `${publicApiUrlNoSlash}/runs/${runStatus || ''}?limit=${limit}`
+    if (cursor)
+        apiUrl += `&cursor=${cursor}&count=true`
+    else
+        apiUrl += `&offset=${offset}`
     if (runId)
         apiUrl += `&run_id=${runId}`
     if (queue)
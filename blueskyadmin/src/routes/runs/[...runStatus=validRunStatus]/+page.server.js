@@ -23,9 +23,10 @@ async function loadData(params, url, fetch) {
       page = page ? parseInt(page) : 0
       const runId = url.searchParams.get('runId')
       const queue = url.searchParams.get('queue')
-      const runsData = queryRuns(fetch, page, offset, runStatus, runId, queue)
+      const cursor = url.searchParams.get('cursor')
+      const runsData = queryRuns(fetch, page, offset, runStatus, runId, queue, cursor)
       console.log(runsData)
-      return { runStatus, runsData, page, limit, offset, runId, queue }
+      return { runStatus, runsData, page, limit, offset, runId, queue, cursor }
     } catch(error) {
       console.error(`Error in load loading queue information: ${error}`);
       return { runStatus, error }
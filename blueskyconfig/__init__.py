@@ -5,10 +5,12 @@ __copyright__   = "Copyright 2015, AirFire, PNW, USFS"
 
 import copy
 import datetime
+import hashlib
 import json
 import logging
 import os
 import threading
+import time
 
 # Note: afconfig is installed via afscripting
 import afconfig
@@ -17,20 +19,117 @@ logger = logging.getLogger(__name__)
 
 __all__ = [
     "ConfigManagerSingleton",
-    "get"
+    "get",
+    "get_mutable",
+    "get_version",
+    "get_archive_info"
 ]
 
 
-# make config data thread safe by storing in thread local,
-# which must be defined once, in main thread.
-thread_local_data = threading.local()
+class FrozenDict(dict):
+    """Read-only dict. Copies are regular, mutable dicts."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Config data is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {k: copy.deepcopy(v, memo) for k, v in self.items()}
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    """Read-only list. Copies are regular, mutable lists."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Config data is read-only")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = clear = extend = insert = pop = remove = reverse = sort = _readonly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def freeze(val):
+    if isinstance(val, dict):
+        return FrozenDict((k, freeze(v)) for k, v in val.items())
+    if isinstance(val, list):
+        return FrozenList(freeze(v) for v in val)
+    return val
+
+
+def build_archive_index(config):
+    """Returns read-only map of archive id to archive info merged
+    with its domain's info, as returned by `get_archive_info`.
+
+    If an archive id is defined in multiple groups, the first is used.
+    Archives whose domain is not defined are still indexed, without
+    domain info, so that they remain valid archive ids.
+    """
+    index = {}
+    domains = config.get('domains') or {}
+    for archives in (config.get('archives') or {}).values():
+        for archive_id, archive_info in archives.items():
+            if archive_id in index:
+                continue
+            domain = domains.get(archive_info.get('domain_id'))
+            if domain is None:
+                logger.error(f"Domain {archive_info.get('domain_id')} of "
+                    f"archive {archive_id} is not defined")
+                domain = {}
+            index[archive_id] = freeze(dict(archive_info, id=archive_id,
+                **domain))
+    return index
+
+
+class ConfigSnapshot(object):
+    """Read-only config data, along with the state of the source files
+    it was loaded from. Snapshots are replaced, never modified, when
+    config is reloaded.
+    """
+
+    def __init__(self, config, version, sources, digest, loaded_at,
+            load_seconds):
+        self.config = config
+        self.version = version
+        self.sources = sources
+        self.digest = digest
+        self.loaded_at = loaded_at
+        self.load_seconds = load_seconds
+        self.archive_index = build_archive_index(config)
+
 
 class ConfigManagerSingleton():
+    """Manages one config snapshot shared by all threads in the process.
+
+    Source files are checked for changes (by mtime and size) at most
+    once every `cache_ttl_minutes`, and config is reloaded only if they
+    changed. Readers never block on reloads; they get the current
+    snapshot until the new one is swapped in.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
 
     def __new__(cls, *args, **kwargs):
-        if not hasattr(thread_local_data, 'config_manager'):
-            thread_local_data.config_manager = object.__new__(cls)
-        return thread_local_data.config_manager
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = object.__new__(cls)
+            return cls._instance
 
     DEFAULT_CONFIG_JSON_FILE = os.path.abspath(
         os.path.join(os.path.dirname(__file__), 'json-config-files/defaults.json'))
@@ -40,10 +139,18 @@ class ConfigManagerSingleton():
         # __init__ will be called each time __new__ is called. So, we need to
         # keep track of initialization to abort subsequent reinitialization
         if not hasattr(self, '_initialized'):
-            self._data = thread_local_data
+            self._lock = threading.Lock()
+            self._snapshot = None
+            self._next_check = 0
             self._config_json_file = self.DEFAULT_CONFIG_JSON_FILE
             self._overrides_files = []
             self._overrides = {}
+            self._stats = {
+                'loads': 0,
+                'checks': 0,
+                'reload_failures': 0,
+                'last_checked_at': None
+            }
             self._initialized = True
 
     # this should never be used, but could if 'cache_ttl_minutes' is
@@ -52,70 +159,176 @@ class ConfigManagerSingleton():
 
     def add_overrides(self, overrides):
         if overrides:
-            afconfig.merge_configs(self._overrides, overrides)
+            with self._lock:
+                # merge_configs merges in place, and would otherwise
+                # share nested dicts of `overrides` with later merges
+                afconfig.merge_configs(self._overrides,
+                    copy.deepcopy(overrides))
+                self._snapshot = None
 
     def add_overrides_file(self, overrides_file):
-        self._overrides_files.append(overrides_file)
+        with self._lock:
+            self._overrides_files.append(overrides_file)
+            self._snapshot = None
 
     @property
     def ttl_seconds(self):
-        if hasattr(self._data, 'config'):
-            ttl = self._data.config.get('cache_ttl_minutes')
+        """Seconds between checks for changes to source files"""
+        if self._snapshot:
+            ttl = self._snapshot.config.get('cache_ttl_minutes')
             if ttl is not None:
                 return ttl * 60
 
-            ttl = self._data.config.get('cache_ttl_seconds')
+            ttl = self._snapshot.config.get('cache_ttl_seconds')
             if ttl is not None:
                 return ttl
 
         return self._DEFAULT_TTL_SECONDS
 
-    def _load_config_from_file(self, config, filename):
-        logger.debug(f"Loading config from {filename}")
-        with open(filename) as f:
+    @property
+    def _source_files(self):
+        return [self._config_json_file] + self._overrides_files
+
+    def _stat_sources(self):
+        sources = []
+        for filename in self._source_files:
             try:
-                c = json.loads(f.read())
-                afconfig.merge_configs(config, c)
-            except Exception as e:
-                logger.warning(f"Failed to config from {filename} - {e}")
+                st = os.stat(filename)
+                sources.append((filename, st.st_mtime_ns, st.st_size))
+            except OSError:
+                sources.append((filename, None, None))
+        return tuple(sources)
 
-    def _load_config(self):
-        # note that 'afconfig.merge_configs' merges in-place
+    def _load_config_from_file(self, config, filename, digest):
+        logger.debug(f"Loading config from {filename}")
+        with open(filename, 'rb') as f:
+            contents = f.read()
+        digest.update(contents)
+        try:
+            c = json.loads(contents)
+            afconfig.merge_configs(config, c)
+        except Exception as e:
+            logger.warning(f"Failed to config from {filename} - {e}")
 
+    def _load_config(self, sources):
+        # note that 'afconfig.merge_configs' merges in-place
+        start = time.monotonic()
         config = {}
+        digest = hashlib.sha1()
 
-        # Load defaults
-        self._load_config_from_file(config, self._config_json_file)
-
-        # load any overrides files
-        for o in self._overrides_files:
-            self._load_config_from_file(config, o)
+        # Load defaults, followed by any overrides files
+        for filename in self._source_files:
+            self._load_config_from_file(config, filename, digest)
 
         # load any overrides loaded when bsp-web was started
         if self._overrides:
             logger.debug(f"Loading static overrides")
             afconfig.merge_configs(config, self._overrides)
+            digest.update(json.dumps(self._overrides, sort_keys=True,
+                default=str).encode())
 
-        self._data.config = config
+        digest = digest.hexdigest()
+        current = self._snapshot
+        if current and current.digest == digest:
+            # files were touched, but their contents are unchanged
+            logger.debug("Config sources unchanged - keeping config")
+            snapshot = ConfigSnapshot(current.config, current.version,
+                sources, digest, current.loaded_at, current.load_seconds)
+        else:
+            # Config is frozen so that it can be returned without copying
+            snapshot = ConfigSnapshot(freeze(config),
+                (current.version if current else self._stats['loads']) + 1,
+                sources, digest, datetime.datetime.utcnow(),
+                time.monotonic() - start)
+            self._stats['loads'] += 1
+            logger.debug(f"Loaded config version {snapshot.version} in "
+                f"{snapshot.load_seconds:.3f}s")
 
-        self._data.expire_at = datetime.datetime.now() + datetime.timedelta(
-            seconds=self.ttl_seconds)
+        # Readers pick up the new snapshot with a single reference swap
+        self._snapshot = snapshot
+
+    def _check_for_changes(self):
+        if not self._lock.acquire(blocking=self._snapshot is None):
+            # another thread is checking; use the current snapshot
+            return
+        try:
+            if self._snapshot and time.monotonic() < self._next_check:
+                return
+            self._stats['checks'] += 1
+            self._stats['last_checked_at'] = datetime.datetime.utcnow()
+            sources = self._stat_sources()
+            if self._snapshot is None:
+                logger.debug("Initial load of config from file")
+                self._load_config(sources)
+            elif sources != self._snapshot.sources:
+                logger.debug("Config sources changed - reloading from file")
+                try:
+                    self._load_config(sources)
+                except Exception as e:
+                    self._stats['reload_failures'] += 1
+                    logger.error(f"Failed to reload config - {e}")
+            self._next_check = time.monotonic() + self.ttl_seconds
+        finally:
+            self._lock.release()
+
+    @property
+    def snapshot(self):
+        if self._snapshot is None or time.monotonic() >= self._next_check:
+            self._check_for_changes()
+        return self._snapshot
 
     @property
     def config(self):
-        """Loads config data from json file and caches in thread local,
-        with expiration
+        """Returns read-only config data, loading it from json files
+        if not yet loaded or if the files have changed
         """
-        if not hasattr(self._data, 'config'):
-            logger.debug("Initial load of config from file")
-            self._load_config()
+        return self.snapshot.config
+
+    @property
+    def version(self):
+        """Incremented each time config changes"""
+        return self.snapshot.version
+
+    @property
+    def archive_index(self):
+        """Archive info index, rebuilt each time config changes"""
+        return self.snapshot.archive_index
 
-        elif self._data.expire_at < datetime.datetime.now():
-            logger.debug(f"Cache expired ({self._data.expire_at} vs. {datetime.datetime.now()}) - reloading from file")
-            self._load_config()
+    @property
+    def stats(self):
+        snapshot = self.snapshot
+        last_checked_at = self._stats['last_checked_at']
+        return dict(self._stats, version=snapshot.version,
+            last_checked_at=last_checked_at and last_checked_at.isoformat(),
+            loaded_at=snapshot.loaded_at.isoformat(),
+            load_seconds=snapshot.load_seconds,
+            check_interval_seconds=self.ttl_seconds,
+            sources=[s[0] for s in snapshot.sources])
+
+def _reset_after_fork():
+    # A lock held by another thread when the process forked would never
+    # be released in the child. The current snapshot is kept.
+    ConfigManagerSingleton._instance_lock = threading.Lock()
+    if ConfigManagerSingleton._instance is not None:
+        ConfigManagerSingleton._instance._lock = threading.Lock()
 
-        return self._data.config
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 def get(*args):
-    return copy.deepcopy(afconfig.get_config_value(
-        ConfigManagerSingleton().config, *args))
+    """Returns read-only config value from the current config snapshot.
+    Use `get_mutable` for a copy that can be modified.
+    """
+    return afconfig.get_config_value(ConfigManagerSingleton().config, *args)
+
+def get_mutable(*args):
+    """Returns a regular, mutable copy of a config value"""
+    return copy.deepcopy(get(*args))
+
+def get_version():
+    return ConfigManagerSingleton().version
+
+def get_archive_info(archive_id):
+    """Returns read-only archive info merged with its domain's info,
+    or None if the archive isn't defined.
+    """
+    return ConfigManagerSingleton().archive_index.get(archive_id)
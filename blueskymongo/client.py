@@ -4,13 +4,21 @@ __author__ = "Joel Dubowy"
 __copyright__ = "Copyright 2015, AirFire, PNW, USFS"
 
 import asyncio
+import base64
+import bisect
 import datetime
+import json
 import logging
+import os
+import re
 import ssl
 import threading
+import time
 from urllib.parse import urlparse
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, ConnectionFailure
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +36,146 @@ def _get_bg_loop() -> asyncio.AbstractEventLoop:
     return _bg_loop
 
 
+##
+## Shared clients
+##
+
+MONGODB_CLIENT_ARGS = {
+    'tls': True,
+    #'tlsAllowInvalidHostnames': True, # Note: makes vulnerable to man-in-the-middle attacks
+    'tlsAllowInvalidCertificates': True,
+    # 'tlsCertificateKeyFile': '/etc/ssl/bluesky-web-client-cert.pem',
+    'tlsCAFile': '/etc/ssl/bluesky-web-client.pem'
+}
+
+# Maps web settings to client connection pool options
+POOL_SETTINGS_KWARGS = {
+    'mongodb_max_pool_size': ('maxPoolSize', int),
+    'mongodb_min_pool_size': ('minPoolSize', int),
+    'mongodb_max_idle_time_ms': ('maxIdleTimeMS', int),
+    'mongodb_connect_timeout_ms': ('connectTimeoutMS', int),
+    'mongodb_server_selection_timeout_ms': ('serverSelectionTimeoutMS', int),
+    'mongodb_wait_queue_timeout_ms': ('waitQueueTimeoutMS', int),
+}
+
+
+def pool_kwargs_from_settings(settings):
+    return {k: t(settings[s]) for s, (k, t) in POOL_SETTINGS_KWARGS.items()
+        if settings.get(s) is not None}
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Tracks connection pool usage, per server, for a client"""
+
+    COUNTERS = ('open', 'in_use', 'created', 'closed', 'checked_out',
+        'checkout_failures', 'cleared')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._servers.items()}
+
+    def _inc(self, event, **counts):
+        address = '{}:{}'.format(*event.address)
+        with self._lock:
+            server = self._servers.setdefault(address,
+                {c: 0 for c in self.COUNTERS})
+            for k, v in counts.items():
+                server[k] += v
+
+    def pool_created(self, event):
+        self._inc(event)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._inc(event, cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._inc(event, open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._inc(event, open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._inc(event, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._inc(event, in_use=1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._inc(event, in_use=-1)
+
+
+# Clients are shared by all db wrappers in a process, keyed by
+# process id so that forked workers create their own
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_mongo_client(mongodb_url, **pool_kwargs):
+    """Returns this process's client for the given url and pool
+    options, creating it on first use.
+    """
+    key = (os.getpid(), mongodb_url, tuple(sorted(pool_kwargs.items())))
+    with _clients_lock:
+        if key not in _clients:
+            logger.debug('Creating mongodb client with pool options %s',
+                pool_kwargs)
+            listener = PoolStatsListener()
+            client = AsyncIOMotorClient(mongodb_url,
+                event_listeners=[listener], **MONGODB_CLIENT_ARGS,
+                **pool_kwargs)
+            _clients[key] = (client, listener)
+        return _clients[key][0]
+
+
+def close_mongo_clients():
+    """Closes this process's clients"""
+    with _clients_lock:
+        keys = [k for k in _clients if k[0] == os.getpid()]
+        for k in keys:
+            _clients.pop(k)[0].close()
+
+
+def mongo_pool_stats():
+    """Returns connection pool usage of this process's clients"""
+    with _clients_lock:
+        clients = [(dict(k[2]), l) for k, (c, l) in _clients.items()
+            if k[0] == os.getpid()]
+    return [{'options': o, 'servers': l.stats} for o, l in clients]
+
+
+def get_db_name(mongodb_url):
+    return (urlparse(mongodb_url).path.lstrip('/').split('/')[0]
+        or 'blueskyweb')
+
+
+def _reset_after_fork():
+    # The background loop's thread, and any lock held by another thread,
+    # don't survive a fork. Clients are already keyed by process id.
+    global _bg_loop, _bg_loop_lock, _clients_lock
+    _bg_loop = None
+    _bg_loop_lock = threading.Lock()
+    _clients_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 class RunStatusesType(type):
     STATUSES = {
         "Enqueued": "enqueued",
@@ -54,114 +202,968 @@ class RunStatuses(metaclass=RunStatusesType):
     pass
 
 
-class BlueSkyWebDB(object):
+class HistoryModes(object):
+    # The entire status history is stored in the run document
+    Full = 'full'
+    # Only the latest status and a capped number of milestones are
+    # stored in the run document; all status updates are recorded
+    # in the 'run_events' collection
+    Compact = 'compact'
 
-    def __init__(self, mongodb_url):
-        db_name = (urlparse(mongodb_url).path.lstrip('/').split('/')[0]
-            or 'blueskyweb')
-        client_args = {
-            'tls': True,
-            #'tlsAllowInvalidHostnames': True, # Note: makes vulnerable to man-in-the-middle attacks
-            'tlsAllowInvalidCertificates': True,
-            # 'tlsCertificateKeyFile': '/etc/ssl/bluesky-web-client-cert.pem',
-            'tlsCAFile': '/etc/ssl/bluesky-web-client.pem'
-        }
-        self.db = AsyncIOMotorClient(mongodb_url, **client_args)[db_name]
 
-    def record_run(self, run_id, status, module=None, log=None, stdout=None,
-            percent_complete=None, status_message=None, **data):
+class MatchModes(object):
+    """How run_id and queue search terms are matched"""
+    # Equality; uses index
+    Exact = 'exact'
+    # Anchored to the beginning of the value; uses index
+    Prefix = 'prefix'
+    # Matches whole tokens, with the last one matched as a prefix;
+    # e.g. 'abc-plume' matches 'xyz-abc-plumerise'. Uses index
+    Token = 'token'
+    # Matches anywhere in the value; requires scanning
+    Contains = 'contains'
 
-        spec = {"run_id": run_id}
-        # include run_id in doc in case it's an insert
-        ts = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    modes = (Exact, Prefix, Token, Contains)
+    # Substring matching is what run_id and queue filters did before
+    # match modes were supported, so it remains the default; the
+    # indexed modes need to be requested. (Token matching also needs
+    # search tokens on existing runs; see build_search_tokens.)
+    default = Contains
+
+
+TOKEN_SPLITTER = re.compile('[^a-z0-9]+')
+
+def tokenize(val):
+    """Splits a run_id or queue name into lowercase alphanumeric tokens"""
+    return [t for t in TOKEN_SPLITTER.split((val or '').lower()) if t]
+
+
+def search_query(field, term, match=MatchModes.default):
+    """Returns query for matching `term` against `field`, using the
+    specified match mode.
+
+    Search terms are escaped, so that they're never interpreted as
+    regular expressions.
+    """
+    if match == MatchModes.Exact:
+        return {field: term}
+    elif match == MatchModes.Prefix:
+        return {field: {'$regex': '^' + re.escape(term)}}
+    elif match == MatchModes.Token:
+        tokens = tokenize(term)
+        if not tokens:
+            return {field: term}
+        token_field = field + '_tokens'
+        conditions = [{token_field: t} for t in tokens[:-1]]
+        conditions.append(
+            {token_field: {'$regex': '^' + re.escape(tokens[-1])}})
+        return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+    elif match == MatchModes.Contains:
+        return {field: {'$regex': re.escape(term)}}
+    raise ValueError("Invalid match mode: {}".format(match))
+
+
+def is_progress_entry(entry):
+    return entry['status'] == RunStatuses.RunningModule
+
+
+class _PendingRunUpdate(object):
+    """Accumulates consecutive status updates for a single run so that
+    they can be written with one upsert.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.data = {}
+        # whether any of the updates are terminal statuses
+        self.terminal = False
+        # number of failed attempts to write the update
+        self.attempts = 0
+        # number of entries already recorded in run_events
+        self.events_recorded = 0
+
+    def add(self, entry, data=None):
+        self.entries.append(entry)
+        if data:
+            self.data.update(data)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def to_update(self, max_milestones=None):
+        """Returns the update to apply to the run document.
+
+        If `max_milestones` is defined, the update is a pipeline that
+        keeps the latest status at position 0, followed by at most
+        `max_milestones` milestone entries (i.e. anything other than
+        progress updates).
+        """
+        if max_milestones is not None:
+            return self._to_compact_update(max_milestones)
+
+        # history is stored in reverse chronological order; it's sorted
+        # by ts, rather than having entries pushed to the front, since
+        # entries recorded by different processes can arrive out of
+        # order, e.g. Enqueued after Dequeued
         doc = {
             "$push": {
                 "history": {
-                    # insert at position in reverse chronological order
-                    '$each': [{'status': status, 'ts': ts}],
-                    '$position': 0
+                    '$each': list(reversed(self.entries)),
+                    '$sort': {'ts': -1}
                 }
             }
         }
+        if self.data:
+            doc["$set"] = self.data
+        return doc
+
+    def _to_compact_update(self, max_milestones):
+        # New and existing entries are sorted by ts, and all but the
+        # latest progress update are dropped, so that history[0] is
+        # the latest status even if entries arrive out of order.
+        # Values are wrapped with $literal so that strings starting
+        # with '$' aren't interpreted as field paths
+        history = {'$sortArray': {
+            'input': {'$concatArrays': [
+                {'$literal': list(reversed(self.entries))},
+                {'$ifNull': ['$history', []]}
+            ]},
+            'sortBy': {'ts': -1}
+        }}
+        milestones = {'$filter': {
+            'input': {'$slice': ['$$history', 1, {'$size': '$$history'}]},
+            'as': 'e',
+            'cond': {'$ne': ['$$e.status', RunStatuses.RunningModule]}
+        }}
+
+        new_fields = {k: {'$literal': v} for k, v in self.data.items()}
+        new_fields['history_mode'] = HistoryModes.Compact
+        new_fields['history'] = {'$let': {
+            'vars': {'history': history},
+            'in': {'$slice': [
+                {'$concatArrays': [{'$slice': ['$$history', 1]}, milestones]},
+                max_milestones + 1
+            ]}
+        }}
+        return [{'$set': new_fields}]
+
+    def merge(self, newer):
+        """Appends updates recorded after these ones"""
+        self.entries.extend(newer.entries)
+        self.data.update(newer.data)
+        self.terminal = self.terminal or newer.terminal
+
+    def to_events(self, run_id):
+        recorded_at = datetime.datetime.utcnow()
+        return [dict(e, run_id=run_id, recorded_at=recorded_at)
+            for e in self.entries[self.events_recorded:]]
+
+
+class _FlusherControl(object):
+    """Lets a flusher be stopped without waiting out its sleep. Only
+    used from the flusher's event loop.
+    """
+
+    def __init__(self):
+        self.stopping = False
+        self._wakeup = None
+
+    async def sleep(self, seconds):
+        self._wakeup = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        self.stopping = True
+        if self._wakeup:
+            self._wakeup.set()
+
+
+class RunRecordWriter(object):
+    """Bounded, coalescing write pipeline for run status updates.
+
+    Updates are buffered per run_id and written periodically with a
+    single bulk_write, one upsert per run. Since there's only ever one
+    batch in flight, updates for a given run are always written in
+    the order in which they were recorded.
+
+    When the number of pending updates reaches `max_pending`, callers
+    block for up to `put_timeout` seconds (or the timeout passed to
+    put) waiting for the flusher to catch up. Updates that still can't
+    be queued are dropped, except for terminal statuses, which are
+    always queued. Callers running on an event loop never block, so
+    that they don't stall it.
+
+    Updates that include terminal statuses are retried, up to
+    `max_write_attempts` times, if writing them fails. close() writes
+    whatever is queued and stops the flusher.
+    """
+
+    def __init__(self, collection, flush_interval=1.0, max_pending=1000,
+            put_timeout=30, events_collection=None, max_milestones=None,
+            events_retention_days=None, stats_collection=None,
+            max_write_attempts=5):
+        self._collection = collection
+        # If stats_collection is defined, daily run counts are
+        # incremented there when runs are initiated
+        self._stats_collection = stats_collection
+        # If events_collection is defined, every update is also
+        # recorded there, and history on the run doc is compacted
+        self._events_collection = events_collection
+        self.max_milestones = max_milestones
+        self.events_retention_days = events_retention_days
+        self._events_indexed = False
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.max_write_attempts = max_write_attempts
+
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._num_pending = 0
+        self._in_flight = 0
+        self._loop = None
+        self._task = None
+        self._control = None
+
+        self._stats = {
+            'queued': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'written': 0,
+            'errors': 0,
+            'retried': 0,
+            'stats_errors': 0,
+            'flushes': 0,
+            'max_queue_depth': 0,
+            'last_flush_latency': None,
+            'max_flush_latency': None,
+            'total_flush_latency': 0.0
+        }
+
+    @property
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, queue_depth=self._num_pending,
+                in_flight=self._in_flight)
+
+    def put(self, run_id, entry, data=None, terminal=False, timeout=None):
+        self._ensure_flusher()
+        if timeout is None:
+            timeout = self.put_timeout
+        with self._cond:
+            if not terminal and timeout > 0 and not _on_event_loop():
+                self._cond.wait_for(
+                    lambda: self._num_pending < self.max_pending,
+                    timeout=timeout)
+            if self._num_pending >= self.max_pending and not terminal:
+                self._stats['dropped'] += 1
+                logger.error('Run record queue full (%s pending) - dropping '
+                    '%s update for run %s', self._num_pending,
+                    entry['status'], run_id)
+                return
+
+            if run_id in self._pending:
+                self._stats['coalesced'] += 1
+            else:
+                self._pending[run_id] = _PendingRunUpdate()
+            self._pending[run_id].add(entry, data)
+            self._pending[run_id].terminal |= terminal
+            self._num_pending += 1
+            self._stats['queued'] += 1
+            self._stats['max_queue_depth'] = max(
+                self._stats['max_queue_depth'], self._num_pending)
+
+    def flush(self, timeout=None):
+        """Blocks until all updates queued so far have been written.
+
+        Must not be called from the flusher's event loop.
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._num_pending == 0 and self._in_flight == 0,
+                timeout=timeout)
+
+    def start(self):
+        """Starts the flusher, on the caller's event loop if there is
+        one. Processes that record runs from both an event loop and
+        other threads, like the web service, should call this from the
+        loop at startup, so that the flusher doesn't end up on the
+        background loop.
+        """
+        self._ensure_flusher()
+
+    async def close(self, timeout=30):
+        """Writes all queued updates and stops the flusher. Returns
+        False if they couldn't all be written within `timeout` seconds.
+        """
+        with self._cond:
+            task, loop, control = self._task, self._loop, self._control
+            self._task = None
+        if task is None or task.done() or loop.is_closed():
+            return self._num_pending == 0
+
+        loop.call_soon_threadsafe(control.stop)
+        if isinstance(task, asyncio.Future):
+            if _running_loop() is loop:
+                waiter = task
+            else:
+                waiter = asyncio.wrap_future(
+                    asyncio.run_coroutine_threadsafe(_wait_for(task), loop))
+        else:
+            # running on the background loop
+            waiter = asyncio.wrap_future(task)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+            return True
+        except asyncio.TimeoutError:
+            loop.call_soon_threadsafe(task.cancel)
+            logger.error('Timed out writing run records - %s updates '
+                'not written', self._num_pending + self._in_flight)
+            return False
+
+    def _ensure_flusher(self):
+        # The flusher runs on the caller's event loop, if there is one,
+        # so that the motor client is only ever used from one loop;
+        # otherwise it runs on the shared background loop
+        with self._cond:
+            if (self._task is not None and not self._task.done()
+                    and not self._loop.is_closed()):
+                return
+            self._control = control = _FlusherControl()
+            try:
+                self._loop = asyncio.get_running_loop()
+                self._task = self._loop.create_task(self._run(control))
+            except RuntimeError:
+                self._loop = _get_bg_loop()
+                self._task = asyncio.run_coroutine_threadsafe(
+                    self._run(control), self._loop)
+
+    async def _run(self, control):
+        while not control.stopping:
+            await control.sleep(self.flush_interval)
+            await self._flush_batch()
+
+        # write what was queued before stopping, including retries
+        while self._pending:
+            await self._flush_batch()
+
+    async def _flush_batch(self):
+        with self._cond:
+            if not self._pending:
+                return
+            batch = self._pending
+            self._pending = {}
+            self._in_flight = self._num_pending
+            self._num_pending = 0
+            # wake up any callers blocked on a full queue
+            self._cond.notify_all()
+
+        max_milestones = (self.max_milestones
+            if self._events_collection is not None else None)
+        ops = [UpdateOne({"run_id": run_id}, u.to_update(max_milestones),
+            upsert=True) for run_id, u in batch.items()]
+        start = time.monotonic()
+        failed = {}
+        try:
+            if self._events_collection is not None:
+                await self._record_events(batch)
+
+            # Each run has at most one op in the batch, so ordering
+            # between ops doesn't matter
+            result = await self._collection.bulk_write(ops, ordered=False)
+            logger.debug('Recorded %s updates for %s runs: %s',
+                self._in_flight, len(ops), result.bulk_api_result)
+        except BulkWriteError as e:
+            # the other ops were written
+            run_ids = list(batch)
+            failed = {run_ids[err['index']]: batch[run_ids[err['index']]]
+                for err in e.details.get('writeErrors', [])}
+            logger.error('Error recording %s runs: %s', len(failed),
+                e.details.get('writeErrors', [])[:1])
+        except Exception as e:
+            logger.error('Error recording runs: %s', e)
+            failed = batch
+
+        # Run counts are only incremented for runs that were recorded;
+        # failures to do so don't affect the runs themselves
+        stats_errors = 0
+        if self._stats_collection is not None:
+            stats_errors = await self._record_stats({run_id: u
+                for run_id, u in batch.items() if run_id not in failed})
+
+        latency = time.monotonic() - start
+        with self._cond:
+            num_failed = sum(len(u) for u in failed.values())
+            self._stats['flushes'] += 1
+            self._stats['stats_errors'] += stats_errors
+            self._stats['errors'] += num_failed
+            self._stats['written'] += self._in_flight - num_failed
+            self._requeue(failed)
+            self._stats['last_flush_latency'] = latency
+            self._stats['max_flush_latency'] = max(
+                self._stats['max_flush_latency'] or 0.0, latency)
+            self._stats['total_flush_latency'] += latency
+            self._in_flight = 0
+            self._cond.notify_all()
+
+    def _requeue(self, failed):
+        """Queues failed updates that include terminal statuses to be
+        retried, ahead of any updates for the same runs recorded since.
+        Must be called with self._cond held.
+        """
+        for run_id, u in failed.items():
+            if not u.terminal:
+                continue
+            u.attempts += 1
+            if u.attempts >= self.max_write_attempts:
+                self._stats['dropped'] += len(u)
+                logger.error('Giving up recording %s status of run %s '
+                    'after %s attempts', u.entries[-1]['status'], run_id,
+                    u.attempts)
+                continue
+            self._num_pending += len(u)
+            self._stats['retried'] += len(u)
+            newer = self._pending.get(run_id)
+            if newer:
+                u.merge(newer)
+            self._pending[run_id] = u
+
+    async def _record_stats(self, batch):
+        """Increments daily per-queue run counts for newly initiated
+        runs, and returns the number of increments that failed
+        """
+        ops = [UpdateOne({'date': u.data['initiated_at'][:10],
+                'queue': u.data.get('queue')},
+            {'$inc': {'count': 1}}, upsert=True)
+            for u in batch.values() if u.data.get('initiated_at')]
+        if not ops:
+            return 0
+        try:
+            await self._stats_collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            logger.error('Error incrementing %s run counts: %s', len(errors),
+                errors[:1])
+            return len(errors)
+        except Exception as e:
+            logger.error('Error incrementing run counts: %s', e)
+            return len(ops)
+        return 0
+
+    async def _record_events(self, batch):
+        if not self._events_indexed:
+            await ensure_run_events_indexes(self._events_collection,
+                self.events_retention_days)
+            self._events_indexed = True
+
+        events = [e for run_id, u in batch.items() for e in u.to_events(run_id)]
+        if events:
+            await self._events_collection.insert_many(events, ordered=False)
+        for u in batch.values():
+            u.events_recorded = len(u.entries)
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+def _on_event_loop():
+    return _running_loop() is not None
+
+async def _wait_for(future):
+    await future
+
+
+# Days to keep entries in the 'run_events' collection, by default. The
+# web service and bsp-web-manage-runs-db need to agree, since the TTL
+# index can't be recreated with a different expiration
+DEFAULT_EVENTS_RETENTION_DAYS = 90
+
+async def ensure_run_events_indexes(collection, retention_days=None):
+    await collection.create_index([('run_id', 1), ('ts', -1)])
+    if retention_days:
+        await collection.create_index('recorded_at',
+            expireAfterSeconds=int(retention_days * 86400))
+
+
+def _plan_stages(plan):
+    """Returns the stages, and index names, of a query plan,
+    recursing through input stages
+    """
+    stages, indexes = [], []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        if 'indexName' in plan:
+            indexes.append(plan['indexName'])
+        for k in ('inputStage', 'queryPlan', 'shards'):
+            if k in plan:
+                s, i = _plan_stages(plan[k])
+                stages.extend(s)
+                indexes.extend(i)
+        for p in plan.get('inputStages', []):
+            s, i = _plan_stages(p)
+            stages.extend(s)
+            indexes.extend(i)
+    elif isinstance(plan, list):
+        for p in plan:
+            s, i = _plan_stages(p)
+            stages.extend(s)
+            indexes.extend(i)
+    return stages, indexes
+
+
+def _winning_plan(explanation):
+    # aggregate explain output nests the query planner output
+    # under the first stage's $cursor
+    if 'queryPlanner' not in explanation and 'stages' in explanation:
+        explanation = explanation['stages'][0]['$cursor']
+    return explanation['queryPlanner']['winningPlan']
+
+
+def _queue_count(queue, count):
+    # runs executed in process aren't in a queue
+    return {'queue': queue, 'count': count} if queue else {'count': count}
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def encode_runs_cursor(run, direction='next'):
+    """Returns an opaque cursor referencing the position of `run` in
+    run listings, for fetching the next or previous page
+    """
+    c = json.dumps([run.get('initiated_at') or '', run['run_id'], direction])
+    return base64.urlsafe_b64encode(c.encode()).decode().rstrip('=')
+
+
+def decode_runs_cursor(cursor):
+    try:
+        c = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        initiated_at, run_id, direction = json.loads(c)
+    except Exception:
+        raise InvalidCursorError(cursor)
+    if (direction not in ('next', 'prev')
+            or not isinstance(initiated_at, str)
+            or not isinstance(run_id, str)):
+        raise InvalidCursorError(cursor)
+    return {
+        'initiated_at': initiated_at,
+        'run_id': run_id,
+        'direction': direction
+    }
+
+
+# Runs don't change once they've reached one of these statuses, though
+# their run ids may be reused; see BlueSkyWebDB._archive_run
+TERMINAL_STATUSES = (RunStatuses.Completed, RunStatuses.Failed)
+
+class BlueSkyWebDB(object):
+
+    def __init__(self, mongodb_url, write_flush_interval=1.0,
+            write_queue_size=1000, history_mode=HistoryModes.Full,
+            max_milestones=20,
+            events_retention_days=DEFAULT_EVENTS_RETENTION_DAYS,
+            count_cache_ttl=30, client=None):
+        self.client = client or get_mongo_client(mongodb_url)
+        self.db = self.client[get_db_name(mongodb_url)]
+        self.count_cache_ttl = count_cache_ttl
+        self._count_cache = {}
+        self.history_mode = history_mode
+        self.max_milestones = max_milestones
+        self.events_retention_days = events_retention_days
+        self.run_writer = RunRecordWriter(self.db.runs,
+            flush_interval=write_flush_interval, max_pending=write_queue_size,
+            events_collection=(self.db.run_events
+                if history_mode == HistoryModes.Compact else None),
+            max_milestones=max_milestones,
+            events_retention_days=events_retention_days,
+            stats_collection=self.db.run_stats)
+
+    MAX_CACHED_COUNTS = 1000
+
+    # Indexes required by the queries issued by the web service. Each
+    # is a tuple of keys and index options
+    RUNS_INDEXES = [
+        # find_run, record_run upserts
+        ([('run_id', 1)], {'name': 'run_id', 'unique': True}),
+        # find_runs without status
+        ([('initiated_at', -1), ('run_id', -1)],
+            {'name': 'initiated_at_run_id'}),
+        # find_runs by status
+        ([('history.0.status', 1), ('initiated_at', -1), ('run_id', -1)],
+            {'name': 'status_initiated_at_run_id'}),
+        # find_runs by queue
+        ([('queue', 1), ('initiated_at', -1), ('run_id', -1)],
+            {'name': 'queue_initiated_at_run_id'}),
+        # find_runs by run_id or queue tokens
+        ([('run_id_tokens', 1)], {'name': 'run_id_tokens'}),
+        ([('queue_tokens', 1)], {'name': 'queue_tokens'}),
+        # get_queue_positions
+        ([('history.0.status', 1), ('queue', 1), ('initiated_at', 1)],
+            {'name': 'status_queue_initiated_at'}),
+    ]
+
+    async def ensure_indexes(self):
+        """Creates any required indexes that don't already exist.
+
+        Failures are logged rather than raised (e.g. if duplicate run
+        ids prevent creation of the unique run_id index), so that the
+        web service can still start, except for failures to connect,
+        which are raised rather than waited out for each index.
+        """
+        for keys, options in self.RUNS_INDEXES:
+            try:
+                await self.db.runs.create_index(keys, **options)
+            except ConnectionFailure:
+                raise
+            except Exception as e:
+                logger.error('Failed to create runs index %s: %s',
+                    options['name'], e)
+        try:
+            await ensure_run_events_indexes(self.db.run_events,
+                self.events_retention_days)
+        except ConnectionFailure:
+            raise
+        except Exception as e:
+            logger.error('Failed to create run_events indexes: %s', e)
+        try:
+            await self.db.run_stats.create_index([('date', 1), ('queue', 1)],
+                unique=True)
+        except ConnectionFailure:
+            raise
+        except Exception as e:
+            logger.error('Failed to create run_stats index: %s', e)
+
+    def _query_shapes(self):
+        """Returns the shape of each query issued by the APIs, as
+        (name, collection name, explain command) tuples.
+        """
+        ts = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        status = RunStatuses.Enqueued
+        sort = dict(self.RUNS_SORT)
+        seek = {'$or': [{'initiated_at': {'$lt': ts}},
+            {'initiated_at': ts, 'run_id': {'$lt': 'x'}}]}
+        return [
+            ('find_run', 'runs', {'find': 'runs',
+                'filter': {'run_id': 'x'}, 'limit': 1}),
+            ('find_runs', 'runs', {'find': 'runs', 'filter': {},
+                'sort': sort, 'limit': 10}),
+            ('find_runs_by_status', 'runs', {'find': 'runs',
+                'filter': {'history.0.status': status},
+                'sort': sort, 'limit': 10}),
+            ('find_runs_by_status_after_cursor', 'runs', {'find': 'runs',
+                'filter': {'$and': [{'history.0.status': status}, seek]},
+                'sort': sort, 'limit': 10}),
+            ('find_runs_by_run_id', 'runs', {'find': 'runs',
+                'filter': search_query('run_id', 'x', MatchModes.Exact),
+                'sort': sort, 'limit': 10}),
+            ('find_runs_by_run_id_prefix', 'runs', {'find': 'runs',
+                'filter': search_query('run_id', 'x', MatchModes.Prefix),
+                'sort': sort, 'limit': 10}),
+            ('find_runs_by_run_id_token', 'runs', {'find': 'runs',
+                'filter': search_query('run_id', 'x-y', MatchModes.Token),
+                'sort': sort, 'limit': 10}),
+            ('find_runs_by_queue', 'runs', {'find': 'runs',
+                'filter': search_query('queue', 'x', MatchModes.Exact),
+                'sort': sort, 'limit': 10}),
+            ('find_runs_by_queue_prefix', 'runs', {'find': 'runs',
+                'filter': search_query('queue', 'x', MatchModes.Prefix),
+                'sort': sort, 'limit': 10}),
+            ('get_queue_positions', 'runs', {'aggregate': 'runs',
+                'pipeline': [
+                    {'$match': {'history.0.status': status,
+                        'queue': {'$in': ['x', 'y']},
+                        'initiated_at': {'$lte': ts}}},
+                    {'$group': {'_id': '$queue',
+                        'initiated_at': {'$push': '$initiated_at'}}}
+                ], 'cursor': {}}),
+            ('find_run_events', 'run_events', {'find': 'run_events',
+                'filter': {'run_id': 'x'}, 'sort': {'ts': -1}}),
+        ]
+
+    async def explain_queries(self):
+        """Explains each API query shape and reports which ones
+        result in collection scans.
+        """
+        report = {'ok': True, 'queries': []}
+        for name, collection, cmd in self._query_shapes():
+            e = await self.db.command('explain', cmd,
+                verbosity='queryPlanner')
+            stages, indexes = _plan_stages(_winning_plan(e))
+            collscan = 'COLLSCAN' in stages
+            if collscan:
+                logger.warning('Query %s on %s results in a collection scan',
+                    name, collection)
+                report['ok'] = False
+            report['queries'].append({
+                'name': name,
+                'collection': collection,
+                'stages': stages,
+                'indexes': indexes,
+                'collscan': collscan
+            })
+        return report
+
+    # Maps web settings to constructor kwargs. The worker receives the
+    # web settings with each job, so both use the same db configuration
+    SETTINGS_KWARGS = {
+        'run_record_flush_interval': ('write_flush_interval', float),
+        'run_record_queue_size': ('write_queue_size', int),
+        'run_history_mode': ('history_mode', str),
+        'run_history_max_milestones': ('max_milestones', int),
+        'run_events_retention_days': ('events_retention_days', float),
+        'runs_count_cache_ttl': ('count_cache_ttl', float),
+    }
+
+    @classmethod
+    def from_settings(cls, mongodb_url, settings):
+        kwargs = {k: t(settings[s]) for s, (k, t) in cls.SETTINGS_KWARGS.items()
+            if settings.get(s) is not None}
+        client = get_mongo_client(mongodb_url,
+            **pool_kwargs_from_settings(settings))
+        return cls(mongodb_url, client=client, **kwargs)
+
+    @property
+    def write_stats(self):
+        return self.run_writer.stats
+
+    def flush(self, timeout=None):
+        """Blocks until all recorded run updates have been written"""
+        return self.run_writer.flush(timeout=timeout)
+
+    def start_writer(self):
+        """Starts writing recorded run updates from the caller's event
+        loop; see RunRecordWriter.start
+        """
+        self.run_writer.start()
+
+    async def close(self, timeout=30):
+        """Writes all recorded run updates and stops the writer. The
+        client is shared, and so is left open; see close_mongo_clients.
+        """
+        return await self.run_writer.close(timeout=timeout)
+
+    def record_run(self, run_id, status, module=None, log=None, stdout=None,
+            percent_complete=None, status_message=None, put_timeout=None,
+            **data):
+        """Queues the update to be written to the run's document.
+
+        put_timeout, if specified, overrides the run record writer's
+        put_timeout; with 0, non-terminal updates are dropped rather
+        than waited on if the writer's queue is full.
+        """
+
+        ts = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        entry = {'status': status, 'ts': ts}
         if module:
-            doc["$push"]["history"]['$each'][0]["module"] = module
+            entry["module"] = module
         if log:
-            doc["$push"]["history"]['$each'][0]["log"] = log
+            entry["log"] = log
         if stdout:
-            doc["$push"]["history"]['$each'][0]["stdout"] = stdout
+            entry["stdout"] = stdout
         if percent_complete is not None:
-            doc["$push"]["history"]['$each'][0]["perc"] = percent_complete
+            entry["perc"] = percent_complete
             # als put percent complete in data
-            if data:
-                data['percent'] = percent_complete
-            else:
-                data = {'percent': percent_complete}
+            data['percent'] = percent_complete
         if status_message:
-            doc["$push"]["history"]['$each'][0]["msg"] = status_message
+            entry["msg"] = status_message
 
-        if data:
-            doc["$set"] = data
+        # Tokens are recorded when the run is initiated and when it's
+        # added to a queue, to support indexed token searches
+        if 'initiated_at' in data:
+            data['run_id_tokens'] = tokenize(run_id)
+        if data.get('queue'):
+            data['queue_tokens'] = tokenize(data['queue'])
 
-        # There should never be multiple entries, since we're always
-        # doing upserts
-        async def _do():
-            try:
-                result = await self.db.runs.update_one(spec, doc, upsert=True)
-                logger.debug('Recorded run: %s', result)
-            except Exception as e:
-                logger.error('Error recording run: %s', e)
+        # Updates are written as upserts, so there should never be
+        # multiple entries per run
+        self.run_writer.put(run_id, entry, data,
+            terminal=status in TERMINAL_STATUSES, timeout=put_timeout)
 
-        try:
-            loop = asyncio.get_running_loop()
-            loop.create_task(_do())
-        except RuntimeError:
-            asyncio.run_coroutine_threadsafe(_do(), _get_bg_loop())
+    async def find_run(self, run_id, projection=None):
+        """Returns the run's document, or None if it doesn't exist.
 
-    async def find_run(self, run_id):
-        run = await self.db.runs.find_one({"run_id": run_id})
+        kwargs:
+         - projection -- mongodb projection specifying which fields to
+           return (or exclude)
+        """
+        run = await self.db.runs.find_one({"run_id": run_id}, projection)
         if run:
-            run.pop('_id')
+            run.pop('_id', None)
         return run
 
-    async def find_runs(self, status=None, limit=None, offset=None, run_id=None, queue=None):
-        query = {'history.0.status': status} if status else {}
+    RUNS_SORT = [('initiated_at', -1), ('run_id', -1)]
+
+    def _runs_query(self, status=None, run_id=None, queue=None,
+            match=MatchModes.default):
+        conditions = []
+        if status:
+            conditions.append({'history.0.status': status})
         if run_id:
-            # TODO: protect against sql-injection types of attacks
-            query['run_id'] = { '$regex': run_id }
+            conditions.append(search_query('run_id', run_id, match))
         if queue:
-            # TODO: protect against sql-injection types of attacks
-            query['queue'] = { '$regex': queue }
-        logger.debug('query, limit, offset: %s, %s, %s', query, limit, offset)
-
-        # Count sometimes returns wront vallue if there are
-        # 'orphaned' (?) documents. So, use aggregate instead:
-        #total_count = await self.db.runs.count(query)
-        cursor = self.db.runs.aggregate([
-            { "$match": query },
-            { "$count": "count" }
-        ])
-
-        r = await cursor.to_list(1)
-        total_count = r[0]['count'] if r else 0
-
-        if total_count > 0:
-            cursor = self.db.runs.find(query)
-            cursor = cursor.sort([('initiated_at', -1)]).limit(limit).skip(offset)
-
-            # runs = []
-            # async for r in cursor:
-            #     logger.debug('run: %s', r)
-            #     r.pop('_id')
-            #     runs.append(r)
-            runs = await cursor.to_list(limit)
-
-            for r in runs:
-                r.pop('_id')
-        else:
-            runs = []
+            conditions.append(search_query('queue', queue, match))
+        if len(conditions) > 1:
+            return {'$and': conditions}
+        return conditions[0] if conditions else {}
+
+    async def find_runs(self, status=None, limit=None, offset=None,
+            run_id=None, queue=None, cursor=None, count=True,
+            match=MatchModes.default, projection=None):
+        """Returns a page of runs, most recently initiated first, along
+        with the total number of matching runs.
+
+        kwargs:
+         - cursor -- decoded cursor (see `decode_runs_cursor`); if
+           specified, seeks to the page after (or before) the run
+           referenced by the cursor, and `offset` is ignored
+         - count -- if False, the total isn't counted, and None is
+           returned in its place
+         - match -- how `run_id` and `queue` are matched; see `MatchModes`
+         - projection -- mongodb projection specifying which fields to
+           return (or exclude); run_id and initiated_at must not be
+           excluded if the returned runs are used to create cursors
+        """
+        query = self._runs_query(status=status, run_id=run_id, queue=queue,
+            match=match)
+        logger.debug('query, limit, offset, cursor: %s, %s, %s, %s',
+            query, limit, offset, cursor)
+
+        total_count = await self.count_runs(query) if count else None
+
+        sort = self.RUNS_SORT
+        if cursor:
+            backward = cursor['direction'] == 'prev'
+            op = '$gt' if backward else '$lt'
+            seek_query = {'$or': [
+                {'initiated_at': {op: cursor['initiated_at']}},
+                {'initiated_at': cursor['initiated_at'],
+                    'run_id': {op: cursor['run_id']}}
+            ]}
+            query = {'$and': [query, seek_query]} if query else seek_query
+            if backward:
+                sort = [(k, -d) for k, d in sort]
+
+        db_cursor = self.db.runs.find(query, projection).sort(sort)
+        if limit:
+            db_cursor = db_cursor.limit(limit)
+        if offset and not cursor:
+            db_cursor = db_cursor.skip(offset)
+        runs = await db_cursor.to_list(limit)
+
+        for r in runs:
+            r.pop('_id', None)
+        if cursor and backward:
+            runs.reverse()
 
         return runs, total_count
 
+    async def count_runs(self, query):
+        """Counts runs matching query, caching counts for
+        `count_cache_ttl` seconds.
+
+        Counts of all runs are estimated from collection metadata.
+        """
+        key = json.dumps(query, sort_keys=True)
+        now = time.monotonic()
+        cached = self._count_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        if query:
+            # Count sometimes returns wront vallue if there are
+            # 'orphaned' (?) documents. So, use aggregate instead:
+            cursor = self.db.runs.aggregate([
+                { "$match": query },
+                { "$count": "count" }
+            ])
+            r = await cursor.to_list(1)
+            count = r[0]['count'] if r else 0
+        else:
+            count = await self.db.runs.estimated_document_count()
+
+        if len(self._count_cache) >= self.MAX_CACHED_COUNTS:
+            self._count_cache = {k: v for k, v in self._count_cache.items()
+                if v[0] > now}
+        self._count_cache[key] = (now + self.count_cache_ttl, count)
+        return count
+
+    async def find_run_events(self, run_id, limit=None):
+        """Returns the full status history of a run, most recent first.
+
+        Falls back on the run document's history if the run's events
+        weren't recorded in the 'run_events' collection.
+        """
+        cursor = self.db.run_events.find({'run_id': run_id},
+            {'_id': 0, 'run_id': 0, 'recorded_at': 0}).sort([('ts', -1)])
+        events = await cursor.to_list(limit)
+        if not events:
+            run = await self.db.runs.find_one({'run_id': run_id},
+                {'history': 1})
+            events = (run or {}).get('history', [])[:limit]
+        return events
+
+    async def migrate_run_history(self, batch_size=100):
+        """Moves full status history of runs recorded in 'full' mode to
+        the 'run_events' collection, and compacts history in each run
+        document to the latest status plus capped milestones.
+
+        Runs that have already been migrated or that were recorded in
+        compact mode are skipped, so this is safe to rerun. Migrated
+        events are stamped as recorded at the time of the migration, so
+        that they're kept for the full retention period rather than
+        expiring as soon as they're inserted.
+        """
+        await ensure_run_events_indexes(self.db.run_events,
+            self.events_retention_days)
+
+        query = {'history_mode': {'$ne': HistoryModes.Compact}}
+        counts = {'runs': 0, 'events': 0}
+        while True:
+            runs = await self.db.runs.find(query,
+                {'run_id': 1, 'history': 1}).limit(batch_size).to_list(batch_size)
+            if not runs:
+                break
+
+            ops = []
+            for run in runs:
+                # history was pushed to the front as entries arrived, so
+                # it isn't necessarily in reverse chronological order
+                history = sorted(run.get('history') or [],
+                    key=lambda e: e.get('ts') or '', reverse=True)
+                recorded_at = datetime.datetime.utcnow()
+                events = [dict(e, run_id=run['run_id'],
+                    recorded_at=recorded_at) for e in reversed(history)]
+                if events:
+                    # Remove any events left over from an aborted
+                    # migration of this run before reinserting
+                    await self.db.run_events.delete_many(
+                        {'run_id': run['run_id']})
+                    await self.db.run_events.insert_many(events)
+
+                compacted = history[:1] + [e for e in history[1:]
+                    if not is_progress_entry(e)][:self.max_milestones]
+                ops.append(UpdateOne({'_id': run['_id']}, {'$set': {
+                    'history': compacted,
+                    'history_mode': HistoryModes.Compact
+                }}))
+                counts['runs'] += 1
+                counts['events'] += len(events)
+
+            await self.db.runs.bulk_write(ops, ordered=False)
+            logger.info('Migrated %s runs (%s events)', counts['runs'],
+                counts['events'])
+
+        return counts
+
     async def get_queue_position(self, run):
         """
 
@@ -173,15 +1175,67 @@ class BlueSkyWebDB(object):
             # it's a run id; query run
             run = await self.find_run(run)
 
-        if run['history'][0]['status'] == RunStatuses.Enqueued:
-            query = {
-                'history.0.status': RunStatuses.Enqueued,
-                'initiated_at': {'$lte': run['initiated_at']},
-                'queue': run['queue']
+        positions = await self.get_queue_positions([run])
+        # returns None if not in queue
+        return positions.get(run['run_id'])
+
+    async def build_search_tokens(self, batch_size=500):
+        """Sets run_id and queue tokens on runs recorded before
+        tokens were introduced.
+        """
+        query = {'run_id_tokens': {'$exists': False}}
+        num_updated = 0
+        while True:
+            runs = await self.db.runs.find(query, {'run_id': 1, 'queue': 1}
+                ).limit(batch_size).to_list(batch_size)
+            if not runs:
+                break
+            await self.db.runs.bulk_write([
+                UpdateOne({'_id': r['_id']}, {'$set': {
+                    'run_id_tokens': tokenize(r['run_id']),
+                    'queue_tokens': tokenize(r.get('queue'))
+                }}) for r in runs
+            ], ordered=False)
+            num_updated += len(runs)
+            logger.info('Set search tokens on %s runs', num_updated)
+        return num_updated
+
+    async def get_queue_positions(self, runs):
+        """Returns queue positions of multiple runs, keyed by run_id,
+        using one aggregation for all of them.
+
+        Runs that aren't enqueued are excluded from the returned dict.
+        """
+        enqueued = [r for r in runs if r.get('queue') and r.get('history')
+            and r['history'][0]['status'] == RunStatuses.Enqueued]
+        if not enqueued:
+            return {}
+
+        pipeline = [
+            {
+                "$match": {
+                    'history.0.status': RunStatuses.Enqueued,
+                    'queue': {'$in': list({r['queue'] for r in enqueued})},
+                    'initiated_at': {
+                        '$lte': max(r['initiated_at'] for r in enqueued)
+                    }
+                }
+            },
+            {
+                "$group": {
+                    "_id": "$queue",
+                    "initiated_at": {"$push": "$initiated_at"}
+                }
             }
-            return await self.db.runs.count_documents(query)
+        ]
+        queues = {}
+        async for e in self.db.runs.aggregate(pipeline):
+            queues[e['_id']] = sorted(e['initiated_at'])
 
-        # else, returns None -> i.e. not in queue
+        # Position is the number of runs in the same queue that were
+        # initiated at or before the given run
+        return {r['run_id']: bisect.bisect_right(queues.get(r['queue'], []),
+            r['initiated_at']) for r in enqueued}
 
     # *** Temporarary HACK ***
     async def _archive_run(self, run):
@@ -190,95 +1244,131 @@ class BlueSkyWebDB(object):
             run['run_id'] += '-' + datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')
             logger.info('Setting run %s with new run_id %s', old_run_id, run['run_id'])
             await self.db.runs.update_one({'run_id': old_run_id},
+                {'$set': {'run_id': run['run_id'],
+                    'run_id_tokens': tokenize(run['run_id'])}})
+            await self.db.run_events.update_many({'run_id': old_run_id},
                 {'$set': {'run_id': run['run_id']}})
     # *** Temporarary HACK ***
 
     async def delete_run(self, run_id):
         r = await self.db.runs.delete_one({'run_id': run_id})
+        await self.db.run_events.delete_many({'run_id': run_id})
         return r.deleted_count
 
     async def delete_all_runs(self):
         r = await self.db.runs.delete_many({})
+        await self.db.run_events.delete_many({})
         return r.deleted_count
 
 
     ## Stats
 
-    async def run_counts_by_month(self, run_id=None):
-        """Returns run counts, per month, for past year
+    # Run counts are maintained per day and queue in the 'run_stats'
+    # collection, incremented when each run is initiated. Counts
+    # filtered by run_id can't use these rollups, and so are
+    # aggregated from the runs collection, as are counts for days
+    # the rollups may not fully cover (see _rolled_up_run_counts).
+
+    async def run_counts_by_month(self, run_id=None, match=MatchModes.default,
+            start=None, end=None):
+        """Returns run counts, per month, for past year or between
+        start and end dates (inclusive), most recent first
+
+        kwargs:
+         - start / end -- 'YYYY-MM-DD' date strings
         """
-        # TOOD: support query parameters to override default of past year,
-        #   and set argument to `to_list`, below, accordingly
-        year_ago = datetime.datetime.now() - datetime.timedelta(days=365)
-        since_str = datetime.date(year_ago.year, year_ago.month, 1).strftime("%Y-%m-%dT00:00:00")
+        if not start:
+            year_ago = datetime.datetime.now() - datetime.timedelta(days=365)
+            start = datetime.date(year_ago.year, year_ago.month, 1).strftime("%Y-%m-%d")
 
-        pipeline = [
-            {
-                "$match": {
-                    "initiated_at": { "$gte": since_str }
-                }
-            },
-            {
-                "$group": {
-                    "_id": {
-                        "year": {"$substr": [ "$initiated_at", 0, 4 ] },
-                        "month": {"$substr": [ "$initiated_at", 5, 2 ] },
-                        "queue": "$queue",
-                    },
-                    "count": { "$sum": 1 }
-                }
-            },
-            {
-                "$group": {
-                    "_id": {
-                        "year": "$_id.year",
-                        "month": "$_id.month",
-                    },
-                    "count": { "$sum": '$count' },
-                    "by_queue": {
-                        "$push": {
-                            "queue": '$_id.queue',
-                            "count": '$count'
-                        }
-                    }
-                }
-            },
-            {
-                '$sort': {'_id': -1}
-            }
-        ]
+        counts = await self._run_counts(7, start, end, run_id, match)
+        return [dict(year=k[:4], month=k[5:7], **v) for k, v in counts]
+
+    async def run_counts_by_day(self, run_id=None, match=MatchModes.default,
+            start=None, end=None):
+        """Returns run counts, per day, for past 30 days or between
+        start and end dates (inclusive), most recent first
+
+        kwargs:
+         - start / end -- 'YYYY-MM-DD' date strings
+        """
+        if not start:
+            month_ago = datetime.datetime.now() - datetime.timedelta(days=30)
+            start = month_ago.strftime("%Y-%m-%d")
+
+        counts = await self._run_counts(10, start, end, run_id, match)
+        return [dict(date=k, **v) for k, v in counts]
 
+    async def _run_counts(self, key_length, start, end, run_id, match):
+        """Returns list of (key, counts) tuples, where each key is a
+        date string truncated to `key_length`, sorted most recent first.
+        """
         if run_id:
-            # insert at beginning
-            pipeline.insert(0, {
-                "$match": {
-                    "run_id": { '$regex': run_id }
-                }
-            })
+            counts_by_queue = await self._aggregate_run_counts(
+                start, end, run_id, match)
+        else:
+            counts_by_queue = await self._rolled_up_run_counts(start, end)
+
+        grouped = {}
+        for e in counts_by_queue:
+            g = grouped.setdefault(e['date'][:key_length],
+                {'count': 0, 'by_queue': {}})
+            g['count'] += e['count']
+            g['by_queue'][e.get('queue')] = (
+                g['by_queue'].get(e.get('queue'), 0) + e['count'])
 
-        cursor = self.db.runs.aggregate(pipeline)
-        r = await cursor.to_list(12)
+        return [(k, {
+            'count': grouped[k]['count'],
+            'by_queue': sorted([_queue_count(q, c)
+                for q, c in grouped[k]['by_queue'].items()],
+                key=lambda e: -e["count"])
+        }) for k in sorted(grouped, reverse=True)]
 
-        return [{
-            'year': e['_id']['year'],
-            'month': e['_id']['month'],
-            'count': e['count'],
-            'by_queue': sorted(e['by_queue'], key=lambda e: -e["count"])
-        } for e in r]
+    async def _rolled_up_run_counts(self, start, end=None):
+        """Returns daily per-queue run counts from the run_stats rollups.
 
-    async def run_counts_by_day(self, run_id=None):
-        """Returns run counts, per day, for past 30 days
+        Rollups are only complete from the day after the earliest one,
+        since runs initiated before they were introduced aren't counted
+        until rebuild_run_stats is run. Counts up to and including the
+        earliest day with rollups (or for the entire range, if there
+        are none) are therefore aggregated from the runs collection.
         """
-        # TOOD: support query parameters to override default of past
-        #   30 days, and set argument to `to_list`, below, accordingly
-        month_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-        since_str = month_ago.strftime("%Y-%m-%dT00:00:00")
+        first = await self.db.run_stats.find_one({}, {'_id': 0, 'date': 1},
+            sort=[('date', 1)])
+        if not first:
+            return await self._aggregate_run_counts(start, end)
+
+        complete_from = (datetime.datetime.strptime(first['date'], "%Y-%m-%d")
+            + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        counts = []
+        if start < complete_from:
+            counts.extend(await self._aggregate_run_counts(start,
+                min(end, first['date']) if end else first['date']))
+        if not end or end >= complete_from:
+            query = {'date': {'$gte': max(start, complete_from)}}
+            if end:
+                query['date']['$lte'] = end
+            counts.extend(await self.db.run_stats.find(query,
+                {'_id': 0}).to_list(None))
+        return counts
+
+    async def _aggregate_run_counts(self, start, end=None, run_id=None,
+            match=MatchModes.default):
+        """Counts runs per day and queue from the runs collection"""
+        initiated_at = {"$gte": start}
+        if end:
+            # initiated_at is a datetime string, so compare with the
+            # beginning of the day after the end date
+            initiated_at['$lt'] = (datetime.datetime.strptime(end, "%Y-%m-%d")
+                + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        match_stage = {"initiated_at": initiated_at}
+        if run_id:
+            match_stage = {'$and': [search_query('run_id', run_id, match),
+                match_stage]}
 
         pipeline = [
             {
-                "$match": {
-                    "initiated_at": { "$gte": since_str }
-                }
+                "$match": match_stage
             },
             {
                 "$group": {
@@ -288,37 +1378,33 @@ class BlueSkyWebDB(object):
                     },
                     "count": { "$sum": 1 }
                 }
-            },
-            {
-                "$group": {
-                    "_id":  "$_id.date",
-                    "count": { "$sum": "$count"},
-                    "by_queue": {
-                        "$push": {
-                            "queue": "$_id.queue",
-                            "count": "$count"
-                        }
-                    }
-                }
-            },
-            {
-                "$sort": {"_id": -1}
             }
         ]
+        return [{'date': e['_id']['date'], 'queue': e['_id'].get('queue'),
+            'count': e['count']} async for e in self.db.runs.aggregate(pipeline)]
 
-        if run_id:
-            # insert at beginning
-            pipeline.insert(0, {
-                "$match": {
-                    "run_id": { '$regex': run_id }
-                }
-            })
+    async def rebuild_run_stats(self, start=None, end=None):
+        """Rebuilds the daily run count rollups from the runs collection,
+        for all dates or between start and end dates (inclusive)
+
+        Note that runs initiated while the rebuild is in progress may
+        not be counted.
+        """
+        counts = await self._aggregate_run_counts(start or '', end)
 
-        cursor = self.db.runs.aggregate(pipeline)
-        r = await cursor.to_list(30)
+        query = {}
+        if start or end:
+            query['date'] = {}
+            if start:
+                query['date']['$gte'] = start
+            if end:
+                query['date']['$lte'] = end
+        await self.db.run_stats.delete_many(query)
 
-        return [{
-            'date': e['_id'],
-            'count': e['count'],
-            'by_queue': sorted(e['by_queue'], key=lambda e: -e["count"])
-        } for e in r]
+        if counts:
+            await self.db.run_stats.bulk_write([
+                ReplaceOne({'date': e['date'], 'queue': e['queue']}, e,
+                    upsert=True) for e in counts
+            ], ordered=False)
+        return {'days': len({e['date'] for e in counts}),
+            'runs': sum(e['count'] for e in counts)}
@@ -4,11 +4,18 @@ __author__ = "Joel Dubowy"
 __copyright__ = "Copyright 2015, AirFire, PNW, USFS"
 
 import datetime
+import hashlib
 import json
 import logging
+import math
 
 from fastapi import HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response, StreamingResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
@@ -76,17 +83,154 @@ def raise_error(status: int, msg: str, exception=None):
     raise HTTPException(status_code=status, detail=msg)
 
 
-def make_json_response(val, verbose=False, status_code=200):
-    """Create a sorted JSON response, optionally stripping verbose fields."""
+##
+## JSON encoding
+##
+
+_FIRE_ENCODER = None
+
+def _json_default(obj):
+    global _FIRE_ENCODER
+    if isinstance(obj, (datetime.date, datetime.datetime, datetime.time)):
+        return obj.isoformat()
+    if _FIRE_ENCODER is None:
+        # Import here, rather than at startup, since bluesky is slow
+        # to import and is only needed for encoding bluesky models
+        from bluesky.models.fires import FireEncoder
+        _FIRE_ENCODER = FireEncoder()
+    # raises TypeError if obj isn't a bluesky model
+    return _FIRE_ENCODER.default(obj)
+
+
+# orjson is used if it's installed. The stdlib fallback, which is also
+# used for streamed responses, sanitizes values first so that both
+# produce the same JSON: NaN and infinite floats are encoded as null,
+# non-string keys are converted to strings before being sorted, and
+# datetimes are always formatted by _json_default.
+
+def _json_key(key):
+    """Converts a dict key to a string, as orjson's OPT_NON_STR_KEYS does"""
+    if isinstance(key, str):
+        return key
+    if key is None:
+        return 'null'
+    if isinstance(key, bool):
+        return 'true' if key else 'false'
+    if isinstance(key, int):
+        return str(int(key))
+    if isinstance(key, float):
+        return repr(float(key)) if math.isfinite(key) else 'null'
+    return _json_default(key)
+
+
+def _sanitize(val):
+    """Returns val with NaN and infinite floats replaced by None and
+    with non-string dict keys converted to strings. Only containers
+    that need changes are copied.
+    """
+    if isinstance(val, float):
+        return val if math.isfinite(val) else None
+    if isinstance(val, dict):
+        items = []
+        changed = False
+        for k, v in val.items():
+            sk, sv = _json_key(k), _sanitize(v)
+            changed = changed or sk is not k or sv is not v
+            items.append((sk, sv))
+        return dict(items) if changed else val
+    if isinstance(val, (list, tuple)):
+        sanitized = [_sanitize(v) for v in val]
+        if any(s is not v for s, v in zip(sanitized, val)):
+            return sanitized
+    return val
+
+
+def _sanitized_json_default(obj):
+    return _sanitize(_json_default(obj))
+
+
+# Options matching JSONResponse's rendering, plus sorted keys
+_JSON_KWARGS = dict(sort_keys=True, default=_sanitized_json_default,
+    ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+
+if orjson:
+    _ORJSON_OPTIONS = (orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME)
+
+def dump_json(val):
+    """Serializes val to sorted JSON, as bytes, in one pass"""
+    if orjson:
+        return orjson.dumps(val, default=_json_default,
+            option=_ORJSON_OPTIONS)
+    return json.dumps(_sanitize(val), **_JSON_KWARGS).encode('utf-8')
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _iter_json(val):
+    chunk = []
+    size = 0
+    for s in json.JSONEncoder(**_JSON_KWARGS).iterencode(_sanitize(val)):
+        chunk.append(s)
+        size += len(s)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk).encode('utf-8')
+
+
+def strip_verbose_fields(val, verbose=False):
+    if not verbose and hasattr(val, 'keys'):
+        for k in VERBOSE_FIELDS:
+            val.pop(k, None)
+    return val
+
+
+def make_json_response(val, verbose=False, status_code=200, stream=False,
+        headers=None):
+    """Create a sorted JSON response, optionally stripping verbose fields.
+
+    If `stream` is true, the response is encoded incrementally, as it's
+    sent, which avoids holding the whole encoded body of very large
+    responses in memory.
+    """
     if hasattr(val, 'keys'):
-        if not verbose:
-            for k in VERBOSE_FIELDS:
-                val.pop(k, None)
-        content = json.loads(json.dumps(val, sort_keys=True))
-        return JSONResponse(content=content, status_code=status_code)
+        strip_verbose_fields(val, verbose)
+        if stream:
+            # starlette iterates sync generators in its thread pool
+            return StreamingResponse(_iter_json(val), status_code=status_code,
+                media_type="application/json", headers=headers)
+        return Response(content=dump_json(val), status_code=status_code,
+            media_type="application/json", headers=headers)
     return val
 
 
+##
+## Conditional requests
+##
+
+def make_etag(*parts):
+    """Returns a strong ETag identifying the given parts"""
+    key = ':'.join(str(p) for p in parts)
+    return '"{}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def is_not_modified(request: Request, etag):
+    """Returns True if the request's If-None-Match header matches etag"""
+    val = request.headers.get('if-none-match')
+    if not val:
+        return False
+    tags = [t.strip() for t in val.split(',')]
+    # weak comparison, as specified for If-None-Match
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def not_modified_response(headers):
+    return Response(status_code=304, headers=headers)
+
+
 class DataCollector:
     """Collects data written to it via write(), to be returned as API response."""
 
@@ -14,4 +14,14 @@ __all__ = ['router']
 @router.get("/api/v{api_version}/config/defaults/")
 async def config_defaults(api_version: str, request: Request):
     verbose = get_boolean_arg(request, 'verbose')
-    return make_json_response(blueskyconfig.ConfigManagerSingleton().config, verbose=verbose)
+    # config is read-only, so copy the top level, from which
+    # make_json_response removes verbose fields
+    return make_json_response(dict(blueskyconfig.ConfigManagerSingleton().config),
+        verbose=verbose)
+
+
+@router.get("/api/v{api_version}/config/status")
+@router.get("/api/v{api_version}/config/status/")
+async def config_status(api_version: str, request: Request):
+    """Returns the config version and reload stats"""
+    return make_json_response(blueskyconfig.ConfigManagerSingleton().stats)
@@ -68,11 +68,18 @@ async def domain_info_by_id(api_version: str, domain_id: str, request: Request):
 ##
 
 
-async def _marshall_archive(archive_group, archive_id, archives, met_archives_db):
-    r = dict(archives[archive_group][archive_id], id=archive_id, group=archive_group)
-    availability = await met_archives_db.get_availability(archive_id)
-    r.update(availability)
-    return r
+async def _marshall_archives(archive_ids_by_group, archives, met_archives_db):
+    """Marshalls each (archive_group, archive_id) pair, looking up the
+    availability of all of the archives at once
+    """
+    availability = await met_archives_db.get_availability_by_archive(
+        [archive_id for archive_group, archive_id in archive_ids_by_group])
+    result = []
+    for archive_group, archive_id in archive_ids_by_group:
+        r = dict(archives[archive_group][archive_id], id=archive_id, group=archive_group)
+        r.update(availability[archive_id])
+        result.append(r)
+    return result
 
 
 def _filter_by_available(archives, available):
@@ -87,14 +94,13 @@ def _filter_by_available(archives, available):
 @router.get("/api/v{api_version}/met/archives")
 @router.get("/api/v{api_version}/met/archives/")
 async def met_archives_info(api_version: str, request: Request):
-    mongodb_url = request.app.state.settings['mongodb_url']
-    met_archives_db = met.db.MetArchiveDB(mongodb_url)
+    met_archives_db = request.app.state.settings['met_db']
     archives = blueskyconfig.get('archives')
 
-    result = []
-    for archive_group in archives:
-        for archive_id in archives[archive_group]:
-            result.append(await _marshall_archive(archive_group, archive_id, archives, met_archives_db))
+    result = await _marshall_archives([(archive_group, archive_id)
+        for archive_group in archives
+        for archive_id in archives[archive_group]],
+        archives, met_archives_db)
 
     available = get_boolean_arg(request, 'available')
     result = _filter_by_available(result, available)
@@ -106,17 +112,16 @@ async def met_archives_info(api_version: str, request: Request):
 @router.get("/api/v{api_version}/met/archives/{identifier}")
 @router.get("/api/v{api_version}/met/archives/{identifier}/")
 async def met_archive_info_by_identifier(api_version: str, identifier: str, request: Request):
-    mongodb_url = request.app.state.settings['mongodb_url']
-    met_archives_db = met.db.MetArchiveDB(mongodb_url)
+    met_archives_db = request.app.state.settings['met_db']
     archives = blueskyconfig.get('archives')
     available = get_boolean_arg(request, 'available')
     verbose = get_boolean_arg(request, 'verbose')
 
     if identifier in archives:
         # It's an archive group
-        result = []
-        for archive_id in archives[identifier]:
-            result.append(await _marshall_archive(identifier, archive_id, archives, met_archives_db))
+        result = await _marshall_archives([(identifier, archive_id)
+            for archive_id in archives[identifier]],
+            archives, met_archives_db)
         result = _filter_by_available(result, available)
         return make_json_response({"archives": result}, verbose=verbose)
 
@@ -124,7 +129,8 @@ async def met_archive_info_by_identifier(api_version: str, identifier: str, requ
         # Look for a specific archive_id across all groups
         for archive_group in archives:
             if identifier in archives[archive_group]:
-                result = await _marshall_archive(archive_group, identifier, archives, met_archives_db)
+                result = (await _marshall_archives([(archive_group, identifier)],
+                    archives, met_archives_db))[0]
                 return make_json_response({"archive": result}, verbose=verbose)
 
         raise HTTPException(status_code=404, detail="Archive does not exist")
@@ -139,8 +145,7 @@ DEFAULT_DATE_RANGE = 3
 @router.get("/api/v{api_version}/met/archives/{archive_id}/{date_str}/")
 async def met_archive_availability(api_version: str, archive_id: str, date_str: str,
         request: Request):
-    mongodb_url = request.app.state.settings['mongodb_url']
-    met_archives_db = met.db.MetArchiveDB(mongodb_url)
+    met_archives_db = request.app.state.settings['met_db']
 
     m = DATE_MATCHER.match(date_str)
     if not m:
@@ -3,8 +3,9 @@
 __author__ = "Joel Dubowy"
 __copyright__ = "Copyright 2015, AirFire, PNW, USFS"
 
-from fastapi import APIRouter
-from bluesky import __version__
+from fastapi import APIRouter, Request
+
+from blueskymongo.client import mongo_pool_stats
 
 router = APIRouter()
 
@@ -14,5 +15,37 @@ __all__ = ['router']
 @router.get("/api/ping")
 @router.get("/api/ping/")
 async def ping():
+    # Import here so that bluesky isn't loaded at startup
+    from bluesky import __version__
+
     # TODO: return anything else?
     return {"msg": "pong", "blueskyVersion": __version__}
+
+
+@router.get("/api/ping/mongo")
+@router.get("/api/ping/mongo/")
+async def ping_mongo(request: Request):
+    """Returns mongodb connection pool, run record write queue and
+    met archive cache usage
+    """
+    settings = request.app.state.settings
+    return {
+        "pools": mongo_pool_stats(),
+        "runWrites": settings['mongo_db'].write_stats,
+        "metCache": settings['met_db'].cache_stats
+    }
+
+
+@router.get("/api/ping/runs")
+@router.get("/api/ping/runs/")
+async def ping_runs(request: Request):
+    """Returns in-process run pool saturation, run publishing and run
+    output and status cache stats
+    """
+    settings = request.app.state.settings
+    return {
+        "inProcess": settings['run_pool'].stats,
+        "publisher": settings['run_publisher'].stats,
+        "outputCache": settings['output_cache'].stats,
+        "statusCache": settings['run_status_cache'].stats
+    }
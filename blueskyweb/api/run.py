@@ -4,17 +4,22 @@ __author__ = "Joel Dubowy"
 __copyright__ = "Copyright 2015, AirFire, PNW, USFS"
 
 import datetime
+import email.utils
 import json
 import logging
 
 from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
 
-from blueskymongo.client import RunStatuses
-from blueskyweb.lib.runs.execute import BlueSkyRunExecutor, ExecuteMode
-from blueskyweb.lib.runs.output import BlueSkyRunOutput
+from blueskymongo.client import (
+    RunStatuses, MatchModes, InvalidCursorError, TERMINAL_STATUSES,
+    encode_runs_cursor, decode_runs_cursor
+)
+from blueskyweb.lib.cache import TTLCache
 from . import (
-    get_boolean_arg, get_datetime_arg,
-    make_json_response, DataCollector
+    get_boolean_arg, get_datetime_arg, dump_json, strip_verbose_fields,
+    make_json_response, make_etag, is_not_modified, not_modified_response,
+    DataCollector, VERBOSE_FIELDS
 )
 
 logger = logging.getLogger(__name__)
@@ -33,6 +38,10 @@ __all__ = ['router']
 @router.post("/api/v{api_version}/run/{mode}/")
 async def run_execute(api_version: str, mode: str, request: Request,
         archive_id: str = None):
+    # Import here, rather than at startup, since execute loads bluesky,
+    # geoutils and blueskyworker.tasks, which are slow to import
+    from blueskyweb.lib.runs.execute import BlueSkyRunExecutor, ExecuteMode
+
     body = await request.body()
     if not body:
         raise HTTPException(status_code=400, detail='empty post data')
@@ -58,10 +67,10 @@ async def run_execute(api_version: str, mode: str, request: Request,
 
     collector = DataCollector()
 
-    def handle_error(status: int, msg: str, exception=None):
+    def handle_error(status: int, msg: str, exception=None, headers=None):
         if exception:
             logger.error('Exception: %s', exception)
-        raise HTTPException(status_code=status, detail=msg)
+        raise HTTPException(status_code=status, detail=msg, headers=headers)
 
     executor = BlueSkyRunExecutor(api_version, mode, archive_id,
         handle_error, collector, settings, hysplit_query_params,
@@ -79,6 +88,8 @@ async def run_execute(api_version: str, mode: str, request: Request,
     logger.debug("Execute API response data: %s", data)
 
     status_code = 400 if (isinstance(data, dict) and 'error' in data) else 200
+    if executor.enqueue_pending:
+        status_code = 202
     verbose = get_boolean_arg(request, 'verbose')
     return make_json_response(data, verbose=verbose, status_code=status_code)
 
@@ -94,45 +105,92 @@ def _get_float_param(request: Request, key: str):
     return None
 
 
+def _get_date_param(request: Request, key: str):
+    val = request.query_params.get(key)
+    if val is not None:
+        try:
+            return datetime.datetime.strptime(val, "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400,
+                detail=f"Invalid date value '{val}' for query arg {key}. Use format YYYY-MM-DD")
+    return None
+
+
 ###
 ### Run status helpers
 ###
 
-RUN_STATUS_VERBOSE_FIELDS = ('output_dir', 'modules', 'server', 'export', 'fires')
+RUN_STATUS_VERBOSE_FIELDS = ('output_dir', 'modules', 'server', 'export',
+    'fires', 'history_mode', 'run_id_tokens', 'queue_tokens')
 AVERAGE_RUN_TIME_IN_SECONDS = 360
 
 
+def _run_projection(raw, verbose, listing=False):
+    """Returns projection that excludes fields that would otherwise be
+    stripped from the response, so that mongodb doesn't send them.
+
+    Verbose fields are only stripped from the top level of responses,
+    so they're kept in each run of a listing.
+    """
+    excluded = set()
+    projection = {'_id': 0}
+    if not raw:
+        excluded.update(RUN_STATUS_VERBOSE_FIELDS)
+        # only the latest status is returned
+        projection['history'] = {'$slice': 1}
+    if not verbose and not listing:
+        excluded.update(VERBOSE_FIELDS)
+    projection.update({k: 0 for k in sorted(excluded)})
+    return projection
+
+
 async def _process_run(run, mongo_db, raw=False):
+    await _process_runs([run], mongo_db, raw=raw)
+    return run
+
+
+async def _process_runs(runs, mongo_db, raw=False):
     if not raw:
-        if 'queue' in run:
-            position = await mongo_db.get_queue_position(run)
-            run['queue'] = {
-                'name': run['queue'],
-                'position': position
-            }
-
-        run['status'] = sorted(run.pop('history'), key=lambda e: e['ts'])[-1]
-        run['complete'] = (run['status']['status']
-            in (RunStatuses.Completed, RunStatuses.Failed))
-
-        if 'percent' not in run:
-            if (run['status']['status'] in
-                    (RunStatuses.Enqueued, RunStatuses.Dequeued)):
-                run['percent'] = 0
-            elif (run['status']['status'] in
-                    (RunStatuses.Completed, RunStatuses.Failed)):
-                run['percent'] = 100
-            elif run['status']['status'] == RunStatuses.ProcessingOutput:
-                run['percent'] = 99  # HACK
-            else:  # RunStatuses.Running
-                _estimate_percent_for_running(run)
-
-        for k in RUN_STATUS_VERBOSE_FIELDS:
-            run.pop(k, None)
+        # look up queue positions of all runs at once
+        positions = await mongo_db.get_queue_positions(runs)
+        for run in runs:
+            _process_run_fields(run, positions)
+    return runs
+
+
+def _process_run_fields(run, queue_positions):
+    if 'queue' in run:
+        run['queue'] = {
+            'name': run['queue'],
+            'position': queue_positions.get(run['run_id'])
+        }
+
+    run['status'] = _latest_status(run.pop('history'))
+    run['complete'] = run['status']['status'] in TERMINAL_STATUSES
+
+    if 'percent' not in run:
+        if (run['status']['status'] in
+                (RunStatuses.Enqueued, RunStatuses.Dequeued)):
+            run['percent'] = 0
+        elif run['status']['status'] in TERMINAL_STATUSES:
+            run['percent'] = 100
+        elif run['status']['status'] == RunStatuses.ProcessingOutput:
+            run['percent'] = 99  # HACK
+        else:  # RunStatuses.Running
+            _estimate_percent_for_running(run)
+
+    for k in RUN_STATUS_VERBOSE_FIELDS:
+        run.pop(k, None)
 
     return run
 
 
+def _latest_status(history):
+    # history is stored sorted by ts, most recent first, but runs
+    # recorded before that was the case may have entries out of order
+    return max(history or [{}], key=lambda e: e.get('ts') or '')
+
+
 def _estimate_percent_for_running(run):
     try:
         i = datetime.datetime.strptime(run['initiated_at'], "%Y-%m-%dT%H:%M:%SZ")
@@ -143,6 +201,15 @@ def _estimate_percent_for_running(run):
         run['percent'] = 50  # HACK
 
 
+def _get_match_arg(request: Request):
+    match = request.query_params.get('match') or MatchModes.default
+    if match not in MatchModes.modes:
+        raise HTTPException(status_code=400,
+            detail=f"Invalid value '{match}' for query arg match. Use one of "
+            + ', '.join(MatchModes.modes))
+    return match
+
+
 ###
 ### Run status routes
 ###
@@ -152,7 +219,10 @@ def _estimate_percent_for_running(run):
 async def run_stats_monthly(api_version: str, request: Request):
     settings = request.app.state.settings
     run_id = request.query_params.get('run_id')
-    monthly = await settings['mongo_db'].run_counts_by_month(run_id=run_id)
+    monthly = await settings['mongo_db'].run_counts_by_month(run_id=run_id,
+        match=_get_match_arg(request),
+        start=_get_date_param(request, 'start'),
+        end=_get_date_param(request, 'end'))
     verbose = get_boolean_arg(request, 'verbose')
     return make_json_response({'monthly': monthly}, verbose=verbose)
 
@@ -162,7 +232,10 @@ async def run_stats_monthly(api_version: str, request: Request):
 async def run_stats_daily(api_version: str, request: Request):
     settings = request.app.state.settings
     run_id = request.query_params.get('run_id')
-    daily = await settings['mongo_db'].run_counts_by_day(run_id=run_id)
+    daily = await settings['mongo_db'].run_counts_by_day(run_id=run_id,
+        match=_get_match_arg(request),
+        start=_get_date_param(request, 'start'),
+        end=_get_date_param(request, 'end'))
     verbose = get_boolean_arg(request, 'verbose')
     return make_json_response({'daily': daily}, verbose=verbose)
 
@@ -170,26 +243,7 @@ async def run_stats_daily(api_version: str, request: Request):
 @router.get("/api/v{api_version}/runs")
 @router.get("/api/v{api_version}/runs/")
 async def runs_info(api_version: str, request: Request):
-    settings = request.app.state.settings
-    limit = min(int(request.query_params.get('limit', 10)), 25)
-    offset = int(request.query_params.get('offset', 0))
-    run_id = request.query_params.get('run_id')
-    queue = request.query_params.get('queue')
-    raw = get_boolean_arg(request, 'raw')
-    verbose = get_boolean_arg(request, 'verbose')
-
-    runs, total_count = await settings['mongo_db'].find_runs(
-        status=None, limit=limit, offset=offset, run_id=run_id, queue=queue)
-    for run in runs:
-        await _process_run(run, settings['mongo_db'], raw=raw)
-
-    return make_json_response({
-        "runs": runs,
-        "count": len(runs),
-        "limit": limit,
-        "offset": offset,
-        "total": total_count
-    }, verbose=verbose)
+    return await _list_runs(api_version, None, request)
 
 
 @router.get("/api/v{api_version}/runs/{run_id}/output")
@@ -197,6 +251,15 @@ async def runs_info(api_version: str, request: Request):
 @router.get("/api/v{api_version}/run/{run_id}/output")
 @router.get("/api/v{api_version}/run/{run_id}/output/")
 async def run_output(api_version: str, run_id: str, request: Request):
+    """Returns the run's output.
+
+    Responses are tagged with the version of the output, so that
+    clients can revalidate with If-None-Match, and encoded responses
+    are cached until the output changes.
+    """
+    # Import here, since output loads blueskyworker.tasks
+    from blueskyweb.lib.runs.output import BlueSkyRunOutput
+
     settings = request.app.state.settings
     collector = DataCollector()
 
@@ -205,11 +268,37 @@ async def run_output(api_version: str, run_id: str, request: Request):
             logger.error('Exception: %s', exception)
         raise HTTPException(status_code=status, detail=msg)
 
-    await BlueSkyRunOutput(api_version, settings['mongo_db'],
-        handle_error, collector).process(run_id)
+    output = BlueSkyRunOutput(api_version, settings['mongo_db'],
+        handle_error, collector,
+        output_root_dir=settings.get('output_root_dir'),
+        local_output_root_dir=settings.get('local_output_root_dir'))
+    version = await output.find(run_id)
+    verbose = bool(get_boolean_arg(request, 'verbose'))
+
+    if not version:
+        await output.write()
+        # outputs, e.g. plumerise fires, can be very large
+        return make_json_response(collector.data, verbose=verbose, stream=True)
+
+    etag = make_etag(run_id, api_version, verbose, version.tag)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': version.last_modified,
+        'Cache-Control': 'no-cache'
+    }
+    if is_not_modified(request, etag):
+        return not_modified_response(headers)
+
+    cache = settings['output_cache']
+    body = cache.get(etag)
+    if body is None:
+        await output.write()
+        body = dump_json(strip_verbose_fields(collector.data, verbose))
+        if len(body) <= int(settings['output_cache_max_item_size']):
+            cache.set(etag, body)
 
-    verbose = get_boolean_arg(request, 'verbose')
-    return make_json_response(collector.data, verbose=verbose)
+    return Response(content=body, media_type="application/json",
+        headers=headers)
 
 
 @router.get("/api/v{api_version}/run/{run_id}/status")
@@ -224,40 +313,136 @@ async def run_status_compat(api_version: str, run_id: str, request: Request):
 async def runs_by_identifier(api_version: str, identifier: str, request: Request):
     """Handles both /runs/{status} (list by status) and /runs/{run_id} (single run)."""
     if identifier in RunStatuses.statuses:
-        return await _list_runs_by_status(api_version, identifier, request)
+        return await _list_runs(api_version, identifier, request)
     else:
         return await _get_run_status(api_version, identifier, request)
 
 
-async def _list_runs_by_status(api_version: str, status: str, request: Request):
+async def _list_runs(api_version: str, status: str, request: Request):
+    """Lists runs, optionally filtered by status.
+
+    Pages can be requested either by offset or with the opaque cursors
+    returned in each response, which seek directly to the adjacent page
+    rather than skipping over all preceding runs. The total is counted
+    by default only for offset based requests; set 'count' to
+    override.
+    """
     settings = request.app.state.settings
     limit = min(int(request.query_params.get('limit', 10)), 25)
     offset = int(request.query_params.get('offset', 0))
     run_id = request.query_params.get('run_id')
     queue = request.query_params.get('queue')
+    match = _get_match_arg(request)
     raw = get_boolean_arg(request, 'raw')
     verbose = get_boolean_arg(request, 'verbose')
 
+    cursor = request.query_params.get('cursor')
+    if cursor:
+        try:
+            cursor = decode_runs_cursor(cursor)
+        except InvalidCursorError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        offset = None
+    count = get_boolean_arg(request, 'count')
+    if count is None:
+        count = not cursor
+
     runs, total_count = await settings['mongo_db'].find_runs(
-        status=status, limit=limit, offset=offset, run_id=run_id, queue=queue)
-    for run in runs:
-        await _process_run(run, settings['mongo_db'], raw=raw)
+        status=status, limit=limit, offset=offset, run_id=run_id,
+        queue=queue, cursor=cursor, count=count, match=match,
+        projection=_run_projection(raw, verbose, listing=True))
+
+    backward = bool(cursor) and cursor['direction'] == 'prev'
+    more_after = backward or len(runs) == limit
+    more_before = (len(runs) == limit) if backward else bool(cursor or offset)
+    next_cursor = (encode_runs_cursor(runs[-1], 'next')
+        if runs and more_after else None)
+    prev_cursor = (encode_runs_cursor(runs[0], 'prev')
+        if runs and more_before else None)
+
+    await _process_runs(runs, settings['mongo_db'], raw=raw)
 
     return make_json_response({
         "runs": runs,
         "count": len(runs),
         "limit": limit,
         "offset": offset,
-        "total": total_count
+        "total": total_count,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor
     }, verbose=verbose)
 
 
 async def _get_run_status(api_version: str, run_id: str, request: Request):
+    """Returns the run's status.
+
+    Completed and failed runs don't change, but their ids can be reused
+    by new runs (see BlueSkyRunExecutor._check_for_existing_run_id).
+    Their responses are therefore cached, in process and briefly by
+    clients, by run id and initiation time, and can be revalidated with
+    If-None-Match. Only if a run's response is cached is its initiation
+    time looked up first, to check that the cached response is for the
+    current run. Responses for other runs are cacheable only until the
+    next suggested poll.
+    """
     settings = request.app.state.settings
-    run = await settings['mongo_db'].find_run(run_id)
+    raw = bool(get_boolean_arg(request, 'raw'))
+    verbose = bool(get_boolean_arg(request, 'verbose'))
+
+    cache = settings['run_status_cache']
+    if cache.get((run_id,), TTLCache.MISSING) is not TTLCache.MISSING:
+        current = await settings['mongo_db'].find_run(run_id,
+            projection={'_id': 0, 'initiated_at': 1})
+        if not current:
+            raise HTTPException(status_code=404, detail="Run doesn't exist")
+        cached = cache.get((run_id, current.get('initiated_at'), raw, verbose))
+        if cached:
+            return _terminal_run_status_response(request, settings, *cached)
+
+    run = await settings['mongo_db'].find_run(run_id,
+        projection=_run_projection(raw, verbose))
     if not run:
         raise HTTPException(status_code=404, detail="Run doesn't exist")
-    raw = get_boolean_arg(request, 'raw')
+    initiated_at = run.get('initiated_at')
     await _process_run(run, settings['mongo_db'], raw=raw)
-    verbose = get_boolean_arg(request, 'verbose')
-    return make_json_response(run, verbose=verbose)
+
+    status = run['status'] if not raw else _latest_status(run.get('history'))
+    if status.get('status') in TERMINAL_STATUSES:
+        entry = (make_etag(run_id, initiated_at, raw, verbose,
+                status.get('ts')),
+            _http_date(status.get('ts')),
+            dump_json(strip_verbose_fields(run, verbose)))
+        # the run's initiation time is cached to know to check it
+        cache.set((run_id,), initiated_at)
+        cache.set((run_id, initiated_at, raw, verbose), entry)
+        return _terminal_run_status_response(request, settings, *entry)
+
+    poll_interval = int(settings['run_status_poll_interval'])
+    return make_json_response(run, verbose=verbose, headers={
+        'Cache-Control': 'max-age={}'.format(poll_interval),
+        'Retry-After': str(poll_interval)
+    })
+
+
+def _terminal_run_status_response(request, settings, etag, last_modified,
+        body):
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'max-age={}'.format(
+            int(settings['terminal_run_status_max_age']))
+    }
+    if last_modified:
+        headers['Last-Modified'] = last_modified
+    if is_not_modified(request, etag):
+        return not_modified_response(headers)
+    return Response(content=body, media_type="application/json",
+        headers=headers)
+
+
+def _http_date(ts):
+    try:
+        d = datetime.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S.%fZ')
+    except (TypeError, ValueError):
+        return None
+    return email.utils.formatdate(
+        d.replace(tzinfo=datetime.timezone.utc).timestamp(), usegmt=True)
@@ -3,6 +3,10 @@
 __author__ = "Joel Dubowy"
 __copyright__ = "Copyright 2015, AirFire, PNW, USFS"
 
+import asyncio
+import contextlib
+import importlib
+import json
 import logging
 import logging.handlers
 import os
@@ -10,7 +14,14 @@ import os
 import uvicorn
 from fastapi import FastAPI
 
-from blueskymongo.client import BlueSkyWebDB
+from blueskyconfig import ConfigManagerSingleton
+from blueskymongo.client import (
+    BlueSkyWebDB, close_mongo_clients, DEFAULT_EVENTS_RETENTION_DAYS
+)
+from blueskyweb.lib.cache import TTLCache
+from blueskyweb.lib.met.db import MetArchiveDB
+from blueskyweb.lib.runs.pool import InProcessRunPool
+from blueskyweb.lib.runs.publish import RunPublisher
 
 DEFAULT_LOG_FORMAT = "%(asctime)s %(name)s %(levelname)s %(filename)s#%(funcName)s: %(message)s"
 
@@ -41,24 +52,117 @@ DEFAULT_SETTINGS = {
     'output_url_scheme': 'https',
     'output_url_port': None,  # 80
     'output_url_path_prefix': 'bluesky-web-output',
+    # Where the workers' output root dir is mounted on this host, if
+    # it's on shared storage mounted at a different location
+    'local_output_root_dir': None,
     # this is supposed to be a string, since it's passed into
     # the bsp docker command
-    'bluesky_log_level': "INFO"
+    'bluesky_log_level': "INFO",
+    # run status updates are buffered and written to mongodb in batches
+    'run_record_flush_interval': 1.0,
+    'run_record_queue_size': 1000,
+    # 'full' keeps every status update in the run document; 'compact'
+    # keeps the latest status plus milestones, and records all
+    # updates in the 'run_events' collection
+    'run_history_mode': 'full',
+    'run_history_max_milestones': 20,
+    'run_events_retention_days': DEFAULT_EVENTS_RETENTION_DAYS,
+    # seconds to cache run listing totals
+    'runs_count_cache_ttl': 30,
+    # connection pool options for the mongodb client shared by the
+    # runs and met archive dbs; None uses the driver's default
+    'mongodb_max_pool_size': 100,
+    'mongodb_min_pool_size': 0,
+    'mongodb_max_idle_time_ms': None,
+    'mongodb_connect_timeout_ms': 20000,
+    'mongodb_server_selection_timeout_ms': 30000,
+    'mongodb_wait_queue_timeout_ms': None,
+    # met archive index lookups are cached; TTLs are in seconds
+    'met_root_dir_cache_ttl': 3600,
+    'met_availability_cache_ttl': 300,
+    'met_check_availability_cache_ttl': 300,
+    'met_cache_size': 256,
+    # seconds between checks for cache invalidations made by
+    # bsp-web-manage-archivedb
+    'met_cache_invalidation_check_interval': 10,
+    # runs are published to rabbitmq from a pool of threads; requests
+    # wait up to enqueue_timeout seconds for the broker to confirm
+    'enqueue_outbox_size': 100,
+    'enqueue_timeout': 10,
+    'enqueue_threads': 2,
+    # fuelbeds and emissions runs execute in the web process; runs
+    # beyond the limit wait up to in_process_queue_timeout seconds for
+    # one to finish, and are otherwise rejected with a 503
+    'in_process_max_runs': 4,
+    'in_process_max_waiting': 16,
+    'in_process_queue_timeout': 10,
+    'in_process_retry_after': 30,
+    # on shutdown, executing in-process runs are given up to
+    # in_process_shutdown_timeout seconds to finish
+    'in_process_shutdown_timeout': 60,
+    # encoded run output responses are cached, until the output
+    # changes or for output_cache_ttl seconds; responses larger than
+    # output_cache_max_item_size bytes aren't cached
+    'output_cache_size': 64,
+    'output_cache_ttl': 3600,
+    'output_cache_max_item_size': 5 * 1024 * 1024,
+    # status responses of completed and failed runs are cached in
+    # process, and clients are told they may cache them for
+    # terminal_run_status_max_age seconds before revalidating, which
+    # is kept short since run ids can be reused; clients polling other
+    # runs are asked to wait run_status_poll_interval seconds
+    'run_status_cache_size': 1024,
+    'run_status_cache_ttl': 3600,
+    'terminal_run_status_max_age': 60,
+    'run_status_poll_interval': 5,
+    # number of processes serving the API
+    'web_workers': 1
 }
 
 
 def create_app(settings: dict) -> FastAPI:
     """Create and configure the FastAPI application."""
     # We need to import routers after MONGODB_URL and RABBITMQ_URL env vars
-    # are set, because blueskyworker.tasks (imported transitively) reads them
-    # at module level.
+    # are set, in case blueskyworker.tasks is imported transitively, since
+    # it reads them at module level. Routers import bluesky, geoutils and
+    # blueskyworker.tasks on first use rather than here, since they're
+    # slow to import.
     from .api.ping import router as ping_router
     from .api.config import router as config_router
     from .api.met import router as met_router
     from .api.run import router as run_router
     from .api.queue import router as queue_router
 
-    app = FastAPI()
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        # db clients, thread pools, etc. are created in each process
+        # serving the app
+        _create_process_resources(settings)
+        # the run record writer needs to run on this loop, even though
+        # runs are also recorded from publisher threads
+        settings['mongo_db'].start_writer()
+        # indexes are created in the background, so that startup isn't
+        # held up building them, or waiting on mongodb if it's down
+        index_task = asyncio.create_task(
+            _ensure_indexes(settings['mongo_db']))
+        # modules deferred to keep startup fast are imported in the
+        # background, so that the first run request doesn't block the
+        # event loop importing them. The task is referenced until
+        # shutdown, but isn't awaited, since imports can't be interrupted
+        warm_up_task = asyncio.create_task(asyncio.to_thread(_warm_up_imports))
+        yield
+        index_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await index_task
+        # let in-flight publishes and in-process runs finish, so that
+        # their runs get recorded before the run record writer is closed
+        await asyncio.to_thread(settings['run_publisher'].shutdown)
+        await settings['run_pool'].shutdown(wait=True,
+            timeout=float(settings['in_process_shutdown_timeout']))
+        await settings['mongo_db'].close()
+        close_mongo_clients()
+
+    app = FastAPI(lifespan=lifespan)
 
     path_prefix = settings.get('path_prefix', '')
 
@@ -69,6 +173,68 @@ def create_app(settings: dict) -> FastAPI:
     return app
 
 
+# Modules imported on first use, since they load bluesky, geoutils and
+# blueskyworker.tasks, which are slow to import
+DEFERRED_MODULES = ('blueskyweb.lib.runs.execute',)
+
+def _warm_up_imports():
+    for m in DEFERRED_MODULES:
+        try:
+            importlib.import_module(m)
+        except Exception as e:
+            logging.error("Failed to import %s: %s", m, e)
+
+
+async def _ensure_indexes(mongo_db):
+    try:
+        await mongo_db.ensure_indexes()
+    except Exception as e:
+        logging.error("Failed to create indexes: %s", e)
+
+
+def _create_process_resources(settings):
+    settings['mongo_db'] = BlueSkyWebDB.from_settings(
+        settings['mongodb_url'], settings)
+    settings['met_db'] = MetArchiveDB.from_settings(settings['mongodb_url'],
+        settings, client=settings['mongo_db'].client)
+    settings['run_publisher'] = RunPublisher(
+        max_pending=int(settings['enqueue_outbox_size']),
+        timeout=float(settings['enqueue_timeout']),
+        num_threads=int(settings['enqueue_threads']))
+    settings['run_pool'] = InProcessRunPool(
+        max_running=int(settings['in_process_max_runs']),
+        max_waiting=int(settings['in_process_max_waiting']),
+        queue_timeout=float(settings['in_process_queue_timeout']),
+        retry_after=int(settings['in_process_retry_after']))
+    settings['output_cache'] = TTLCache(
+        maxsize=int(settings['output_cache_size']),
+        ttl=float(settings['output_cache_ttl']))
+    settings['run_status_cache'] = TTLCache(
+        maxsize=int(settings['run_status_cache_size']),
+        ttl=float(settings['run_status_cache_ttl']))
+
+
+def _add_config_overrides(settings):
+    for o in settings.get('config_overrides_files') or []:
+        ConfigManagerSingleton().add_overrides_file(o)
+
+    ConfigManagerSingleton().add_overrides(settings.get('config_file_options'))
+    ConfigManagerSingleton().add_overrides(settings.get('config_options'))
+
+
+# Used to pass settings to worker processes when running multiple
+# workers, since uvicorn starts them with an app factory
+SETTINGS_ENV_VAR = 'BLUESKYWEB_SETTINGS'
+
+
+def create_worker_app() -> FastAPI:
+    """App factory called by uvicorn in each worker process"""
+    settings = json.loads(os.environ[SETTINGS_ENV_VAR])
+    configure_logging(**settings)
+    _add_config_overrides(settings)
+    return create_app(settings)
+
+
 def main(**settings):
     """Main method for starting bluesky FastAPI web service."""
     logger = logging.getLogger(__name__)
@@ -85,10 +251,16 @@ def main(**settings):
         settings['path_prefix'] = '/' + settings['path_prefix'].lstrip('/')
 
     os.environ["MONGODB_URL"] = settings['mongodb_url']
-    settings['mongo_db'] = BlueSkyWebDB(settings['mongodb_url'])
-
     os.environ["RABBITMQ_URL"] = settings['rabbitmq_url']
 
-    app = create_app(settings)
+    workers = int(settings['web_workers'])
+    if workers > 1:
+        # Each worker process creates its own app, db clients and config
+        os.environ[SETTINGS_ENV_VAR] = json.dumps(settings)
+        uvicorn.run("blueskyweb.app:create_worker_app", factory=True,
+            workers=workers, host="0.0.0.0", port=int(settings['port']))
 
-    uvicorn.run(app, host="0.0.0.0", port=int(settings['port']))
+    else:
+        _add_config_overrides(settings)
+        app = create_app(settings)
+        uvicorn.run(app, host="0.0.0.0", port=int(settings['port']))
@@ -0,0 +1,80 @@
+"""blueskyweb.lib.cache"""
+
+__author__      = "Joel Dubowy"
+__copyright__   = "Copyright 2015, AirFire, PNW, USFS"
+
+import collections
+import threading
+import time
+
+__all__ = [
+    "TTLCache"
+]
+
+
+class TTLCache(object):
+    """Size bounded cache whose entries expire `ttl` seconds after being
+    set. When full, the least recently used entry is evicted.
+
+    Cached values are returned as is, and so should not be modified by
+    callers. A ttl of 0 disables caching.
+    """
+
+    MISSING = object()
+
+    def __init__(self, maxsize=128, ttl=60, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._entries),
+                maxsize=self.maxsize, ttl=self.ttl)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > self._timer():
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry[1]
+                del self._entries[key]
+                self._stats['expirations'] += 1
+            self._stats['misses'] += 1
+            return default
+
+    def set(self, key, value):
+        if not self.ttl or not self.maxsize:
+            return
+        with self._lock:
+            self._entries[key] = (self._timer() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, match=None):
+        """Removes all entries, or those whose keys satisfy `match`,
+        and returns the number removed.
+        """
+        with self._lock:
+            keys = [k for k in self._entries if match is None or match(k)]
+            for k in keys:
+                del self._entries[k]
+            self._stats['invalidations'] += len(keys)
+            return len(keys)
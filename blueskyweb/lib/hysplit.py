@@ -143,10 +143,9 @@ class HysplitConfigurator(object):
 
     def _fill_in_defaults(self):
         # fill config with defaults
-        hysplit_defaults = blueskyconfig.get('hysplit')
-        hysplit_defaults.update(
-            blueskyconfig.get('hysplit_met_specific').get(
-                self._archive_info['domain_id'], {}))
+        hysplit_defaults = blueskyconfig.get_mutable('hysplit')
+        hysplit_defaults.update(blueskyconfig.get_mutable(
+            'hysplit_met_specific', self._archive_info['domain_id']) or {})
         for k in hysplit_defaults:
             # use MPI and NCPUS defaults even if request specifies them
             if k in ('MPI', 'NCPUS') or k not in self._hysplit_config:
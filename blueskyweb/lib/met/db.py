@@ -13,11 +13,11 @@ import datetime
 import logging
 import math
 import os
-import ssl
-from urllib.parse import urlparse
+import time
 
-from motor.motor_asyncio import AsyncIOMotorClient
 import blueskyconfig
+from blueskymongo.client import get_db_name, get_mongo_client
+from blueskyweb.lib.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
@@ -45,21 +45,19 @@ ONE_DAY = datetime.timedelta(days=1)
 ##
 
 def get_archive_info(archive_id):
+    """Returns read-only archive info merged with its domain's info"""
     if archive_id:
-        for v in blueskyconfig.get('archives').values():
-            if archive_id in v:
-                archive_info = v[archive_id]
-                return dict(archive_info, id=archive_id,
-                    **(blueskyconfig.get('domains')[archive_info['domain_id']]))
-        raise InvalidArchiveError(archive_id)
+        archive_info = blueskyconfig.get_archive_info(archive_id)
+        if archive_info is None:
+            raise InvalidArchiveError(archive_id)
+        return archive_info
 
 
 def validate_archive_id(archive_id):
     if archive_id:
-        for v in blueskyconfig.get('archives').values():
-            if archive_id in v:
-                return archive_id
-        raise InvalidArchiveError(archive_id)
+        if blueskyconfig.get_archive_info(archive_id) is None:
+            raise InvalidArchiveError(archive_id)
+        return archive_id
 
 
 def apply_min_max(min_max_func, a, b):
@@ -78,23 +76,111 @@ def apply_min_max(min_max_func, a, b):
 class MetArchiveDB(object):
     """Wraps interaction with met archive index mongodb
 
-    TODO: memoize / cache the three main methods
+    Root dirs and availability are cached, with per method TTLs, since
+    the index is only updated a few times a day. Caches are cleared in
+    all processes when the invalidation generation, stored in the
+    'met_cache' collection, is incremented - e.g. by
+    `bsp-web-manage-archivedb -a invalidate-cache`
     """
 
-    def __init__(self, mongodb_url):
-        db_name = (urlparse(mongodb_url).path.lstrip('/').split('/')[0]
-            or 'blueskyweb')
+    # Default TTLs, in seconds
+    CACHE_TTLS = {
+        'root_dir': 3600,
+        'availability': 300,
+        'check_availability': 300
+    }
+
+    def __init__(self, mongodb_url, client=None, cache_ttls=None,
+            cache_size=256, invalidation_check_interval=10):
         logger.debug('Using %s for domain data', mongodb_url)
-        client_args = {
-            'tls': True,
-            #'tlsAllowInvalidHostnames': True, # Note: makes vulnerable to man-in-the-middle attacks
-            'tlsAllowInvalidCertificates': True,
-            # 'tlsCertificateKeyFile': '/etc/ssl/bluesky-web-client-cert.pem',
-            'tlsCAFile': '/etc/ssl/bluesky-web-client.pem'
-        }
-        self.db = AsyncIOMotorClient(mongodb_url, **client_args)[db_name]
+        self.client = client or get_mongo_client(mongodb_url)
+        self.db = self.client[get_db_name(mongodb_url)]
+        ttls = dict(self.CACHE_TTLS, **(cache_ttls or {}))
+        self._caches = {m: TTLCache(maxsize=cache_size, ttl=ttl)
+            for m, ttl in ttls.items()}
+        self.invalidation_check_interval = invalidation_check_interval
+        self._next_invalidation_check = 0
+        self._generation = None
+
+    # Maps web settings to constructor kwargs
+    SETTINGS_KWARGS = {
+        'met_cache_size': ('cache_size', int),
+        'met_cache_invalidation_check_interval': (
+            'invalidation_check_interval', float),
+    }
+    CACHE_TTL_SETTINGS = {
+        'met_root_dir_cache_ttl': 'root_dir',
+        'met_availability_cache_ttl': 'availability',
+        'met_check_availability_cache_ttl': 'check_availability',
+    }
+
+    @classmethod
+    def from_settings(cls, mongodb_url, settings, client=None):
+        kwargs = {k: t(settings[s]) for s, (k, t) in cls.SETTINGS_KWARGS.items()
+            if settings.get(s) is not None}
+        cache_ttls = {m: float(settings[s])
+            for s, m in cls.CACHE_TTL_SETTINGS.items()
+            if settings.get(s) is not None}
+        return cls(mongodb_url, client=client, cache_ttls=cache_ttls, **kwargs)
+
+    ## Caching
+
+    @property
+    def cache_stats(self):
+        return {m: c.stats for m, c in self._caches.items()}
+
+    async def _cached(self, method, key, func, *args):
+        await self._check_invalidation()
+        cache = self._caches[method]
+        val = cache.get(key, TTLCache.MISSING)
+        if val is TTLCache.MISSING:
+            val = await func(*args)
+            cache.set(key, val)
+        return val
+
+    def invalidate_cache(self, archive_id=None):
+        """Clears cached lookups in this process, for all archives or
+        for just `archive_id`
+        """
+        def match(key):
+            # availability for all archives is cached with key None
+            key_archive_id = key[0] if isinstance(key, tuple) else key
+            return key_archive_id in (archive_id, None)
+
+        return sum(c.invalidate(match if archive_id else None)
+            for c in self._caches.values())
+
+    async def _check_invalidation(self):
+        if (not self.invalidation_check_interval
+                or time.monotonic() < self._next_invalidation_check):
+            return
+        self._next_invalidation_check = (time.monotonic()
+            + self.invalidation_check_interval)
+        try:
+            d = await self.db.met_cache.find_one({'_id': 'invalidation'})
+        except Exception as e:
+            logger.warning('Failed to check met cache invalidation: %s', e)
+            return
+        generation = d['generation'] if d else 0
+        if self._generation is not None and generation != self._generation:
+            logger.info('Met cache invalidated (generation %s)', generation)
+            self.invalidate_cache()
+        self._generation = generation
+
+    async def invalidate_all_caches(self):
+        """Clears cached lookups in this and all other processes"""
+        await self.db.met_cache.update_one({'_id': 'invalidation'},
+            {'$inc': {'generation': 1},
+             '$set': {'ts': datetime.datetime.utcnow()}}, upsert=True)
+        return self.invalidate_cache()
+
+    ## Lookups
 
     async def get_root_dir(self, archive_id):
+        return await self._cached('root_dir', archive_id,
+            self._get_root_dir, archive_id)
+
+    async def _get_root_dir(self, archive_id):
         # Use met_files collection object directly so that we can
         # specify reading only the root_dir field
         d = await self.db.met_files.find_one({'domain': archive_id}, {'root_dir': 1})
@@ -158,8 +244,46 @@ class MetArchiveDB(object):
 
     async def get_availability(self, archive_id=None):
         validate_archive_id(archive_id)
+        return await self._cached('availability', archive_id,
+            self._get_availability, archive_id)
+
+    async def get_availability_by_archive(self, archive_ids):
+        """Returns the availability of each of the given archives,
+        keyed by archive id. Archives not already cached are looked
+        up with one query.
+        """
+        for archive_id in archive_ids:
+            validate_archive_id(archive_id)
+
+        await self._check_invalidation()
+        cache = self._caches['availability']
+        r = {}
+        for archive_id in archive_ids:
+            val = cache.get(archive_id, TTLCache.MISSING)
+            if val is not TTLCache.MISSING:
+                r[archive_id] = val
+
+        missing = [a for a in archive_ids if a not in r]
+        if missing:
+            found = await self._find_availability(
+                {"domain": {"$in": missing}})
+            for archive_id in missing:
+                r[archive_id] = (found.get(archive_id)
+                    or dict(begin=None, end=None))
+                cache.set(archive_id, r[archive_id])
+
+        return r
 
+    async def _get_availability(self, archive_id):
         query = { "domain": archive_id } if archive_id else {}
+        r = await self._find_availability(query)
+
+        # TODO: modify r?
+        if archive_id:
+            return r.get(archive_id) or dict(begin=None, end=None)
+        return r
+
+    async def _find_availability(self, query):
         select_set = {
             'domain': 1, 'availability': 1, 'start': 1, 'end': 1, 'latest_forecast': 1
         }
@@ -187,16 +311,17 @@ class MetArchiveDB(object):
                     latest_forecast=e['latest_forecast'],
                     availability=e.get('availability', []))
 
-        # TODO: modify r?
-        if archive_id:
-            return r.get(archive_id) or dict(begin=None, end=None)
         return r
 
     async def check_availability(self, archive_id, target_date, date_range):
         if not archive_id:
             raise ArchiveNotDefinedError()
         validate_archive_id(archive_id)
+        key = (archive_id, target_date.strftime('%Y-%m-%d'), date_range)
+        return await self._cached('check_availability', key,
+            self._check_availability, archive_id, target_date, date_range)
 
+    async def _check_availability(self, archive_id, target_date, date_range):
         date_range *= ONE_DAY
         begin_date_str = (target_date - date_range).strftime('%Y-%m-%d')
         target_date_str = target_date.strftime('%Y-%m-%d')
@@ -262,6 +387,8 @@ class MetArchiveDB(object):
                     self.db.dates.remove(q)
                     self.db.met_files.remove(q)
 
+        if prune and obsolete:
+            await self.invalidate_all_caches()
         return obsolete
 
     async def clear_index(self):
@@ -270,3 +397,4 @@ class MetArchiveDB(object):
         """
         self.db.dates.delete_many({})
         self.db.met_files.delete_many({})
+        await self.invalidate_all_caches()
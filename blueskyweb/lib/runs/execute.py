@@ -23,6 +23,8 @@ import blueskyconfig
 from blueskymongo.client import RunStatuses
 from blueskyweb.lib import met, hysplit
 from blueskyweb.lib.runs import output
+from blueskyweb.lib.runs.pool import RunPoolFullError
+from blueskyweb.lib.runs.publish import OutboxFullError, PublishTimeoutError
 from blueskyworker.tasks import (
     run_bluesky, BlueSkyRunner, apply_output_processor, OUTPUT_PROCESSORS
 )
@@ -43,6 +45,15 @@ PRE_PROCESSORS = {
     '1': pre_process_v1
 }
 
+# Settings holding objects local to the web process, which aren't
+# passed on to workers with each job
+LOCAL_SETTINGS = ('mongo_db', 'met_db', 'run_publisher', 'run_pool',
+    'output_cache', 'run_status_cache')
+
+# Seconds clients are asked to wait before retrying runs that couldn't
+# be enqueued
+RETRY_ENQUEUE_AFTER = 10
+
 class ExecuteMode(object):
     IN_PROCESS = 1
     ASYNC = 2
@@ -61,6 +72,9 @@ class BlueSkyRunExecutor(object):
         self.settings = settings
         self.hysplit_query_params = hysplit_query_params
         self.fuelbeds_query_params = fuelbeds_query_params
+        # set if an asynchronous run's job was accepted but not yet
+        # confirmed by the broker
+        self.enqueue_pending = False
 
     async def execute(self, data, execute_mode=None, scheduleFor=None):
         # TODO: should no configuration be allowed at all?  or only some? if
@@ -238,7 +252,8 @@ class BlueSkyRunExecutor(object):
         logger.debug("Modules be run: {}".format(', '.join(data['modules'])))
 
     async def _check_for_existing_run_id(self, run_id):
-        run = await self.settings['mongo_db'].find_run(run_id)
+        run = await self.settings['mongo_db'].find_run(run_id,
+            projection={'run_id': 1})
         if run:
             # TODO: eventually, when STI's code is updated to handle it,
             #   we want to do one of two things:
@@ -248,6 +263,8 @@ class BlueSkyRunExecutor(object):
             #       was changed.
             #   for now, just move existing record in the db
             await self.settings['mongo_db']._archive_run(run)
+            self.settings['run_status_cache'].invalidate(
+                lambda key: key[0] == run_id)
 
 
     async def _run_asynchronously(self, data, scheduleFor=None):
@@ -260,17 +277,43 @@ class BlueSkyRunExecutor(object):
         #logger.debug('input: %s', data)
         args = (data, self.api_version)
 
-        # TODO: figure out how to enqueue without blocking
-        settings = {k:v for k, v in self.settings.items() if k != 'mongo_db'}
+        settings = {k:v for k, v in self.settings.items()
+            if k not in LOCAL_SETTINGS}
         logger.debug("About to enqueue run %s",
             data.get('run_id'))
 
-        run_bluesky.apply_async(args=args, kwargs=settings, queue=queue_name,
-            eta=scheduleFor)
-        self.settings['mongo_db'].record_run(data['run_id'],
-            RunStatuses.Enqueued, queue=queue_name, modules=data["modules"],
+        # The run is recorded as enqueued before it's published, so that
+        # it's on record before the worker records any of its statuses,
+        # and even if the broker doesn't confirm the job in time
+        run_id = data['run_id']
+        mongo_db = self.settings['mongo_db']
+        mongo_db.record_run(run_id, RunStatuses.Enqueued, queue=queue_name,
+            modules=data["modules"],
             initiated_at=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
-        self.output_stream.write({"run_id": data['run_id']})
+
+        def record_failed(e):
+            mongo_db.record_run(run_id, RunStatuses.Failed,
+                status_message="Failed to enqueue run: {}".format(e))
+
+        try:
+            await self.settings['run_publisher'].publish(run_bluesky,
+                args=args, kwargs=settings, on_failed=record_failed,
+                queue=queue_name, eta=scheduleFor)
+        except OutboxFullError as e:
+            record_failed(e)
+            self.handle_error(503, "Too many runs being enqueued - "
+                "try again later", exception=e,
+                headers={'Retry-After': str(RETRY_ENQUEUE_AFTER)})
+        except PublishTimeoutError as e:
+            # The job is still published, or the run recorded as failed,
+            # once the broker responds. Retrying would start a duplicate
+            # run, so the client is told to follow the run's status
+            logger.warning("Run %s not yet enqueued: %s", run_id, e)
+            self.enqueue_pending = True
+            self.output_stream.write({"run_id": run_id, "status": "pending"})
+            return
+
+        self.output_stream.write({"run_id": run_id})
 
     async def _run_in_process(self, data, **kwargs):
         """Runs bluesky in the web process
@@ -279,39 +322,47 @@ class BlueSkyRunExecutor(object):
         the signature to make calls to _run_in_process compatible with
         calls to _run_asynchronously
         """
-        # We need the outer try block to handle any exception raised
-        # before the bluesky thread is started. If an exception is
-        # encountered in the seperate thread, it's handling
-        try:
-            run_id = data['run_id']
-            self.settings['mongo_db'].record_run(run_id,
+        run_id = data['run_id']
+        mongo_db = self.settings['mongo_db']
+
+        # The run is only recorded once it's allowed to start
+        def record_running():
+            mongo_db.record_run(run_id,
                 RunStatuses.Running, modules=data["modules"],
                 initiated_at=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
-            output_stream = apply_output_processor(self.api_version,
-                self.output_stream)
+
+        # The terminal status is recorded when the thread finishes, even
+        # if this request is cancelled before then
+        def record_done():
+            mongo_db.record_run(run_id, RunStatuses.Failed if t.exception
+                else RunStatuses.Completed)
+
+        try:
             # Runs bluesky in a separate thread so that run configurations
             # don't overwrite each other. (Bluesky manages configuration
             # with a singleton that stores config data in thread local)
             # BlueSkyRunner will call self.output_stream.write.
-            t = BlueSkyRunner(data, output_stream=output_stream)
-            t.start()
-            # block until it thread completes so that self.output_stream.write
-            # is called before the main thread exits and so that we can return
-            # 500 if necessary
-            t.join()
-            if t.exception:
-                self.settings['mongo_db'].record_run(run_id, RunStatuses.Failed)
-                self.handle_error(500, str(t.exception),
-                    exception=t.exception)
-            else:
-                self.settings['mongo_db'].record_run(run_id, RunStatuses.Completed)
-
-
+            t = BlueSkyRunner(data, output_stream=apply_output_processor(
+                self.api_version, self.output_stream))
+            # Wait for a slot in the in-process run pool, and then until the
+            # thread completes so that self.output_stream.write is called
+            # before responding and so that we can return 500 if necessary.
+            await self.settings['run_pool'].run(t, on_start=record_running,
+                on_done=record_done)
+        except RunPoolFullError as e:
+            self.handle_error(503, "Too many runs executing - try again later",
+                exception=e, headers={'Retry-After': str(e.retry_after)})
         except Exception as e:
-            self.settings['mongo_db'].record_run(run_id, RunStatuses.Failed)
+            # raised before the bluesky thread was started
+            mongo_db.record_run(run_id, RunStatuses.Failed)
             logger.debug(traceback.format_exc())
             self.handle_error(500, str(e), exception=e)
 
+        # If an exception was encountered in the seperate thread, it's
+        # handled here
+        if t.exception:
+            self.handle_error(500, str(t.exception), exception=t.exception)
+
 
 
     ##
@@ -419,7 +470,7 @@ class BlueSkyRunExecutor(object):
     async def _configure_findmetdata(self, data):
         logger.debug('Configuring findmetdata')
         data['config'] = data.get('config', {})
-        met_archives_db = met.db.MetArchiveDB(self.settings['mongodb_url'])
+        met_archives_db = self.settings['met_db']
         try:
             met_root_dir = await met_archives_db.get_root_dir(self.archive_id)
         except met.db.UnavailableArchiveError as e:
@@ -612,7 +663,8 @@ class BlueSkyRunExecutor(object):
                 or data['config']['visualization'].get("dispersion", {}).get("hysplit", {})
         )
         hy_con = data['config']['visualization']["hysplit"]
-        default_hy_con = blueskyconfig.get('visualization')["dispersion"]["hysplit"]
+        # copy, since parts of the defaults are added to the run's config
+        default_hy_con = blueskyconfig.get_mutable('visualization', 'dispersion', 'hysplit')
         hy_con["websky_version"] = default_hy_con["websky_version"]
         hy_con["images_dir"] = default_hy_con["images_dir"]
         hy_con["data_dir"] = default_hy_con["data_dir"]
@@ -3,82 +3,123 @@
 __author__      = "Joel Dubowy"
 __copyright__   = "Copyright 2015, AirFire, PNW, USFS"
 
+import asyncio
+import collections
+import datetime
+import email.utils
 import json
 import logging
 import os
+import threading
 
-import ipify2
 import requests
-import urllib.request
+import requests.adapters
 
 logger = logging.getLogger(__name__)
-from bluesky.marshal import Blueskyv4_0To4_1
-from bluesky.models import fires
 
 from blueskyworker.tasks import process_runtime, apply_output_processor
 
-try:
-    IP_ADDRESS = ipify2.get_ipv4()
-except:
-    # IP_ADDRESS is only used to see if worker is running on
-    # same machine as web server.  If ipify fails, we'll just
-    # resort to loading all output as if from remote server
-    IP_ADDRESS = None
-logger.info('IP_ADDRESS (in output.py): %s', IP_ADDRESS)
-
-
-# PORT_IN_HOSTNAME_MATCHER = re.compile(':\d+')
-# def is_same_host(web_request_host):
-#     """Checks to see if the output is local to the web service
-#
-#     If they are local, the run status and output APIS can carry out their
-#     checks more efficiently and quickly.
-#
-#     This function is a complete hack, but it works, at least some of the time.
-#     (And when it fails, it should only result in false negatives, which
-#     don't affect the correctness of the calling APIs - it just means they
-#     don't take advantage of working with local files.)
-#     """
-#     # first check if same hostname
-#     try:
-#         web_service_host = socket.gethostbyaddr(socket.gethostname())[0]
-#     except:
-#         web_service_host = PORT_IN_HOSTNAME_MATCHER.sub('', web_request_host)
-#
-#     output_hostname = "" # TODO: Get hostname from mongodb
-#     if output_hostname == web_service_host:
-#         return True
-#
-#     # TODO: determine ip address of upload host and web service host and
-#     #   check if ip addresses match
-#
-#     return False
-
-def is_same_host(run):
-    logger.info('server ip %s vs. IP_ADDRESS: %s',
-        run['server']['ip'], IP_ADDRESS)
-    return run['server']['ip'] == IP_ADDRESS
-
 ##
-## Utilities for working with remote output
+## Locating output
 ##
 
-class remote_open(object):
-    """Context manager that clones opens remote file and closes it on exit
+def get_local_output_dir(run, output_root_dir=None,
+        local_output_root_dir=None):
+    """Returns the path of the run's output directory on this host, or
+    None if it's not on this host or on storage shared with it.
+
+    Output written under the workers' `output_root_dir` is looked for
+    under `local_output_root_dir`, if specified, e.g. if the workers'
+    output is mounted at a different location. Otherwise, the run's
+    output directory is probed for directly. This avoids relying on
+    public ip addresses, which can't be determined without network
+    access, to decide if output was written on this host.
+
+    Output directories are named after run ids, which can be reused,
+    so a directory is only used if its output was written after the
+    run was initiated; otherwise, it's a previous run's output, and
+    this run's output is on another host.
     """
+    output_dir = run.get('output_dir')
+    if not output_dir:
+        return None
+
+    candidates = []
+    if output_root_dir and local_output_root_dir:
+        rel_path = os.path.relpath(output_dir, output_root_dir)
+        if not rel_path.startswith(os.pardir):
+            candidates.append(os.path.join(local_output_root_dir, rel_path))
+    candidates.append(output_dir)
+
+    initiated_at = _get_initiated_at(run)
+    for d in candidates:
+        if os.path.isdir(d):
+            if _written_since(d, initiated_at):
+                return d
+            logger.debug('Output in %s predates run %s', d, run.get('run_id'))
+    return None
+
+def _get_initiated_at(run):
+    try:
+        return datetime.datetime.strptime(run['initiated_at'],
+            '%Y-%m-%dT%H:%M:%SZ').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def _written_since(output_dir, ts):
+    if ts is None:
+        return True
+    # The directory itself is checked if output.json hasn't been written
+    for path in (os.path.join(output_dir, 'output.json'), output_dir):
+        try:
+            return os.stat(path).st_mtime >= ts
+        except OSError:
+            continue
+    return False
 
-    def __init__(self, url):
-        self.url = url
+##
+## Utilities for working with remote output
+##
 
-    def __enter__(self):
-        self.f = urllib.request.urlopen(self.url)
-        return self.f
+# Seconds to wait to connect to, and then to read from, output hosts
+REMOTE_TIMEOUT = (5, 60)
 
-    def __exit__(self, type, value, traceback):
-        self.f.close()
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Returns the process's shared session, which keeps connections to
+    output hosts alive for reuse
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=10,
+                pool_maxsize=20)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def _reset_after_fork():
+    # connections can't be shared with the parent process
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 def remote_exists(url):
-    return requests.head(url).status_code != 404
+    """Returns False if url isn't found. If the check fails, url is
+    assumed to exist.
+    """
+    try:
+        return get_session().head(url,
+            timeout=REMOTE_TIMEOUT).status_code != 404
+    except requests.RequestException as e:
+        logger.error('Failed to check %s: %s', url, e)
+        return True
 
 # def get_output_server_info(run_id):
 #     output_server_info = {} # TODO: Get info from mongodb
@@ -89,32 +130,122 @@ def remote_exists(url):
 
 
 
+# Identifies a version of a run's output; `tag` changes whenever the
+# output does, and `last_modified` is an HTTP date
+OutputVersion = collections.namedtuple('OutputVersion',
+    ['tag', 'last_modified'])
+
+def _http_date(ts):
+    return email.utils.formatdate(ts, usegmt=True)
+
+
 class BlueSkyRunOutput(object):
 
     def __init__(self, api_version, mongo_db, handle_error_func,
-            output_stream):
+            output_stream, output_root_dir=None, local_output_root_dir=None):
         self.mongo_db = mongo_db
         self.handle_error = handle_error_func
         self.output_stream = apply_output_processor(api_version, output_stream)
+        self.output_root_dir = output_root_dir
+        self.local_output_root_dir = local_output_root_dir
+        self.local_output_dir = None
 
     async def process(self, run_id):
-        self.run_info = await self.mongo_db.find_run(run_id)
+        await self.find(run_id)
+        await self.write()
+
+    async def find(self, run_id):
+        """Looks up the run, and returns the version of its output, or
+        None if it can't be determined. Output isn't loaded until
+        write() is called.
+        """
+        # only the latest status is needed, to version the output
+        self.run_info = await self.mongo_db.find_run(run_id,
+            projection={'history': {'$slice': 1}})
         if not self.run_info:
             self.handle_error(404, "Run doesn't exist")
 
         elif not self.run_info.get('output_url'):
             self.handle_error(404, "Run output doesn't exist")
 
+        return await asyncio.to_thread(self._locate, self.run_info)
+
+    async def write(self):
         if 'dispersion' in self.run_info['modules']:
             #if output['config']['dispersion'].get('model') != 'vsmoke'):
-            self._get_dispersion(self.run_info)
+            await self._get_dispersion(self.run_info)
         elif 'plumerise' in self.run_info['modules']:
-            self._get_plumerise(self.run_info)
+            await self._get_plumerise(self.run_info)
         else:
             # TODO: is returning raw input not ok?
-            output = self._load_output(self.run_info)
+            output = await self._load_output(self.run_info)
             self.output_stream.write(output)
 
+    def _locate(self, run):
+        """Looks for the run's output on this host, and returns its version"""
+        self.local_output_dir = get_local_output_dir(run,
+            self.output_root_dir, self.local_output_root_dir)
+        return self._get_version(run)
+
+    def _get_version(self, run):
+        """Versions output by the run's latest status and, if the output
+        is read from output.json, by the file's modification time and
+        size (or the output host's ETag)
+        """
+        history = run.get('history') or []
+        if not history or not history[0].get('ts'):
+            return None
+        status = history[0]
+        tags = [status['status'], status['ts']]
+        try:
+            modified = datetime.datetime.strptime(status['ts'],
+                '%Y-%m-%dT%H:%M:%S.%fZ').replace(
+                tzinfo=datetime.timezone.utc).timestamp()
+        except ValueError:
+            return None
+
+        modules = run.get('modules') or []
+        embedded = (('dispersion' in modules and 'export' in run)
+            or ('dispersion' not in modules and 'plumerise' in modules
+                and 'fires' in run))
+        if not embedded:
+            file_version = (self._get_local_file_version(self.local_output_dir)
+                if self.local_output_dir
+                else self._get_remote_file_version(run['output_url']))
+            if not file_version:
+                return None
+            tags.append(file_version[0])
+            modified = max(modified, file_version[1] or 0)
+
+        return OutputVersion(':'.join(tags), _http_date(modified))
+
+    def _get_local_file_version(self, output_dir):
+        try:
+            st = os.stat(os.path.join(output_dir, 'output.json'))
+        except OSError:
+            return None
+        return '{}-{}'.format(st.st_mtime_ns, st.st_size), st.st_mtime
+
+    def _get_remote_file_version(self, output_url):
+        output_json_file = '/'.join([output_url.rstrip('/'), 'output.json'])
+        try:
+            resp = get_session().head(output_json_file,
+                timeout=REMOTE_TIMEOUT)
+        except requests.RequestException as e:
+            logger.error('Failed to check %s: %s', output_json_file, e)
+            return None
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+        if not resp.ok or not (etag or last_modified):
+            return None
+        try:
+            modified = email.utils.parsedate_to_datetime(
+                last_modified).timestamp()
+        except (TypeError, ValueError):
+            modified = None
+        return (etag or '{}-{}'.format(last_modified,
+            resp.headers.get('Content-Length'))), modified
+
     ##
     ## Plumerise
     ##
@@ -125,9 +256,9 @@ class BlueSkyRunOutput(object):
             if k not in whitelist:
                 info_dict.pop(k)
 
-    def _get_plumerise(self, run):
+    async def _get_plumerise(self, run):
         version_info = run.get('version_info') or {}
-        run_info = run if 'fires' in run else self._load_output(run)
+        run_info = run if 'fires' in run else await self._load_output(run)
         fires = run_info['fires']
         runtime_info = process_runtime(run_info.get('runtime'))
 
@@ -140,14 +271,14 @@ class BlueSkyRunOutput(object):
     ## Dispersion
     ##
 
-    def _get_dispersion(self, run):
+    async def _get_dispersion(self, run):
         r = {
             "root_url": run['output_url'],
             "version_info": run.get('version_info') or {}
         }
         if run.get('raw_data_images'):
             r['raw_data_images'] = run['raw_data_images']
-        run_info = run if 'export' in run else self._load_output(run)
+        run_info = run if 'export' in run else await self._load_output(run)
 
         # TODO: refine what runtime info is returned
         r['runtime'] = process_runtime(run_info.get('runtime'))
@@ -200,46 +331,59 @@ class BlueSkyRunOutput(object):
     ## Common methods
     ##
 
-    def _load_output(self, run):
-        # TODO: Maybe first try local no matter what, since is_same_host might
-        #   give false negative and checking local shouldn't give false postive
-        #   (only do this if is_same_host returns false negative in production)
-        if is_same_host(run):
+    async def _load_output(self, run):
+        """Loads output.json, without blocking the event loop"""
+        if self.local_output_dir:
             logger.debug('Loading local output')
-            return self._get(run['output_dir'], os.path.exists, open)
+            return await asyncio.to_thread(self._get_local,
+                self.local_output_dir)
         else:
             logger.debug('Loading remote output')
-            return self._get(run['output_url'], remote_exists, remote_open)
+            return await asyncio.to_thread(self._get_remote, run['output_url'])
 
-    def _get(self, output_location, exists_func, open_func):
-        """Gets information about the outpu output, which may be in local dir
-        or on remote host
-
-        args:
-         - output_location -- local pathname or url
-         - exists_func -- function to check existence of dir or file
-            (local or via http)
-         - open_func -- function to open output json file (local or via http)
+    def _get_local(self, output_dir):
+        logger.debug('Looking for output in %s', output_dir)
+        output_json_file = os.path.join(output_dir, 'output.json')
+        try:
+            with open(output_json_file, 'rb') as f:
+                j = f.read()
+        except FileNotFoundError:
+            self._handle_missing(output_dir, output_json_file, os.path.exists)
+        except OSError:
+            j = None
+        return self._parse(j, output_json_file)
+
+    def _get_remote(self, output_url):
+        """Downloads output.json once, only checking if the output
+        directory exists if output.json isn't found
         """
-        logger.debug('Looking for output in %s', output_location)
+        logger.debug('Looking for output in %s', output_url)
+        # use join instead of os.path.join since output_url is a url
+        output_json_file = '/'.join([output_url.rstrip('/'), 'output.json'])
+        j = None
+        try:
+            resp = get_session().get(output_json_file, timeout=REMOTE_TIMEOUT)
+            if resp.status_code == 404:
+                self._handle_missing(output_url, output_json_file,
+                    remote_exists)
+            if resp.ok:
+                j = resp.content
+        except requests.RequestException as e:
+            logger.error('Failed to download %s: %s', output_json_file, e)
+        return self._parse(j, output_json_file)
+
+    def _handle_missing(self, output_location, output_json_file, exists_func):
         if not exists_func(output_location):
             msg = "Output location doesn't exist: {}".format(output_location)
             self.handle_error(404, msg)
 
-        # use join instead of os.path.join in case output_location is a remote url
-        output_json_file = '/'.join([output_location.rstrip('/'), 'output.json'])
-        if not exists_func(output_json_file):
-            msg = "Output file doesn't exist: {}".format(output_json_file)
-            self.handle_error(404, msg)
-
-        with open_func(output_json_file) as f:
-            try:
-                j = f.read()
-                if hasattr(j, 'decode'):
-                    j = j.decode()
-                return json.loads(j)
-                # TODO: set fields here, using , etc.
-            except:
-                msg = "Failed to open output file: {}".format(output_json_file)
-                self.handle_error(500, msg)
+        msg = "Output file doesn't exist: {}".format(output_json_file)
+        self.handle_error(404, msg)
 
+    def _parse(self, j, output_json_file):
+        try:
+            return json.loads(j)
+            # TODO: set fields here, using , etc.
+        except:
+            msg = "Failed to open output file: {}".format(output_json_file)
+            self.handle_error(500, msg)
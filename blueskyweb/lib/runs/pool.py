@@ -0,0 +1,153 @@
+"""blueskyweb.lib.runs.pool"""
+
+__author__      = "Joel Dubowy"
+__copyright__   = "Copyright 2015, AirFire, PNW, USFS"
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "RunPoolFullError",
+    "InProcessRunPool"
+]
+
+
+class RunPoolFullError(RuntimeError):
+
+    def __init__(self, msg, retry_after):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+class InProcessRunPool(object):
+    """Limits the number of bluesky runs executing in the web process.
+
+    Each run still gets its own thread, since bluesky stores its config
+    in thread local data, but at most `max_running` run at once. Other
+    runs wait up to `queue_timeout` seconds for a slot, with at most
+    `max_waiting` waiting, before being rejected. Runs are awaited
+    without blocking the event loop.
+
+    Once the pool is shut down, new runs are rejected, and executing
+    runs can be waited on so that their statuses get recorded.
+    """
+
+    def __init__(self, max_running=4, max_waiting=16, queue_timeout=10,
+            retry_after=30):
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._slots = None
+        self._running = 0
+        self._waiting = 0
+        self._executing = set()
+        self._shut_down = False
+        self._stats = {
+            'completed': 0,
+            'failed_to_start': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'max_running': 0,
+            'max_waiting': 0,
+            'total_wait_seconds': 0.0
+        }
+
+    @property
+    def stats(self):
+        return dict(self._stats, running=self._running, waiting=self._waiting,
+            limit=self.max_running, saturated=self._running >= self.max_running)
+
+    async def run(self, runner, on_start=None, on_done=None):
+        """Starts `runner`, a thread, once a slot is available, and
+        waits for it to finish. `on_start`, if specified, is called
+        just before starting the thread. `on_done`, if specified, is
+        called once the thread finishes, even if the caller was
+        cancelled before then.
+        """
+        # the semaphore is created lazily so that it's bound to the
+        # running loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_running)
+
+        if self._shut_down:
+            self._stats['rejected'] += 1
+            raise RunPoolFullError("Shutting down", self.retry_after)
+
+        if self._slots.locked():
+            if self._waiting >= self.max_waiting:
+                self._stats['rejected'] += 1
+                raise RunPoolFullError("{} runs executing and {} waiting".format(
+                    self._running, self._waiting), self.retry_after)
+
+        start = time.monotonic()
+        self._waiting += 1
+        self._stats['max_waiting'] = max(self._stats['max_waiting'],
+            self._waiting)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._stats['timed_out'] += 1
+            raise RunPoolFullError("Timed out waiting for one of {} "
+                "executing runs to finish".format(self._running),
+                self.retry_after)
+        finally:
+            self._waiting -= 1
+            self._stats['total_wait_seconds'] += time.monotonic() - start
+
+        self._running += 1
+        self._stats['max_running'] = max(self._stats['max_running'],
+            self._running)
+        if self._shut_down:
+            # shut down while waiting for the slot
+            self._stats['rejected'] += 1
+            self._release()
+            raise RunPoolFullError("Shutting down", self.retry_after)
+
+        try:
+            if on_start:
+                on_start()
+            runner.start()
+        except Exception:
+            self._stats['failed_to_start'] += 1
+            self._release()
+            raise
+
+        # The slot is released, and on_done called, when the thread
+        # finishes, even if this request is cancelled first
+        done = asyncio.ensure_future(asyncio.to_thread(runner.join))
+        self._executing.add(done)
+        done.add_done_callback(self._executing.discard)
+        done.add_done_callback(lambda f: self._finished(on_done))
+        await asyncio.shield(done)
+
+    def _finished(self, on_done):
+        self._release(completed=True)
+        if on_done:
+            try:
+                on_done()
+            except Exception as e:
+                logger.error("Failed to handle completed run: %s", e)
+
+    async def shutdown(self, wait=True, timeout=None):
+        """Rejects new runs and, if `wait` is true, waits up to `timeout`
+        seconds (indefinitely if None) for executing runs to finish.
+        """
+        self._shut_down = True
+        if wait and self._executing:
+            logger.info("Waiting for %s in-process runs to finish",
+                len(self._executing))
+            _, pending = await asyncio.wait(set(self._executing),
+                timeout=timeout)
+            if pending:
+                logger.warning("%s in-process runs still executing at "
+                    "shutdown", len(pending))
+
+    def _release(self, completed=False):
+        self._running -= 1
+        if completed:
+            self._stats['completed'] += 1
+        self._slots.release()
@@ -0,0 +1,124 @@
+"""blueskyweb.lib.runs.publish"""
+
+__author__      = "Joel Dubowy"
+__copyright__   = "Copyright 2015, AirFire, PNW, USFS"
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "OutboxFullError",
+    "PublishTimeoutError",
+    "RunPublisher"
+]
+
+
+class OutboxFullError(RuntimeError):
+    pass
+
+class PublishTimeoutError(RuntimeError):
+    pass
+
+
+class RunPublisher(object):
+    """Publishes run jobs to the broker from a small pool of dedicated
+    threads, so that a slow or reconnecting broker doesn't block the
+    event loop.
+
+    Jobs wait in a bounded outbox until a publisher thread picks them
+    up. Each thread publishes through celery's producer pool, which
+    keeps long-lived broker connections, and waits for the broker to
+    confirm the publish.
+    """
+
+    def __init__(self, max_pending=100, timeout=10, num_threads=2):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_threads, thread_name_prefix='run-publisher')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {
+            'published': 0,
+            'failed': 0,
+            'timed_out': 0,
+            'rejected': 0,
+            'max_pending': 0,
+            'last_publish_seconds': None,
+            'max_publish_seconds': 0
+        }
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=self._pending)
+
+    async def publish(self, task, args, kwargs, on_published=None,
+            on_failed=None, **options):
+        """Publishes a `task` job and waits up to `timeout` seconds for
+        the broker to confirm it.
+
+        `on_published`, if specified, is called from the publisher thread
+        once the job is confirmed - even if this call has timed out.
+        Likewise, `on_failed` is called with the exception if publishing
+        fails.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._stats['rejected'] += 1
+                raise OutboxFullError(
+                    "{} runs waiting to be enqueued".format(self._pending))
+            self._pending += 1
+            self._stats['max_pending'] = max(self._stats['max_pending'],
+                self._pending)
+
+        future = asyncio.get_running_loop().run_in_executor(self._executor,
+            self._publish, task, args, kwargs, on_published, on_failed,
+            options)
+        try:
+            # shield, so that publishing isn't abandoned on timeout
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._stats['timed_out'] += 1
+            raise PublishTimeoutError(
+                "Broker didn't confirm within {}s".format(self.timeout))
+
+    def _publish(self, task, args, kwargs, on_published, on_failed, options):
+        start = time.monotonic()
+        try:
+            result = task.apply_async(args=args, kwargs=kwargs, **options)
+        except Exception as e:
+            logger.error('Failed to publish %s job: %s', task.name, e)
+            with self._lock:
+                self._stats['failed'] += 1
+            self._call(on_failed, e)
+            raise
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+        seconds = time.monotonic() - start
+        with self._lock:
+            self._stats['published'] += 1
+            self._stats['last_publish_seconds'] = seconds
+            self._stats['max_publish_seconds'] = max(
+                self._stats['max_publish_seconds'], seconds)
+
+        self._call(on_published)
+        return result
+
+    def _call(self, callback, *args):
+        if callback:
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error('Failed to handle publish outcome: %s', e)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,90 @@
+"""blueskyweb.lib.startup
+
+Measures cold start time of the web service and the worker, for
+catching startup regressions, e.g. modules that are slow to import
+being imported at startup rather than on first use.
+"""
+
+__author__      = "Joel Dubowy"
+__copyright__   = "Copyright 2015, AirFire, PNW, USFS"
+
+import collections
+import os
+import subprocess
+import sys
+import time
+
+__all__ = [
+    "STARTUP_TARGETS",
+    "profile_startup",
+    "format_report"
+]
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# Arguments to the interpreter, to run what each process does before
+# it's ready to serve. For the web service, 'web-cli' runs bin/bsp-web
+# itself, up to parsing args, and 'web' constructs the app, which is
+# what bin/bsp-web (or each uvicorn worker) does next. Starting uvicorn
+# isn't included, since it binds a port and connects to mongodb. For
+# the worker, it's what `celery -A blueskyworker.tasks` loads
+STARTUP_TARGETS = {
+    'web-cli': [os.path.join(ROOT_DIR, 'bin', 'bsp-web'), '--help'],
+    'web': ['-c', "from blueskyweb.app import create_app, DEFAULT_SETTINGS; "
+        "create_app(dict(DEFAULT_SETTINGS))"],
+    'worker': ['-c', "import blueskyworker.tasks"]
+}
+
+ModuleImportTime = collections.namedtuple('ModuleImportTime',
+    ['module', 'self_seconds', 'cumulative_seconds'])
+
+StartupProfile = collections.namedtuple('StartupProfile',
+    ['target', 'seconds', 'modules'])
+
+
+def profile_startup(target):
+    """Runs `target`'s startup in a new interpreter, and returns its
+    total wall time along with the time spent importing each module,
+    as reported by `python -X importtime`.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [ROOT_DIR] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    start = time.monotonic()
+    p = subprocess.run([sys.executable, '-X', 'importtime']
+        + STARTUP_TARGETS[target], cwd=ROOT_DIR, env=env,
+        capture_output=True, text=True)
+    seconds = time.monotonic() - start
+    if p.returncode != 0:
+        raise RuntimeError("{} startup failed: {}".format(target,
+            p.stderr.strip().splitlines()[-1:]))
+
+    return StartupProfile(target, seconds, _parse_import_times(p.stderr))
+
+
+def _parse_import_times(stderr):
+    modules = []
+    for line in stderr.splitlines():
+        # e.g. 'import time:       526 |       1230 |   celery'
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        try:
+            modules.append(ModuleImportTime(parts[2].strip(),
+                int(parts[0]) / 1000000, int(parts[1]) / 1000000))
+        except (IndexError, ValueError):
+            # header line
+            continue
+    return modules
+
+
+def format_report(profile, limit=25):
+    """Returns a report of the modules that took the longest to
+    import, including the modules they imported
+    """
+    lines = ["{} startup: {:.3f}s".format(profile.target, profile.seconds),
+        "{:>10} {:>10}  module".format('cumul (s)', 'self (s)')]
+    modules = sorted(profile.modules, key=lambda m: -m.cumulative_seconds)
+    for m in modules[:limit]:
+        lines.append("{:10.3f} {:10.3f}  {}".format(m.cumulative_seconds,
+            m.self_seconds, m.module))
+    return '\n'.join(lines)
@@ -0,0 +1,94 @@
+"""blueskyworker.host"""
+
+__author__      = "Joel Dubowy"
+__copyright__   = "Copyright 2015, AirFire, PNW, USFS"
+
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "HostIdentity",
+    "get_host_identity"
+]
+
+
+class HostIdentity(object):
+    """Identifies the host that workers write run output on, for
+    recording in run records and for building output urls.
+
+    Values are resolved on first use, and then cached, so that nothing
+    is looked up at import. The hostname is, in order of preference,
+    the configured hostname, the host's public ip address, or the local
+    fully qualified hostname. The ip address is the configured one or,
+    if `ip_lookup` is enabled, the public ip address reported by ipify,
+    which requires network access.
+    """
+
+    def __init__(self, hostname=None, ip=None, ip_lookup=True):
+        self._hostname = hostname
+        self._ip = ip
+        self.ip_lookup = ip_lookup and not ip
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Configures identity from the PUBLIC_HOSTNAME and PUBLIC_IP env
+        vars. Setting HOST_IP_LOOKUP to 'none' disables ip lookups.
+        """
+        return cls(hostname=os.environ.get('PUBLIC_HOSTNAME') or None,
+            ip=os.environ.get('PUBLIC_IP') or None,
+            ip_lookup=os.environ.get('HOST_IP_LOOKUP', '').lower() != 'none')
+
+    @property
+    def ip(self):
+        with self._lock:
+            if self.ip_lookup:
+                self.ip_lookup = False
+                self._ip = self._lookup_ip()
+            return self._ip
+
+    @property
+    def hostname(self):
+        if self._hostname:
+            return self._hostname
+        ip = self.ip
+        with self._lock:
+            if not self._hostname:
+                self._hostname = ip or socket.getfqdn() or 'localhost'
+                logger.info('Hostname: %s', self._hostname)
+            return self._hostname
+
+    def to_record(self):
+        """Returns identity to record with runs, without looking up the
+        ip address if it isn't needed
+        """
+        hostname = self.hostname
+        return {"hostname": hostname, "ip": self._ip}
+
+    def _lookup_ip(self):
+        try:
+            import ipify2
+            ip = ipify2.get_ipv4()
+        except Exception as e:
+            # this should only happen if working without internet
+            # connection, in which case output urls use the local hostname
+            logger.warning('Failed to look up public ip address: %s', e)
+            return None
+        logger.info('IP address: %s', ip)
+        return ip
+
+
+_host_identity = None
+_host_identity_lock = threading.Lock()
+
+def get_host_identity():
+    """Returns the process's host identity, configured from env vars"""
+    global _host_identity
+    with _host_identity_lock:
+        if _host_identity is None:
+            _host_identity = HostIdentity.from_env()
+        return _host_identity
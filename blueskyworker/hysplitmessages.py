@@ -0,0 +1,110 @@
+"""blueskyworker.hysplitmessages"""
+
+__author__      = "Joel Dubowy"
+__copyright__   = "Copyright 2015, AirFire, PNW, USFS"
+
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "HysplitMessageTailer"
+]
+
+
+class HysplitMessageTailer(object):
+    """Determines how many hours hysplit has completed by tailing its
+    MESSAGE files, which get a line mentioning 'output' for each hour.
+
+    Each file's read offset is kept, so that each check only reads what
+    was appended since the previous one. Multi-process (MPI) runs write
+    a MESSAGE.NNN file per process, and runs split into multiple hysplit
+    processes run each in a sub directory of the working dir; all of
+    these files are tracked, and progress is that of the slowest.
+    Files that are no longer tracked, e.g. the single MESSAGE file once
+    process specific ones are written, are forgotten, and progress is
+    never reported to have decreased.
+    """
+
+    OUTPUT_MARKER = b'output'
+    MESSAGE_FILE_MATCHER = re.compile(r'^MESSAGE(\.\d{3})?$')
+
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        # hours completed, and read offset, by file
+        self._hours = {}
+        self._offsets = {}
+        self._current_hour = None
+
+    @property
+    def current_hour(self):
+        """Most hours completed by the slowest process, or None if no
+        MESSAGE files have been found
+        """
+        return self._current_hour
+
+    def update(self):
+        """Reads what's been appended to the MESSAGE files, and returns
+        the current hour
+        """
+        files = self.find_message_files()
+        for f in set(self._hours) - set(files):
+            self._hours.pop(f, None)
+            self._offsets.pop(f, None)
+        for f in files:
+            try:
+                self._read(f)
+            except OSError as e:
+                logger.debug("Failed to read %s: %s", f, e)
+
+        if self._hours:
+            hour = min(self._hours.values())
+            if self._current_hour is None or hour > self._current_hour:
+                self._current_hour = hour
+        return self._current_hour
+
+    def find_message_files(self):
+        files = []
+        for d in self._find_dirs():
+            names = self._list_message_files(d)
+            # Process specific files are written by MPI runs
+            numbered = [n for n in names if n != 'MESSAGE']
+            files.extend(os.path.join(d, n) for n in (numbered or names))
+        return sorted(files)
+
+    def _find_dirs(self):
+        if not self.working_dir:
+            return []
+        dirs = [self.working_dir]
+        try:
+            with os.scandir(self.working_dir) as it:
+                dirs.extend(e.path for e in it if e.is_dir())
+        except OSError:
+            pass
+        return dirs
+
+    def _list_message_files(self, d):
+        try:
+            with os.scandir(d) as it:
+                return [e.name for e in it
+                    if self.MESSAGE_FILE_MATCHER.match(e.name) and e.is_file()]
+        except OSError:
+            return []
+
+    def _read(self, f):
+        offset = self._offsets.get(f, 0)
+        with open(f, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size < offset:
+                # the file was truncated or replaced
+                offset = 0
+                self._hours[f] = 0
+            fp.seek(offset)
+            data = fp.read()
+
+        # only complete lines are counted; the rest is read next time
+        end = data.rfind(b'\n') + 1
+        self._hours[f] = self._hours.get(f, 0) + sum(
+            1 for l in data[:end].split(b'\n') if self.OUTPUT_MARKER in l)
+        self._offsets[f] = offset + end
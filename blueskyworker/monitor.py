@@ -4,80 +4,59 @@ __author__      = "Joel Dubowy"
 __copyright__   = "Copyright 2015, AirFire, PNW, USFS"
 
 import logging
-import os
-import subprocess
-import time
-import threading
 
 from bluesky.config import Config
 
 logger = logging.getLogger(__name__)
 
 from blueskymongo.client import RunStatuses
+from .watcher import get_progress_watcher
 
-class HysplitMonitor(threading.Thread):
-    """Monitor thread that scrapes hysplit MESSAGE files to determine
-    how many hours are complete
+class HysplitMonitor(object):
+    """Monitors hysplit MESSAGE files to determine how many hours are
+    complete, recording progress whenever another hour completes.
+
+    The files are watched by the process's progress watcher, which
+    serves all runs in the process from a single thread.
     """
-    def __init__(self, m, config, fires_manager, record_run_func):
-        super(HysplitMonitor, self).__init__()
-        # configuration needs to be set in each thread; record it here
-        # and set it in 'run', once thread has started
-        self.config = config
+    def __init__(self, m, fires_manager, record_run_func):
         self.m = m
         self.fires_manager = fires_manager
         self.start_hour = Config().get('dispersion', 'start')
         self.num_hours = Config().get('dispersion', 'num_hours')
+        self.working_dir = Config().get('dispersion', 'working_dir')
 
         self.record_run_func = record_run_func
-        self.terminate = False
-        self._message_file_name = None
-
-    @property
-    def message_file_name(self):
-        if self._message_file_name is None:
-            # this code will run again if no message files are found
-            working_dir = Config().get(
-                'dispersion', 'working_dir')
-            mp1 = os.path.join(working_dir, 'MESSAGE')
-            if os.path.exists(mp1):
-                self._message_file_name = mp1
-            else:
-                mpN = os.path.join(working_dir, 'MESSAGE.001')
-                if os.path.exists(mpN):
-                    self._message_file_name = mpN
-
-        return self._message_file_name
-
-    def run(self):
-        Config().set(self.config)
-        while not self.terminate:
-            self.check_progress()
-            time.sleep(5)
-
-    def check_progress(self):
-        percent_complete = 2
-        if self.message_file_name:
-            try:
-                # estimate percent complete based on slowest of
-                # all hysplit processes
-                current_hour = self.get_current_hour()
-                # we want percent_complete to be between 3 and 90
-                percent_complete = int((90 * (current_hour / self.num_hours)) + 2)
-            except Exception as e:
-                logger.info("Failed to check progress: %s", e)
-
-        # else, leave at 2
+        self._watch_key = None
+
+    def start(self):
+        # hysplit hasn't written any MESSAGE files yet
+        self.record_progress(2)
+        self._watch_key = get_progress_watcher().watch(self.working_dir,
+            self.on_hour)
+
+    def stop(self):
+        if self._watch_key is not None:
+            get_progress_watcher().unwatch(self._watch_key)
+            self._watch_key = None
+
+    def on_hour(self, current_hour):
+        """Called with the number of hours completed by the slowest of
+        all hysplit processes
+        """
+        # we want percent_complete to be between 3 and 90.
+        # This is called on the watcher thread shared by all runs, so
+        # progress is dropped rather than waiting for the run record
+        # writer to catch up
+        self.record_progress(int((90 * (current_hour / self.num_hours)) + 2),
+            put_timeout=0)
+
+    def record_progress(self, percent_complete, put_timeout=None):
         logger.info("Run %s hysplit %d complete",
             self.fires_manager.run_id, percent_complete)
 
         self.record_run_func(RunStatuses.RunningModule, module=self.m,
-            percent_complete=percent_complete)
-
-    def get_current_hour(self):
-        output_lines = [l for l in subprocess.check_output(
-            ["grep", "output", self.message_file_name]).decode().split('\n') if l]
-        return len(output_lines)
+            percent_complete=percent_complete, put_timeout=put_timeout)
 
 
 class monitor_run(object):
@@ -87,21 +66,20 @@ class monitor_run(object):
         self.m = m
         self.fires_manager = fires_manager
         self.record_run_func = record_run_func
-        self.thread = None
+        self.monitor = None
 
     def __enter__(self):
         logger.info("Entering monitor_run context manager")
         if self._is_hysplit():
-            logger.info("Starting thread to monitor hysplit")
-            self.thread = HysplitMonitor(self.m, Config().get(),
-                self.fires_manager, self.record_run_func)
-            self.thread.start()
+            logger.info("Starting to monitor hysplit")
+            self.monitor = HysplitMonitor(self.m, self.fires_manager,
+                self.record_run_func)
+            self.monitor.start()
 
     def __exit__(self, e_type, value, tb):
-        if self.thread:
-            self.thread.terminate = True
-            logger.info("joining hysplit monitoring thread")
-            self.thread.join()
+        if self.monitor:
+            logger.info("Stopping hysplit monitoring")
+            self.monitor.stop()
 
     def _is_hysplit(self):
         if self.m =='dispersion':
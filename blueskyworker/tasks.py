@@ -4,6 +4,7 @@ __author__      = "Joel Dubowy"
 __copyright__   = "Copyright 2015, AirFire, PNW, USFS"
 
 import abc
+import asyncio
 import datetime
 import json
 import logging
@@ -14,7 +15,6 @@ import threading
 import traceback
 import uuid
 
-import ipify2
 from celery import Celery
 from bluesky import (
     exceptions, models, __version__ as bluesky_version
@@ -25,6 +25,7 @@ from blueskymongo.client import BlueSkyWebDB, RunStatuses
 
 import logging
 
+from .host import get_host_identity
 from .monitor import monitor_run
 
 logger = logging.getLogger(__name__)
@@ -43,17 +44,14 @@ app.conf.update(
         'certfile': '/etc/ssl/bluesky-web-client-cert.crt',
         'ca_certs': '/etc/ssl/bluesky-web-client.pem',
         'cert_reqs': ssl.CERT_NONE
+    },
+    # have the broker confirm each published job, so that publishing
+    # fails instead of silently dropping jobs
+    broker_transport_options={
+        'confirm_publish': True
     }
 )
 
-try:
-    IP_ADDRESS = ipify2.get_ipv4()
-except:
-    # this should only happen in dev, if working without internet connection
-    IP_ADDRESS = 'localhost'
-logger.info('IP_ADDRESS (in tasks.py): %s', IP_ADDRESS)
-HOSTNAME = os.environ.get('PUBLIC_HOSTNAME') or IP_ADDRESS
-
 ##
 ## Public Job Interface
 ##
@@ -69,9 +67,9 @@ def run_bluesky(input_data, api_version, **settings):
     Settings:
      See `_run_bluesky` helpstring for required settings
     """
-    db = BlueSkyWebDB(MONGODB_URL)
+    db = BlueSkyWebDB.from_settings(MONGODB_URL, settings)
     db.record_run(input_data['run_id'], RunStatuses.Dequeued,
-        server={"ip": IP_ADDRESS})
+        server=get_host_identity().to_record())
     logger.info("Running %s from queue %s",
         input_data['run_id'],  '/') # TODO: get queue from job process
 
@@ -85,6 +83,10 @@ def run_bluesky(input_data, api_version, **settings):
     t.start()
     t.join() # block until it completes
 
+    # make sure the final status is written before the task is acked,
+    # and stop the db's writer, since each job gets its own
+    asyncio.run(db.close(timeout=60))
+
 
 ##
 ## Launching process
@@ -195,7 +197,8 @@ class BlueSkyRunner(threading.Thread):
             if self.settings.get('output_url_port') else '')
         prefix = (self.settings.get('output_url_path_prefix') or '').strip('/')
         self.output_url = "{}://{}{}/{}/{}".format(
-            scheme, HOSTNAME, port_str, prefix, self.run_id)
+            scheme, get_host_identity().hostname, port_str, prefix,
+            self.run_id)
 
     ##
     ## Execution
@@ -0,0 +1,303 @@
+"""blueskyworker.watcher"""
+
+__author__      = "Joel Dubowy"
+__copyright__   = "Copyright 2015, AirFire, PNW, USFS"
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from .hysplitmessages import HysplitMessageTailer
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "HysplitProgressWatcher",
+    "get_progress_watcher"
+]
+
+
+##
+## inotify
+##
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Minimal wrapper around linux's inotify api"""
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+            use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Failed to initialize inotify")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Failed to watch " + path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """Waits up to `timeout` seconds for events, and returns them as
+        (wd, mask, name) tuples
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        i = 0
+        while i + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, i)
+            i += EVENT_HEADER.size
+            name = data[i:i + length].rstrip(b'\0').decode(errors='replace')
+            i += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+##
+## Progress watcher
+##
+
+class _WatchedRun(object):
+
+    def __init__(self, working_dir, on_hour):
+        self.working_dir = working_dir
+        self.on_hour = on_hour
+        self.tailer = HysplitMessageTailer(working_dir)
+        self.hour = None
+        # set while on_hour is being called
+        self.reporting = False
+        # watch descriptors, by watched directory
+        self.wds = {}
+
+
+class HysplitProgressWatcher(object):
+    """Watches the working dirs of all of a process's active hysplit
+    runs from a single thread, and reports a run's progress only when
+    hysplit completes another hour.
+
+    Uses inotify, where available, to check a run's MESSAGE files as
+    soon as they're written, with a full check every `rescan_interval`
+    seconds in case events are missed. Otherwise, and for runs whose
+    working dir doesn't exist yet, MESSAGE files are checked every
+    `poll_interval` seconds.
+    """
+
+    def __init__(self, poll_interval=5, rescan_interval=60,
+            use_inotify=True):
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                logger.info("Polling for hysplit progress: %s", e)
+        self._runs = {}
+        self._runs_by_wd = {}
+        self._lock = threading.Lock()
+        # notified when a run's progress has been reported, so that
+        # unwatch() can wait until none is being reported
+        self._reported = threading.Condition(self._lock)
+        self._thread = None
+        self._terminate = False
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def watch(self, working_dir, on_hour):
+        """Starts watching `working_dir`; `on_hour` is called, from the
+        watcher thread, with the number of hours completed by the slowest
+        hysplit process whenever it changes. Returns a key for unwatch().
+        """
+        run = _WatchedRun(working_dir, on_hour)
+        with self._lock:
+            key = id(run)
+            self._runs[key] = run
+            self._add_watches(key, run)
+            if self._thread is None:
+                self._terminate = False
+                self._thread = threading.Thread(target=self._run,
+                    name='hysplit-progress-watcher', daemon=True)
+                self._thread.start()
+        return key
+
+    def unwatch(self, key):
+        """Stops watching; no progress is reported once this returns,
+        unless called from `on_hour` itself
+        """
+        with self._lock:
+            run = self._runs.pop(key, None)
+            if run:
+                for wd in run.wds.values():
+                    self._runs_by_wd.pop(wd, None)
+                    self._inotify.rm_watch(wd)
+                if threading.current_thread() is not self._thread:
+                    self._reported.wait_for(lambda: not run.reporting)
+
+    def shutdown(self):
+        with self._lock:
+            self._terminate = True
+            thread = self._thread
+            self._thread = None
+        if thread:
+            thread.join()
+
+    ## Watcher thread
+
+    def _run(self):
+        last_rescan = time.monotonic()
+        while True:
+            with self._lock:
+                if self._terminate:
+                    return
+                runs = dict(self._runs)
+            if not self._inotify:
+                time.sleep(self.poll_interval)
+                changed = set(runs)
+            else:
+                changed = self._wait_for_changes()
+                if time.monotonic() - last_rescan >= self.rescan_interval:
+                    last_rescan = time.monotonic()
+                    changed.update(runs)
+
+            for key in changed:
+                self._check(key)
+
+    def _wait_for_changes(self):
+        changed = set()
+        for wd, mask, name in self._inotify.read_events(self.poll_interval):
+            with self._lock:
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(self._runs)
+                    continue
+                key = self._runs_by_wd.get(wd)
+                if key is None or key not in self._runs:
+                    continue
+                run = self._runs[key]
+                if mask & IN_ISDIR:
+                    if (mask & IN_CREATE
+                            and run.wds.get(run.working_dir) == wd):
+                        # runs split across processes write MESSAGE
+                        # files in sub directories
+                        self._add_watch(key, run,
+                            os.path.join(run.working_dir, name))
+                        changed.add(key)
+                elif HysplitMessageTailer.MESSAGE_FILE_MATCHER.match(name):
+                    # hysplit writes other files, e.g. cdump, much more
+                    # often than MESSAGE files, so their events are
+                    # ignored
+                    changed.add(key)
+
+        with self._lock:
+            # working dirs that didn't exist yet are polled
+            for key, run in self._runs.items():
+                if not run.wds:
+                    self._add_watches(key, run)
+                    changed.add(key)
+        return changed
+
+    def _add_watches(self, key, run):
+        if not self._inotify or not run.working_dir:
+            return
+        if self._add_watch(key, run, run.working_dir):
+            try:
+                with os.scandir(run.working_dir) as it:
+                    for e in it:
+                        if e.is_dir():
+                            self._add_watch(key, run, e.path)
+            except OSError:
+                pass
+
+    def _add_watch(self, key, run, path):
+        if path in run.wds:
+            return True
+        try:
+            wd = self._inotify.add_watch(path)
+        except OSError as e:
+            logger.debug("Failed to watch %s: %s", path, e)
+            return False
+        run.wds[path] = wd
+        self._runs_by_wd[wd] = key
+        return True
+
+    def _check(self, key):
+        with self._lock:
+            run = self._runs.get(key)
+        if not run:
+            return
+        try:
+            hour = run.tailer.update()
+        except Exception as e:
+            logger.info("Failed to check progress: %s", e)
+            return
+        if hour is None or hour == run.hour:
+            return
+
+        # on_hour is called without holding the lock, since it may be
+        # slow, e.g. recording progress, but not once unwatched
+        with self._lock:
+            if key not in self._runs:
+                return
+            run.reporting = True
+        try:
+            run.hour = hour
+            run.on_hour(hour)
+        except Exception as e:
+            logger.info("Failed to report progress: %s", e)
+        finally:
+            with self._lock:
+                run.reporting = False
+                self._reported.notify_all()
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+def get_progress_watcher():
+    """Returns the process's progress watcher"""
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = HysplitProgressWatcher()
+        return _watcher
+
+def _reset_after_fork():
+    # Celery forks worker processes, which can't share the parent's
+    # watcher thread
+    global _watcher, _watcher_lock
+    _watcher = None
+    _watcher_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
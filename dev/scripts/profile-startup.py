@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+"""profile-startup.py: reports cold start time of the web service and
+worker, and the modules that took longest to import"""
+
+__author__ = "Joel Dubowy"
+__copyright__ = "Copyright 2015, AirFire, PNW, USFS"
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(sys.path[0], '..', '..')))
+from blueskyweb.lib.startup import STARTUP_TARGETS, profile_startup, format_report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-t', '--target', action='append', dest='targets',
+        choices=sorted(STARTUP_TARGETS),
+        help="Process to profile; defaults to all")
+    parser.add_argument('-l', '--limit', type=int, default=25,
+        help="Number of modules to list")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for target in args.targets or sorted(STARTUP_TARGETS):
+        print(format_report(profile_startup(target), limit=args.limit))
+        print()
+
+
+if __name__ == "__main__":
+    main()
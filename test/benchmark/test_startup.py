@@ -0,0 +1,70 @@
+"""Fails if cold start of the web service or worker goes over budget.
+
+Each target is started in a new interpreter (see
+blueskyweb.lib.startup.STARTUP_TARGETS). The web service's cold start
+is measured in two parts: 'web-cli' runs `bin/bsp-web --help`, and
+'web' constructs the app, as bin/bsp-web does before starting uvicorn.
+Starting uvicorn itself isn't measured, since it binds a port and
+connects to mongodb.
+
+Budgets, in seconds, can be set with the BSP_WEB_CLI_STARTUP_BUDGET,
+BSP_WEB_STARTUP_BUDGET and BSP_WORKER_STARTUP_BUDGET env vars. Run
+
+    ./dev/scripts/profile-startup.py
+
+to see which modules are responsible.
+"""
+
+import importlib.util
+import os
+
+import pytest
+
+from blueskyweb.lib.startup import profile_startup, format_report
+
+BUDGETS = {
+    'web-cli': float(os.environ.get('BSP_WEB_CLI_STARTUP_BUDGET') or 2.0),
+    'web': float(os.environ.get('BSP_WEB_STARTUP_BUDGET') or 2.0),
+    'worker': float(os.environ.get('BSP_WORKER_STARTUP_BUDGET') or 5.0)
+}
+
+# Each target is skipped if any of the packages it needs at startup
+# aren't installed. The web service doesn't need bluesky to start
+DEPENDENCIES = {
+    'web-cli': ('afscripting', 'afconfig', 'fastapi', 'motor', 'uvicorn'),
+    'web': ('afconfig', 'fastapi', 'motor', 'uvicorn'),
+    'worker': ('afconfig', 'bluesky', 'celery')
+}
+
+def _skip_if_missing_dependencies(target):
+    missing = [m for m in DEPENDENCIES[target]
+        if importlib.util.find_spec(m) is None]
+    if missing:
+        pytest.skip("{} startup needs {}".format(target, ', '.join(missing)))
+
+# The fastest of a few runs is used, to reduce noise
+NUM_RUNS = 3
+
+# Modules that should only be imported on first use by the web service
+WEB_LAZY_MODULES = ('bluesky', 'geoutils', 'blueskyworker.tasks')
+
+
+def _profile(target):
+    return min((profile_startup(target) for i in range(NUM_RUNS)),
+        key=lambda p: p.seconds)
+
+
+class TestStartup(object):
+
+    @pytest.mark.parametrize('target', sorted(BUDGETS))
+    def test_within_budget(self, target):
+        _skip_if_missing_dependencies(target)
+        profile = _profile(target)
+        assert profile.seconds <= BUDGETS[target], format_report(profile)
+
+    @pytest.mark.parametrize('target', ['web-cli', 'web'])
+    def test_web_defers_slow_imports(self, target):
+        _skip_if_missing_dependencies(target)
+        profile = profile_startup(target)
+        imported = set(m.module for m in profile.modules)
+        assert not imported.intersection(WEB_LAZY_MODULES), format_report(profile)
@@ -0,0 +1,182 @@
+import json
+import os
+
+import pytest
+
+import blueskyconfig
+
+
+def _write(config_file, config):
+    config_file.write(json.dumps(config))
+    # make sure the change is seen even if the file is rewritten
+    # within the filesystem's timestamp resolution
+    st = os.stat(str(config_file))
+    os.utime(str(config_file), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+@pytest.fixture
+def config_file(tmpdir, monkeypatch):
+    config_file = tmpdir.join('defaults.json')
+    # checks for changes on each access
+    _write(config_file, {'cache_ttl_minutes': 0, 'foo': {'bar': 1}})
+    monkeypatch.setattr(blueskyconfig.ConfigManagerSingleton, '_instance', None)
+    monkeypatch.setattr(blueskyconfig.ConfigManagerSingleton,
+        'DEFAULT_CONFIG_JSON_FILE', str(config_file))
+    return config_file
+
+
+ARCHIVES_CONFIG = {
+    'domains': {
+        'DRI2km': {'grid': {'spacing': 2}, 'arl_index_file': 'a.csv'},
+        'NAM84': {'grid': {'spacing': 12}}
+    },
+    'archives': {
+        'standard': {
+            'ca-nv_2-km': {'domain_id': 'DRI2km', 'title': 'CA/NV 2km'},
+            'national_12-km': {'domain_id': 'NAM84'}
+        },
+        'special': {
+            # duplicate of an archive in another group
+            'ca-nv_2-km': {'domain_id': 'NAM84', 'title': 'duplicate'},
+            'no-domain': {'domain_id': 'UNDEFINED', 'title': 'No domain'}
+        }
+    }
+}
+
+
+class TestBuildArchiveIndex(object):
+
+    def test_merges_domain_info(self):
+        index = blueskyconfig.build_archive_index(ARCHIVES_CONFIG)
+        assert index['ca-nv_2-km'] == {
+            'id': 'ca-nv_2-km',
+            'domain_id': 'DRI2km',
+            'title': 'CA/NV 2km',
+            'grid': {'spacing': 2},
+            'arl_index_file': 'a.csv'
+        }
+        assert index['national_12-km'] == {
+            'id': 'national_12-km',
+            'domain_id': 'NAM84',
+            'grid': {'spacing': 12}
+        }
+
+    def test_undefined_domain(self):
+        index = blueskyconfig.build_archive_index(ARCHIVES_CONFIG)
+        assert index['no-domain'] == {
+            'id': 'no-domain',
+            'domain_id': 'UNDEFINED',
+            'title': 'No domain'
+        }
+
+    def test_read_only(self):
+        index = blueskyconfig.build_archive_index(ARCHIVES_CONFIG)
+        with pytest.raises(TypeError):
+            index['ca-nv_2-km']['grid']['spacing'] = 4
+        # the source config isn't affected by the merge
+        assert 'grid' not in ARCHIVES_CONFIG['archives']['standard']['ca-nv_2-km']
+
+    def test_empty_config(self):
+        assert blueskyconfig.build_archive_index({}) == {}
+
+    def test_get_archive_info(self, config_file):
+        _write(config_file, dict(ARCHIVES_CONFIG, cache_ttl_minutes=0))
+        assert blueskyconfig.get_archive_info('ca-nv_2-km')['grid'] == {'spacing': 2}
+        assert blueskyconfig.get_archive_info('no-domain')['id'] == 'no-domain'
+        assert blueskyconfig.get_archive_info('foo') is None
+
+
+class TestConfigManagerSingleton(object):
+
+    def test_singleton(self, config_file):
+        assert (blueskyconfig.ConfigManagerSingleton()
+            is blueskyconfig.ConfigManagerSingleton())
+
+    def test_reloads_when_content_changes(self, config_file):
+        manager = blueskyconfig.ConfigManagerSingleton()
+        assert manager.config['foo'] == {'bar': 1}
+        version = manager.version
+
+        _write(config_file, {'cache_ttl_minutes': 0, 'foo': {'bar': 22}})
+        assert manager.config['foo'] == {'bar': 22}
+        assert manager.version == version + 1
+        assert manager.stats['loads'] == 2
+
+    def test_unchanged_content_keeps_version(self, config_file):
+        manager = blueskyconfig.ConfigManagerSingleton()
+        config = manager.config
+        version = manager.version
+        checks = manager.stats['checks']
+
+        # touched, but not changed
+        st = os.stat(str(config_file))
+        os.utime(str(config_file), ns=(st.st_atime_ns,
+            st.st_mtime_ns + 10**9))
+        assert manager.config is config
+        assert manager.version == version
+        stats = manager.stats
+        assert stats['checks'] > checks
+        assert stats['loads'] == 1
+
+    def test_overrides_survive_reloads(self, config_file):
+        manager = blueskyconfig.ConfigManagerSingleton()
+        version = manager.version
+        manager.add_overrides({'foo': {'baz': 3}})
+        assert manager.config['foo'] == {'bar': 1, 'baz': 3}
+        assert manager.version == version + 1
+
+        _write(config_file, {'cache_ttl_minutes': 0, 'foo': {'bar': 22}})
+        assert manager.config['foo'] == {'bar': 22, 'baz': 3}
+        assert manager.version == version + 2
+
+    def test_reset_after_fork(self, config_file):
+        manager = blueskyconfig.ConfigManagerSingleton()
+        config = manager.config
+        # held, as if by another thread, when the process forks
+        with manager._lock:
+            pid = os.fork()
+            if pid == 0:
+                ok = False
+                try:
+                    child = blueskyconfig.ConfigManagerSingleton()
+                    ok = (child is manager
+                        and child._lock.acquire(blocking=False)
+                        and child._snapshot.config is config)
+                finally:
+                    os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+class TestGet(object):
+
+    def test_get_is_read_only(self, config_file):
+        _write(config_file, {'cache_ttl_minutes': 0,
+            'foo': {'bar': 1, 'baz': [{'a': 1}]}})
+        foo = blueskyconfig.get('foo')
+        with pytest.raises(TypeError):
+            foo['bar'] = 2
+        with pytest.raises(TypeError):
+            foo.update(bar=2)
+        with pytest.raises(TypeError):
+            foo['baz'].append({})
+        with pytest.raises(TypeError):
+            foo['baz'][0]['a'] = 2
+        assert blueskyconfig.get('foo') == {'bar': 1, 'baz': [{'a': 1}]}
+
+    def test_get_mutable_returns_independent_copy(self, config_file):
+        _write(config_file, {'cache_ttl_minutes': 0,
+            'foo': {'bar': 1, 'baz': [{'a': 1}]}})
+        foo = blueskyconfig.get_mutable('foo')
+        assert type(foo) is dict
+        assert type(foo['baz']) is list
+        assert type(foo['baz'][0]) is dict
+
+        foo['bar'] = 2
+        foo['baz'].append({})
+        foo['baz'][0]['a'] = 2
+        assert blueskyconfig.get('foo') == {'bar': 1, 'baz': [{'a': 1}]}
+
+        # each call returns a new copy
+        assert blueskyconfig.get_mutable('foo') == {'bar': 1, 'baz': [{'a': 1}]}
+        assert blueskyconfig.get_mutable('foo') is not blueskyconfig.get_mutable('foo')
@@ -0,0 +1,645 @@
+import asyncio
+import datetime
+import time
+
+import pytest
+from pymongo.errors import OperationFailure, ServerSelectionTimeoutError
+
+from blueskymongo import client
+
+
+class MockCollection(object):
+
+    def __init__(self):
+        self.batches = []
+
+    async def bulk_write(self, ops, ordered=True):
+        self.batches.append(ops)
+        class Result(object):
+            bulk_api_result = {}
+        return Result()
+
+
+class TestPendingRunUpdate(object):
+
+    def test_single_entry(self):
+        u = client._PendingRunUpdate()
+        u.add({'status': 'enqueued', 'ts': '1'}, {'queue': 'no-met'})
+        assert u.to_update() == {
+            "$push": {
+                "history": {
+                    '$each': [{'status': 'enqueued', 'ts': '1'}],
+                    '$sort': {'ts': -1}
+                }
+            },
+            "$set": {'queue': 'no-met'}
+        }
+
+    def test_no_data(self):
+        u = client._PendingRunUpdate()
+        u.add({'status': 'running', 'ts': '1'})
+        assert "$set" not in u.to_update()
+
+    def test_multiple_entries(self):
+        u = client._PendingRunUpdate()
+        u.add({'status': 'running_module', 'ts': '1', 'perc': 10}, {'percent': 10})
+        u.add({'status': 'running_module', 'ts': '2', 'perc': 20}, {'percent': 20})
+        u.add({'status': 'completed', 'ts': '3'}, {'output_url': 'foo'})
+        assert len(u) == 3
+        assert u.to_update() == {
+            "$push": {
+                "history": {
+                    # most recent first
+                    '$each': [
+                        {'status': 'completed', 'ts': '3'},
+                        {'status': 'running_module', 'ts': '2', 'perc': 20},
+                        {'status': 'running_module', 'ts': '1', 'perc': 10}
+                    ],
+                    '$sort': {'ts': -1}
+                }
+            },
+            "$set": {'percent': 20, 'output_url': 'foo'}
+        }
+
+
+    def test_compact(self):
+        u = client._PendingRunUpdate()
+        u.add({'status': 'starting_module', 'ts': '1', 'module': 'dispersion'})
+        u.add({'status': 'running_module', 'ts': '2', 'perc': 10}, {'percent': 10})
+        u.add({'status': 'running_module', 'ts': '3', 'perc': 20}, {'percent': 20})
+        update = u.to_update(max_milestones=5)
+        assert len(update) == 1
+        new_fields = update[0]['$set']
+        assert new_fields['percent'] == {'$literal': 20}
+        assert new_fields['history_mode'] == client.HistoryModes.Compact
+        history = new_fields['history']['$let']
+        # new and existing entries are sorted by ts, most recent first
+        sorted_history = history['vars']['history']['$sortArray']
+        assert sorted_history['sortBy'] == {'ts': -1}
+        assert sorted_history['input']['$concatArrays'] == [
+            {'$literal': [
+                {'status': 'running_module', 'ts': '3', 'perc': 20},
+                {'status': 'running_module', 'ts': '2', 'perc': 10},
+                {'status': 'starting_module', 'ts': '1', 'module': 'dispersion'}
+            ]},
+            {'$ifNull': ['$history', []]}
+        ]
+        # latest status, followed by milestones
+        history_slice = history['in']['$slice']
+        assert history_slice[1] == 6
+        latest, milestones = history_slice[0]['$concatArrays']
+        assert latest == {'$slice': ['$$history', 1]}
+        assert milestones['$filter']['cond'] == {
+            '$ne': ['$$e.status', client.RunStatuses.RunningModule]}
+
+    def test_to_events(self):
+        u = client._PendingRunUpdate()
+        u.add({'status': 'running', 'ts': '1'})
+        u.add({'status': 'completed', 'ts': '2'})
+        events = u.to_events('abc')
+        assert [(e['run_id'], e['status']) for e in events] == [
+            ('abc', 'running'), ('abc', 'completed')]
+        assert all('recorded_at' in e for e in events)
+
+
+class TestRunRecordWriter(object):
+
+    def test_coalesces_per_run(self):
+        collection = MockCollection()
+        writer = client.RunRecordWriter(collection, flush_interval=0.01)
+
+        async def _test():
+            writer.put('a', {'status': 'running', 'ts': '1'})
+            writer.put('b', {'status': 'running', 'ts': '2'})
+            writer.put('a', {'status': 'completed', 'ts': '3'}, terminal=True)
+            assert writer.stats['queue_depth'] == 3
+            assert writer.stats['coalesced'] == 1
+            await writer._flush_batch()
+
+        asyncio.run(_test())
+
+        assert len(collection.batches) == 1
+        ops = collection.batches[0]
+        assert len(ops) == 2
+        assert [op._filter for op in ops] == [{'run_id': 'a'}, {'run_id': 'b'}]
+        stats = writer.stats
+        assert stats['queue_depth'] == 0
+        assert stats['written'] == 3
+        assert stats['flushes'] == 1
+        assert stats['last_flush_latency'] is not None
+
+    def test_drops_when_full(self):
+        collection = MockCollection()
+        writer = client.RunRecordWriter(collection, flush_interval=60,
+            max_pending=1, put_timeout=0)
+
+        async def _test():
+            writer.put('a', {'status': 'running', 'ts': '1'})
+            writer.put('a', {'status': 'running', 'ts': '2'})
+            # terminal statuses are never dropped
+            writer.put('a', {'status': 'completed', 'ts': '3'}, terminal=True)
+
+        asyncio.run(_test())
+
+        stats = writer.stats
+        assert stats['dropped'] == 1
+        assert stats['queue_depth'] == 2
+
+
+    def test_close_writes_queued_updates(self):
+        collection = MockCollection()
+        writer = client.RunRecordWriter(collection, flush_interval=60)
+
+        async def _test():
+            writer.put('a', {'status': 'running', 'ts': '1'})
+            assert await writer.close(timeout=5)
+
+        asyncio.run(_test())
+        assert len(collection.batches) == 1
+        assert writer.stats['written'] == 1
+
+    def test_close_stops_background_flusher(self):
+        loop = client._get_bg_loop()
+        num_tasks = lambda: asyncio.run_coroutine_threadsafe(
+            _count_tasks(), loop).result(5)
+        before = num_tasks()
+        collections = []
+        for i in range(10):
+            collections.append(MockCollection())
+            writer = client.RunRecordWriter(collections[-1],
+                flush_interval=60)
+            # not on an event loop, so the background loop is used
+            writer.put('a', {'status': 'completed', 'ts': '1'},
+                terminal=True)
+            assert asyncio.run(writer.close(timeout=5))
+        assert all(len(c.batches) == 1 for c in collections)
+        assert num_tasks() == before
+
+    def test_does_not_block_event_loops(self):
+        collection = MockCollection()
+        writer = client.RunRecordWriter(collection, flush_interval=60,
+            max_pending=1, put_timeout=5)
+        # flusher runs on the background loop
+        writer.put('a', {'status': 'enqueued', 'ts': '1'})
+
+        async def _test():
+            start = time.monotonic()
+            writer.put('a', {'status': 'running', 'ts': '2'})
+            assert time.monotonic() - start < 1
+
+        asyncio.run(_test())
+        assert writer.stats['dropped'] == 1
+        assert asyncio.run(writer.close(timeout=5))
+
+    def test_put_without_waiting(self):
+        collection = MockCollection()
+        writer = client.RunRecordWriter(collection, flush_interval=60,
+            max_pending=1, put_timeout=5)
+        # flusher runs on the background loop
+        writer.put('a', {'status': 'enqueued', 'ts': '1'})
+
+        # not on an event loop, but told not to wait
+        start = time.monotonic()
+        writer.put('a', {'status': 'running', 'ts': '2'}, timeout=0)
+        assert time.monotonic() - start < 1
+        assert writer.stats['dropped'] == 1
+        # terminal statuses are still queued
+        writer.put('a', {'status': 'completed', 'ts': '3'}, terminal=True,
+            timeout=0)
+        assert writer.stats['dropped'] == 1
+        assert asyncio.run(writer.close(timeout=5))
+
+    def test_retries_terminal_updates(self):
+        collection = FailingCollection(failures=2)
+        writer = client.RunRecordWriter(collection, flush_interval=60)
+
+        async def _test():
+            writer.put('a', {'status': 'completed', 'ts': '1'}, terminal=True)
+            writer.put('b', {'status': 'running', 'ts': '2'})
+            await writer._flush_batch()
+            writer.put('a', {'status': 'foo', 'ts': '3'})
+            await writer._flush_batch()
+            await writer._flush_batch()
+
+        asyncio.run(_test())
+        # only the terminal update is retried, along with the one
+        # recorded after it
+        assert len(collection.batches) == 1
+        assert [op._filter for op in collection.batches[0]] == [{'run_id': 'a'}]
+        history = collection.batches[0][0]._doc['$push']['history']['$each']
+        assert [e['ts'] for e in history] == ['3', '1']
+        stats = writer.stats
+        assert stats['errors'] == 4
+        assert stats['written'] == 2
+        assert stats['queue_depth'] == 0
+
+    def test_gives_up_after_max_attempts(self):
+        collection = FailingCollection(failures=10)
+        writer = client.RunRecordWriter(collection, flush_interval=60,
+            max_write_attempts=2)
+
+        async def _test():
+            writer.put('a', {'status': 'completed', 'ts': '1'}, terminal=True)
+            for i in range(3):
+                await writer._flush_batch()
+
+        asyncio.run(_test())
+        assert writer.stats['dropped'] == 1
+        assert writer.stats['queue_depth'] == 0
+
+
+async def _count_tasks():
+    return len(asyncio.all_tasks())
+
+
+class FailingCollection(MockCollection):
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    async def bulk_write(self, ops, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("mongo unavailable")
+        return await super().bulk_write(ops, ordered=ordered)
+
+
+class TestPlanStages(object):
+
+    def test_index_scan(self):
+        plan = {
+            'stage': 'LIMIT',
+            'inputStage': {
+                'stage': 'FETCH',
+                'inputStage': {'stage': 'IXSCAN', 'indexName': 'initiated_at'}
+            }
+        }
+        assert client._plan_stages(plan) == (
+            ['LIMIT', 'FETCH', 'IXSCAN'], ['initiated_at'])
+
+    def test_collection_scan(self):
+        plan = {
+            'stage': 'SORT',
+            'inputStage': {'stage': 'COLLSCAN'}
+        }
+        assert client._plan_stages(plan) == (['SORT', 'COLLSCAN'], [])
+
+    def test_or_stages(self):
+        plan = {
+            'stage': 'OR',
+            'inputStages': [
+                {'stage': 'IXSCAN', 'indexName': 'a'},
+                {'stage': 'IXSCAN', 'indexName': 'b'}
+            ]
+        }
+        assert client._plan_stages(plan) == (
+            ['OR', 'IXSCAN', 'IXSCAN'], ['a', 'b'])
+
+    def test_winning_plan_from_aggregate(self):
+        explanation = {'stages': [
+            {'$cursor': {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}},
+            {'$group': {}}
+        ]}
+        assert client._winning_plan(explanation) == {'stage': 'COLLSCAN'}
+
+
+class MockIndexedCollection(object):
+
+    def __init__(self, error=None):
+        self.error = error
+        self.indexes = []
+
+    async def create_index(self, keys, **options):
+        self.indexes.append(keys)
+        if self.error:
+            raise self.error
+
+
+class TestEnsureIndexes(object):
+
+    def _db(self, error=None):
+        db = client.BlueSkyWebDB.__new__(client.BlueSkyWebDB)
+        db.events_retention_days = None
+        collections = {k: MockIndexedCollection(error)
+            for k in ('runs', 'run_events', 'run_stats')}
+        db.db = type('MockDB', (object,), collections)()
+        return db
+
+    def test_logs_failures(self):
+        db = self._db(error=OperationFailure("duplicate key"))
+        asyncio.run(db.ensure_indexes())
+        assert len(db.db.runs.indexes) == len(db.RUNS_INDEXES)
+        assert len(db.db.run_stats.indexes) == 1
+
+    def test_raises_if_unable_to_connect(self):
+        db = self._db(error=ServerSelectionTimeoutError("no servers"))
+        with pytest.raises(ServerSelectionTimeoutError):
+            asyncio.run(db.ensure_indexes())
+        # doesn't wait out server selection for each index
+        assert len(db.db.runs.indexes) == 1
+
+
+class MockMigrationCollection(MockIndexedCollection):
+
+    def __init__(self, runs=()):
+        super().__init__()
+        self.runs = list(runs)
+        self.inserted = []
+        self.batches = []
+
+    def find(self, query, projection=None):
+        runs, self.runs = self.runs, []
+        class Cursor(object):
+            def limit(self, n):
+                return self
+            async def to_list(self, length):
+                return runs
+        return Cursor()
+
+    async def delete_many(self, query):
+        pass
+
+    async def insert_many(self, docs):
+        self.inserted.extend(docs)
+
+    async def bulk_write(self, ops, ordered=True):
+        self.batches.append(ops)
+
+
+class TestMigrateRunHistory(object):
+
+    def test_events_recorded_at_migration_time(self):
+        db = client.BlueSkyWebDB.__new__(client.BlueSkyWebDB)
+        db.events_retention_days = client.DEFAULT_EVENTS_RETENTION_DAYS
+        db.max_milestones = 20
+        history = [
+            {'status': 'completed', 'ts': '2020-01-01T00:05:00.000000Z'},
+            {'status': 'enqueued', 'ts': '2020-01-01T00:00:00.000000Z'}
+        ]
+        db.db = type('MockDB', (object,), {
+            'runs': MockMigrationCollection([
+                {'_id': 1, 'run_id': 'a', 'history': history}]),
+            'run_events': MockMigrationCollection()
+        })()
+        before = datetime.datetime.utcnow()
+        counts = asyncio.run(db.migrate_run_history())
+        assert counts == {'runs': 1, 'events': 2}
+        events = db.db.run_events.inserted
+        assert [e['status'] for e in events] == ['enqueued', 'completed']
+        # not the events' original ts, which would have them expire
+        # right away
+        assert all(e['recorded_at'] >= before for e in events)
+
+
+class MockRunsCollection(object):
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.pipelines = []
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        groups = self.groups
+        class Cursor(object):
+            def __aiter__(self):
+                self._it = iter(groups)
+                return self
+            async def __anext__(self):
+                try:
+                    return next(self._it)
+                except StopIteration:
+                    raise StopAsyncIteration
+        return Cursor()
+
+
+class TestGetQueuePositions(object):
+
+    def _db(self, groups):
+        db = client.BlueSkyWebDB.__new__(client.BlueSkyWebDB)
+        db.db = type('MockDB', (object,), {'runs': MockRunsCollection(groups)})()
+        return db
+
+    def _run(self, run_id, status, queue, initiated_at):
+        return {'run_id': run_id, 'queue': queue, 'initiated_at': initiated_at,
+            'history': [{'status': status}]}
+
+    def test_none_enqueued(self):
+        db = self._db([])
+        runs = [self._run('a', 'running', 'q1', '2024-01-01T00:00:00Z')]
+        assert asyncio.run(db.get_queue_positions(runs)) == {}
+        assert db.db.runs.pipelines == []
+
+    def test_multiple_queues(self):
+        db = self._db([
+            {'_id': 'q1', 'initiated_at': ['2024-01-01T00:03:00Z',
+                '2024-01-01T00:01:00Z', '2024-01-01T00:02:00Z']},
+            {'_id': 'q2', 'initiated_at': ['2024-01-01T00:05:00Z']},
+        ])
+        runs = [
+            self._run('a', 'enqueued', 'q1', '2024-01-01T00:02:00Z'),
+            self._run('b', 'enqueued', 'q1', '2024-01-01T00:03:00Z'),
+            self._run('c', 'enqueued', 'q2', '2024-01-01T00:05:00Z'),
+            self._run('d', 'running', 'q2', '2024-01-01T00:00:00Z'),
+        ]
+        assert asyncio.run(db.get_queue_positions(runs)) == {
+            'a': 2, 'b': 3, 'c': 1}
+        # one aggregation for all runs
+        assert len(db.db.runs.pipelines) == 1
+
+
+class MockStatsCollection(object):
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.queries = []
+
+    async def find_one(self, query, projection=None, sort=None):
+        return min(self.entries, key=lambda e: e['date'], default=None)
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        dates = query['date']
+        entries = [e for e in self.entries if dates['$gte'] <= e['date']
+            and ('$lte' not in dates or e['date'] <= dates['$lte'])]
+        class Cursor(object):
+            async def to_list(self, length):
+                return entries
+        return Cursor()
+
+
+class TestRunCounts(object):
+
+    ENTRIES = [
+        {'date': '2024-01-30', 'queue': 'q1', 'count': 2},
+        {'date': '2024-01-31', 'queue': 'q1', 'count': 3},
+        {'date': '2024-01-31', 'queue': None, 'count': 1},
+        {'date': '2024-02-01', 'queue': 'q2', 'count': 4},
+    ]
+
+    def _db(self, entries=ENTRIES, groups=()):
+        db = client.BlueSkyWebDB.__new__(client.BlueSkyWebDB)
+        db.db = type('MockDB', (object,),
+            {'run_stats': MockStatsCollection(entries),
+            'runs': MockRunsCollection(groups)})()
+        return db
+
+    def test_by_day(self):
+        # the earliest day's rollups may be incomplete, so it's
+        # counted from the runs collection
+        db = self._db(groups=[
+            {'_id': {'date': '2024-01-30', 'queue': 'q1'}, 'count': 3}])
+        daily = asyncio.run(db.run_counts_by_day(start='2024-01-30',
+            end='2024-02-01'))
+        assert db.db.run_stats.queries == [
+            {'date': {'$gte': '2024-01-31', '$lte': '2024-02-01'}}]
+        match = db.db.runs.pipelines[0][0]['$match']
+        assert match == {'initiated_at': {'$gte': '2024-01-30',
+            '$lt': '2024-01-31'}}
+        assert daily == [
+            {'date': '2024-02-01', 'count': 4,
+                'by_queue': [{'queue': 'q2', 'count': 4}]},
+            {'date': '2024-01-31', 'count': 4,
+                'by_queue': [{'queue': 'q1', 'count': 3}, {'count': 1}]},
+            {'date': '2024-01-30', 'count': 3,
+                'by_queue': [{'queue': 'q1', 'count': 3}]},
+        ]
+
+    def test_by_month(self):
+        db = self._db()
+        monthly = asyncio.run(db.run_counts_by_month(start='2024-02-01'))
+        # only rollups are needed
+        assert db.db.runs.pipelines == []
+        assert monthly == [
+            {'year': '2024', 'month': '02', 'count': 4,
+                'by_queue': [{'queue': 'q2', 'count': 4}]},
+        ]
+
+    def test_without_rollups(self):
+        db = self._db(entries=[], groups=[
+            {'_id': {'date': '2024-01-31', 'queue': 'q1'}, 'count': 5}])
+        daily = asyncio.run(db.run_counts_by_day(start='2024-01-30'))
+        assert db.db.run_stats.queries == []
+        assert daily == [{'date': '2024-01-31', 'count': 5,
+            'by_queue': [{'queue': 'q1', 'count': 5}]}]
+
+    def test_writer_increments_initiated_runs(self):
+        collection = MockCollection()
+        stats = MockCollection()
+        writer = client.RunRecordWriter(collection, stats_collection=stats)
+        batch = {}
+        for run_id, data in (('a', {'initiated_at': '2024-01-31T00:00:00Z',
+                'queue': 'q1'}), ('b', {})):
+            batch[run_id] = client._PendingRunUpdate()
+            batch[run_id].add({'status': 'enqueued'}, data)
+        asyncio.run(writer._record_stats(batch))
+        assert len(stats.batches) == 1
+        op = stats.batches[0][0]
+        assert op._filter == {'date': '2024-01-31', 'queue': 'q1'}
+        assert op._doc == {'$inc': {'count': 1}}
+
+
+    def test_writer_handles_stats_failures_separately(self):
+        collection = MockCollection()
+        stats = FailingCollection(failures=1)
+        writer = client.RunRecordWriter(collection, stats_collection=stats)
+
+        async def _test():
+            writer.put('a', {'status': 'enqueued', 'ts': '1'},
+                {'initiated_at': '2024-01-31T00:00:00Z'})
+            await writer._flush_batch()
+
+        asyncio.run(_test())
+        assert len(collection.batches) == 1
+        assert writer.stats['written'] == 1
+        assert writer.stats['errors'] == 0
+        assert writer.stats['stats_errors'] == 1
+
+
+class TestRunsCursor(object):
+
+    def test_round_trip(self):
+        run = {'run_id': 'abc-123', 'initiated_at': '2024-01-01T00:00:00Z'}
+        cursor = client.encode_runs_cursor(run, 'prev')
+        assert client.decode_runs_cursor(cursor) == {
+            'run_id': 'abc-123',
+            'initiated_at': '2024-01-01T00:00:00Z',
+            'direction': 'prev'
+        }
+
+    def test_invalid(self):
+        for cursor in ('', 'sdfsdf', client.encode_runs_cursor(
+                {'run_id': 'a', 'initiated_at': 'b'}, 'sideways')):
+            with pytest.raises(client.InvalidCursorError):
+                client.decode_runs_cursor(cursor)
+
+
+class TestSearchQuery(object):
+
+    def test_tokenize(self):
+        assert client.tokenize('abc123-Plumerise') == ['abc123', 'plumerise']
+        assert client.tokenize('national_12-km') == ['national', '12', 'km']
+        assert client.tokenize('') == []
+        assert client.tokenize(None) == []
+
+    def test_exact(self):
+        assert client.search_query('run_id', 'a.b', 'exact') == {'run_id': 'a.b'}
+
+    def test_prefix(self):
+        assert client.search_query('run_id', 'a.b', 'prefix') == {
+            'run_id': {'$regex': r'^a\.b'}}
+
+    def test_contains(self):
+        assert client.search_query('queue', 'a.b', 'contains') == {
+            'queue': {'$regex': r'a\.b'}}
+
+    def test_default(self):
+        # substring matching, as run_id and queue filters always did
+        assert client.search_query('queue', 'a.b') == {
+            'queue': {'$regex': r'a\.b'}}
+
+    def test_token(self):
+        assert client.search_query('run_id', 'Plume', 'token') == {
+            'run_id_tokens': {'$regex': '^plume'}}
+        assert client.search_query('run_id', 'abc-plume', 'token') == {
+            '$and': [
+                {'run_id_tokens': 'abc'},
+                {'run_id_tokens': {'$regex': '^plume'}}
+            ]}
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            client.search_query('run_id', 'abc', 'foo')
+
+
+class TestMongoClients(object):
+
+    def test_shared_per_url_and_options(self, monkeypatch):
+        monkeypatch.setattr(client, 'MONGODB_CLIENT_ARGS', {})
+        try:
+            a = client.get_mongo_client('mongodb://localhost/a', maxPoolSize=5)
+            assert client.get_mongo_client('mongodb://localhost/a',
+                maxPoolSize=5) is a
+            assert client.get_mongo_client('mongodb://localhost/a',
+                maxPoolSize=10) is not a
+            assert [p['options'] for p in client.mongo_pool_stats()] == [
+                {'maxPoolSize': 5}, {'maxPoolSize': 10}]
+        finally:
+            client.close_mongo_clients()
+        assert client.mongo_pool_stats() == []
+
+    def test_pool_stats_listener(self):
+        class Event(object):
+            address = ('mongo', 27017)
+        listener = client.PoolStatsListener()
+        listener.connection_created(Event())
+        listener.connection_created(Event())
+        listener.connection_checked_out(Event())
+        listener.connection_checked_out(Event())
+        listener.connection_checked_in(Event())
+        listener.connection_closed(Event())
+        stats = listener.stats['mongo:27017']
+        assert stats['open'] == 1
+        assert stats['in_use'] == 1
+        assert stats['created'] == 2
+        assert stats['checked_out'] == 2
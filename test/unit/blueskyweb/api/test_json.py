@@ -0,0 +1,95 @@
+import datetime
+import json
+
+import pytest
+
+from blueskyweb import api
+
+PAYLOAD = {
+    'b': [1, 2.5, float('nan'), float('inf'), float('-inf'), None, True],
+    'a': {
+        'started': datetime.datetime(2024, 5, 1, 12, 30, 0, 123),
+        'utc': datetime.datetime(2024, 5, 1, 12, 30, tzinfo=datetime.timezone.utc),
+        'date': datetime.date(2024, 5, 1),
+        'tuple': (1, 'x')
+    },
+    'unicode': 'Fire near Añasco',
+    'keys': {10: 'ten', 2: 'two', 1.5: 'one and a half', None: 'none',
+        True: 'true', 'c': 'c'}
+}
+
+EXPECTED = (
+    '{"a":{"date":"2024-05-01","started":"2024-05-01T12:30:00.000123",'
+    '"tuple":[1,"x"],"utc":"2024-05-01T12:30:00+00:00"},'
+    '"b":[1,2.5,null,null,null,null,true],'
+    '"keys":{"1.5":"one and a half","10":"ten","2":"two","c":"c",'
+    '"null":"none","true":"true"},'
+    '"unicode":"Fire near Añasco"}'
+).encode('utf-8')
+
+
+@pytest.fixture(params=['orjson', 'stdlib'])
+def json_impl(request, monkeypatch):
+    if request.param == 'orjson':
+        if not api.orjson:
+            pytest.skip("orjson not installed")
+    else:
+        monkeypatch.setattr(api, 'orjson', None)
+    return request.param
+
+
+class TestDumpJson(object):
+
+    def test_payload(self, json_impl):
+        assert api.dump_json(PAYLOAD) == EXPECTED
+
+    def test_round_trip(self, json_impl):
+        val = {'z': [1, {'y': 'x'}], 'a': None}
+        assert json.loads(api.dump_json(val)) == val
+        assert api.dump_json(val) == b'{"a":null,"z":[1,{"y":"x"}]}'
+
+    def test_unsupported_type(self, json_impl, monkeypatch):
+        class FireEncoder(object):
+            def default(self, obj):
+                raise TypeError("not serializable")
+        monkeypatch.setattr(api, '_FIRE_ENCODER', FireEncoder())
+        with pytest.raises(TypeError):
+            api.dump_json({'a': object()})
+
+    def test_default_values_sanitized(self, json_impl, monkeypatch):
+        class Model(object):
+            pass
+        class FireEncoder(object):
+            def default(self, obj):
+                return {2: float('nan'), 'a': 1}
+        monkeypatch.setattr(api, '_FIRE_ENCODER', FireEncoder())
+        assert api.dump_json({'m': Model()}) == b'{"m":{"2":null,"a":1}}'
+
+
+class TestIterJson(object):
+
+    def test_payload(self):
+        assert b''.join(api._iter_json(PAYLOAD)) == EXPECTED
+
+    def test_chunks(self, monkeypatch):
+        monkeypatch.setattr(api, 'STREAM_CHUNK_SIZE', 16)
+        val = {'k{}'.format(i): list(range(10)) for i in range(20)}
+        chunks = list(api._iter_json(val))
+        assert len(chunks) > 1
+        assert b''.join(chunks) == api.dump_json(val)
+
+
+class TestSanitize(object):
+
+    def test_unchanged_values_not_copied(self):
+        val = {'a': [1, 2.5, {'b': 'c'}], 'd': (1,)}
+        assert api._sanitize(val) is val
+
+    def test_changed_values_copied(self):
+        inner = {'b': 'c'}
+        val = {'a': [float('nan')], 'inner': inner}
+        sanitized = api._sanitize(val)
+        assert sanitized == {'a': [None], 'inner': inner}
+        assert sanitized['inner'] is inner
+        # the original isn't modified
+        assert val['a'][0] != val['a'][0]
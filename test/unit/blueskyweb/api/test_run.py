@@ -0,0 +1,248 @@
+import asyncio
+import copy
+import json
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from blueskyweb.api import run as run_api
+from blueskyweb.lib.cache import TTLCache
+
+
+class MockDB(object):
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.projections = []
+
+    async def find_runs(self, projection=None, **kwargs):
+        self.projections.append(projection)
+        return [self._project(r, projection) for r in self.runs], len(self.runs)
+
+    async def find_run(self, run_id, projection=None):
+        self.projections.append(projection)
+        for r in self.runs:
+            if r['run_id'] == run_id:
+                return self._project(r, projection)
+        return None
+
+    async def get_queue_positions(self, runs):
+        return {}
+
+    def _project(self, run, projection):
+        run = copy.deepcopy(run)
+        projection = projection or {}
+        included = [k for k, v in projection.items()
+            if v == 1 and k != '_id']
+        if included:
+            run = {k: v for k, v in run.items() if k in included}
+        for k, v in projection.items():
+            if v == 0:
+                run.pop(k, None)
+            elif isinstance(v, dict) and '$slice' in v and k in run:
+                run[k] = run[k][:v['$slice']]
+        return run
+
+
+class MockRequest(object):
+
+    def __init__(self, settings, query_params=None, headers=None):
+        self.app = type('App', (object,), {})()
+        self.app.state = type('State', (object,), {})()
+        self.app.state.settings = settings
+        self.query_params = query_params or {}
+        self.headers = headers or {}
+
+
+RUN = {
+    'run_id': 'abc',
+    'initiated_at': '2024-01-01T00:00:00Z',
+    'queue': 'no-met',
+    'history': [
+        {'status': 'completed', 'ts': '2024-01-01T00:05:00.000000Z'},
+        {'status': 'enqueued', 'ts': '2024-01-01T00:00:00.000000Z'}
+    ],
+    'output_dir': '/data/abc',
+    'modules': ['fuelbeds'],
+    'server': {'hostname': 'foo'},
+    'runtime': {'total': 10},
+    'version_info': {'bluesky': '1'},
+    'counts': {'fires': 1},
+    'processing': [],
+    'run_config': {},
+    'today': '2024-01-01'
+}
+
+
+class TestListRuns(object):
+
+    def test_matches_baseline_payload(self):
+        db = MockDB([RUN])
+        request = MockRequest({'mongo_db': db})
+        response = asyncio.run(run_api._list_runs('4.2', None, request))
+        runs = json.loads(response.body)['runs']
+        # per run verbose fields were never stripped from listings
+        assert runs == [{
+            'run_id': 'abc',
+            'initiated_at': '2024-01-01T00:00:00Z',
+            'queue': {'name': 'no-met', 'position': None},
+            'status': {'status': 'completed',
+                'ts': '2024-01-01T00:05:00.000000Z'},
+            'complete': True,
+            'percent': 100,
+            'runtime': {'total': 10},
+            'version_info': {'bluesky': '1'},
+            'counts': {'fires': 1},
+            'processing': [],
+            'run_config': {},
+            'today': '2024-01-01'
+        }]
+
+    def test_projection(self):
+        projection = run_api._run_projection(False, False, listing=True)
+        assert all(k not in projection for k in run_api.VERBOSE_FIELDS)
+        projection = run_api._run_projection(False, False)
+        assert all(projection[k] == 0 for k in run_api.VERBOSE_FIELDS)
+
+
+class TestGetRunStatus(object):
+
+    def _settings(self, runs):
+        return {
+            'mongo_db': MockDB(runs),
+            'run_status_cache': TTLCache(maxsize=10, ttl=60),
+            'terminal_run_status_max_age': 60,
+            'run_status_poll_interval': 5
+        }
+
+    def _get(self, settings, headers=None):
+        request = MockRequest(settings, headers=headers)
+        return asyncio.run(run_api._get_run_status('4.2', 'abc', request))
+
+    def test_running_run_fetched_once(self):
+        running = dict(RUN, history=[{'status': 'running',
+            'ts': '2024-01-01T00:01:00.000000Z'}])
+        settings = self._settings([running])
+        for i in range(2):
+            response = self._get(settings)
+            assert response.headers['Cache-Control'] == 'max-age=5'
+        # one query per request, and nothing cached
+        assert len(settings['mongo_db'].projections) == 2
+        assert len(settings['run_status_cache']) == 0
+
+    def test_terminal_run_cached_and_revalidated(self):
+        settings = self._settings([RUN])
+        response = self._get(settings)
+        etag = response.headers['ETag']
+        assert response.headers['Cache-Control'] == 'max-age=60'
+        assert json.loads(response.body)['status']['status'] == 'completed'
+
+        response = self._get(settings, headers={'if-none-match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        # the cached response is used after checking the run's
+        # initiation time
+        assert settings['mongo_db'].projections[-1] == {
+            '_id': 0, 'initiated_at': 1}
+        assert len(settings['mongo_db'].projections) == 2
+
+    def test_reused_run_id(self):
+        settings = self._settings([RUN])
+        etag = self._get(settings).headers['ETag']
+
+        # the run id is reused by a new run
+        settings['mongo_db'].runs = [dict(RUN,
+            initiated_at='2024-02-01T00:00:00Z',
+            history=[{'status': 'enqueued',
+                'ts': '2024-02-01T00:00:00.000000Z'}])]
+        response = self._get(settings, headers={'if-none-match': etag})
+        assert response.status_code == 200
+        assert 'ETag' not in response.headers
+        assert json.loads(response.body)['status']['status'] == 'enqueued'
+
+    def test_deleted_run(self):
+        settings = self._settings([RUN])
+        self._get(settings)
+        settings['mongo_db'].runs = []
+        with pytest.raises(HTTPException) as e_info:
+            self._get(settings)
+        assert e_info.value.status_code == 404
+
+
+class TestRunOutput(object):
+
+    @pytest.fixture
+    def settings(self, tmpdir, monkeypatch):
+        # Imported here, since output loads blueskyworker.tasks
+        from blueskyweb.lib.runs import output
+
+        self.loads = []
+        get_local = output.BlueSkyRunOutput._get_local
+        def _get_local(run_output, output_dir):
+            self.loads.append(output_dir)
+            return get_local(run_output, output_dir)
+        monkeypatch.setattr(output.BlueSkyRunOutput, '_get_local', _get_local)
+
+        self.output_dir = str(tmpdir)
+        self._write_output({'run_id': 'abc', 'fires': [{'id': 'a'}]})
+        run = dict(RUN, output_url='https://foo.com/bluesky-output/abc',
+            output_dir=self.output_dir)
+        return {
+            'mongo_db': MockDB([run]),
+            'output_cache': TTLCache(maxsize=10, ttl=60),
+            'output_cache_max_item_size': 1024
+        }
+
+    def _write_output(self, data):
+        output_json_file = os.path.join(self.output_dir, 'output.json')
+        st = os.stat(output_json_file) if os.path.exists(output_json_file) else None
+        with open(output_json_file, 'w') as f:
+            f.write(json.dumps(data))
+        if st:
+            # make sure the change is seen even if the file is rewritten
+            # within the filesystem's timestamp resolution
+            os.utime(output_json_file, ns=(st.st_atime_ns,
+                st.st_mtime_ns + 10**9))
+
+    def _get(self, settings, headers=None):
+        request = MockRequest(settings, headers=headers)
+        return asyncio.run(run_api.run_output('4.2', 'abc', request))
+
+    def test_etag_and_not_modified(self, settings):
+        response = self._get(settings)
+        assert response.status_code == 200
+        assert json.loads(response.body) == {'run_id': 'abc',
+            'fires': [{'id': 'a'}]}
+        etag = response.headers['ETag']
+        assert response.headers['Last-Modified']
+        assert response.headers['Cache-Control'] == 'no-cache'
+
+        response = self._get(settings, headers={'if-none-match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        # output isn't loaded to revalidate
+        assert len(self.loads) == 1
+
+    def test_cached_by_etag(self, settings):
+        body = self._get(settings).body
+        etag = self._get(settings).headers['ETag']
+        assert settings['output_cache'].get(etag) == body
+        assert len(self.loads) == 1
+
+    def test_cache_miss_after_output_changes(self, settings):
+        etag = self._get(settings).headers['ETag']
+        self._write_output({'run_id': 'abc', 'fires': [{'id': 'b'}]})
+
+        response = self._get(settings, headers={'if-none-match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert json.loads(response.body)['fires'] == [{'id': 'b'}]
+        assert len(self.loads) == 2
+
+    def test_large_output_not_cached(self, settings):
+        settings['output_cache_max_item_size'] = 10
+        self._get(settings)
+        self._get(settings)
+        assert len(settings['output_cache']) == 0
+        assert len(self.loads) == 2
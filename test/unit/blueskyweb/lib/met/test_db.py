@@ -39,4 +39,47 @@ class TestApplyMinMax(object):
         with pytest.raises(TypeError) as e_info:
             db.apply_min_max(min, "sdf", 1)
         with pytest.raises(TypeError) as e_info:
-            db.apply_min_max(max, 3.4, "SDFDSF")
\ No newline at end of file
+            db.apply_min_max(max, 3.4, "SDFDSF")
+
+ARCHIVE_INDEX = {
+    'ca-nv_2-km': {'id': 'ca-nv_2-km', 'domain_id': 'DRI2km',
+        'grid': {'spacing': 2}},
+    # domain not defined in config
+    'no-domain': {'id': 'no-domain', 'domain_id': 'UNDEFINED'}
+}
+
+
+@pytest.fixture
+def archive_index(monkeypatch):
+    monkeypatch.setattr(db.blueskyconfig, 'get_archive_info',
+        ARCHIVE_INDEX.get)
+
+
+class TestValidateArchiveId(object):
+
+    def test_valid(self, archive_index):
+        assert db.validate_archive_id('ca-nv_2-km') == 'ca-nv_2-km'
+
+    def test_undefined_domain(self, archive_index):
+        assert db.validate_archive_id('no-domain') == 'no-domain'
+
+    def test_invalid(self, archive_index):
+        with pytest.raises(db.InvalidArchiveError):
+            db.validate_archive_id('foo')
+
+    def test_not_specified(self, archive_index):
+        assert db.validate_archive_id(None) is None
+
+
+class TestGetArchiveInfo(object):
+
+    def test_valid(self, archive_index):
+        assert db.get_archive_info('ca-nv_2-km') == ARCHIVE_INDEX['ca-nv_2-km']
+
+    def test_undefined_domain(self, archive_index):
+        assert db.get_archive_info('no-domain') == {'id': 'no-domain',
+            'domain_id': 'UNDEFINED'}
+
+    def test_invalid(self, archive_index):
+        with pytest.raises(db.InvalidArchiveError):
+            db.get_archive_info('foo')
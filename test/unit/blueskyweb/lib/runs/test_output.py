@@ -0,0 +1,280 @@
+import asyncio
+import email.utils
+import json
+import os
+import threading
+
+import pytest
+import requests
+from fastapi import HTTPException
+
+from blueskyweb.lib.runs import output
+
+
+class MockMongoDB(object):
+
+    def __init__(self, run):
+        self.run = run
+
+    async def find_run(self, run_id, projection=None):
+        if self.run and self.run['run_id'] == run_id:
+            return dict(self.run, history=self.run['history'][:1])
+        return None
+
+
+class MockResponse(object):
+
+    def __init__(self, status_code=200, headers=None, content=b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+
+class MockSession(object):
+
+    def __init__(self, head=None, get=None):
+        self._head = head or MockResponse()
+        self._get = get or MockResponse()
+        self.calls = []
+
+    def _respond(self, resp):
+        if isinstance(resp, Exception):
+            raise resp
+        return resp
+
+    def head(self, url, timeout=None):
+        self.calls.append(('head', url))
+        return self._respond(self._head)
+
+    def get(self, url, timeout=None):
+        self.calls.append(('get', url))
+        return self._respond(self._get)
+
+
+class Collector(object):
+
+    def __init__(self):
+        self.data = None
+
+    def write(self, val):
+        self.data = val
+
+
+def handle_error(status, msg, exception=None):
+    raise HTTPException(status_code=status, detail=msg)
+
+
+STATUS_TS = '2024-05-01T12:00:00.000000Z'
+STATUS_TIME = 1714564800  # STATUS_TS as timestamp
+
+def _run(**kwargs):
+    return dict({
+        'run_id': 'abc',
+        'initiated_at': '2024-05-01T11:00:00Z',
+        'modules': ['fuelbeds'],
+        'output_url': 'https://foo.com/bluesky-output/abc',
+        'output_dir': '/dev/null/abc',
+        'history': [
+            {'status': 'completed', 'ts': STATUS_TS},
+            {'status': 'enqueued', 'ts': '2024-05-01T11:00:00.000000Z'}
+        ]
+    }, **kwargs)
+
+def _write_output(output_dir, data, mtime):
+    output_json_file = os.path.join(output_dir, 'output.json')
+    with open(output_json_file, 'w') as f:
+        f.write(json.dumps(data))
+    os.utime(output_json_file, (mtime, mtime))
+
+def _find(run, run_id='abc'):
+    run_output = output.BlueSkyRunOutput('4.2', MockMongoDB(run),
+        handle_error, Collector())
+    return run_output, asyncio.run(run_output.find(run_id))
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = MockSession()
+    monkeypatch.setattr(output, 'get_session', lambda: session)
+    return session
+
+
+class TestFind(object):
+
+    def test_run_doesnt_exist(self, session):
+        with pytest.raises(HTTPException) as e_info:
+            _find(_run(), run_id='def')
+        assert e_info.value.status_code == 404
+
+    def test_no_output_url(self, session):
+        with pytest.raises(HTTPException) as e_info:
+            _find(_run(output_url=None))
+        assert e_info.value.status_code == 404
+
+    def test_no_status_ts(self, session):
+        _, version = _find(_run(history=[{'status': 'completed'}]))
+        assert version is None
+        assert session.calls == []
+
+    def test_embedded_output(self, session):
+        _, version = _find(_run(modules=['fuelbeds', 'dispersion'],
+            export={'localsave': {}}))
+        assert version == output.OutputVersion('completed:' + STATUS_TS,
+            email.utils.formatdate(STATUS_TIME, usegmt=True))
+        # output.json isn't needed
+        assert session.calls == []
+
+
+class TestFindLocalOutput(object):
+
+    def test_versioned_by_mtime(self, tmpdir, session):
+        _write_output(str(tmpdir), {'a': 1}, STATUS_TIME + 60)
+        st = os.stat(str(tmpdir.join('output.json')))
+        run_output, version = _find(_run(output_dir=str(tmpdir)))
+        assert run_output.local_output_dir == str(tmpdir)
+        assert version.tag == 'completed:{}:{}-{}'.format(STATUS_TS,
+            st.st_mtime_ns, st.st_size)
+        assert version.last_modified == email.utils.formatdate(
+            STATUS_TIME + 60, usegmt=True)
+        assert session.calls == []
+
+    def test_version_changes_with_output(self, tmpdir, session):
+        _write_output(str(tmpdir), {'a': 1}, STATUS_TIME + 60)
+        _, version = _find(_run(output_dir=str(tmpdir)))
+        _write_output(str(tmpdir), {'a': 2}, STATUS_TIME + 120)
+        _, new_version = _find(_run(output_dir=str(tmpdir)))
+        assert new_version.tag != version.tag
+
+    def test_missing_output_json(self, tmpdir, session):
+        os.utime(str(tmpdir), (STATUS_TIME, STATUS_TIME))
+        _, version = _find(_run(output_dir=str(tmpdir)))
+        assert version is None
+
+
+class TestFindRemoteOutput(object):
+
+    LAST_MODIFIED = email.utils.formatdate(STATUS_TIME + 60, usegmt=True)
+
+    def test_versioned_by_etag(self, session):
+        session._head = MockResponse(headers={'ETag': '"xyz"',
+            'Last-Modified': self.LAST_MODIFIED})
+        run_output, version = _find(_run())
+        assert run_output.local_output_dir is None
+        assert session.calls == [('head',
+            'https://foo.com/bluesky-output/abc/output.json')]
+        assert version.tag == 'completed:{}:"xyz"'.format(STATUS_TS)
+        assert version.last_modified == self.LAST_MODIFIED
+
+    def test_versioned_by_last_modified(self, session):
+        session._head = MockResponse(headers={
+            'Last-Modified': self.LAST_MODIFIED, 'Content-Length': '123'})
+        _, version = _find(_run())
+        assert version.tag == 'completed:{}:{}-123'.format(STATUS_TS,
+            self.LAST_MODIFIED)
+
+    def test_no_version_headers(self, session):
+        _, version = _find(_run())
+        assert version is None
+
+    def test_not_found(self, session):
+        session._head = MockResponse(status_code=404,
+            headers={'ETag': '"xyz"'})
+        _, version = _find(_run())
+        assert version is None
+
+    def test_request_failed(self, session):
+        session._head = requests.ConnectionError("failed")
+        _, version = _find(_run())
+        assert version is None
+
+
+class TestRemoteExists(object):
+
+    def test_exists(self, session):
+        assert output.remote_exists('https://foo.com/abc')
+        assert session.calls == [('head', 'https://foo.com/abc')]
+
+    def test_doesnt_exist(self, session):
+        session._head = MockResponse(status_code=404)
+        assert not output.remote_exists('https://foo.com/abc')
+
+    def test_request_failed(self, session):
+        session._head = requests.ConnectionError("failed")
+        assert output.remote_exists('https://foo.com/abc')
+
+
+class TestLoadOutput(object):
+
+    @pytest.fixture
+    def threads(self, monkeypatch):
+        threads = []
+        for name in ('_get_local', '_get_remote'):
+            f = getattr(output.BlueSkyRunOutput, name)
+            def wrapped(run_output, location, f=f):
+                threads.append(threading.get_ident())
+                return f(run_output, location)
+            monkeypatch.setattr(output.BlueSkyRunOutput, name, wrapped)
+        return threads
+
+    def _load(self, run, local_output_dir=None):
+        run_output = output.BlueSkyRunOutput('4.2', MockMongoDB(run),
+            handle_error, Collector())
+        run_output.local_output_dir = local_output_dir
+        return asyncio.run(run_output._load_output(run))
+
+    def test_local(self, tmpdir, session, threads):
+        _write_output(str(tmpdir), {'a': 1}, STATUS_TIME)
+        assert self._load(_run(), local_output_dir=str(tmpdir)) == {'a': 1}
+        # loaded in another thread, without blocking the event loop
+        assert threads and threads[0] != threading.get_ident()
+        assert session.calls == []
+
+    def test_local_missing(self, tmpdir, session, threads):
+        with pytest.raises(HTTPException) as e_info:
+            self._load(_run(), local_output_dir=str(tmpdir))
+        assert e_info.value.status_code == 404
+        assert e_info.value.detail.startswith("Output file doesn't exist")
+
+    def test_remote(self, session, threads):
+        session._get = MockResponse(content=b'{"a": 1}')
+        assert self._load(_run()) == {'a': 1}
+        assert threads and threads[0] != threading.get_ident()
+        assert session.calls == [('get',
+            'https://foo.com/bluesky-output/abc/output.json')]
+
+    def test_remote_output_location_missing(self, session, threads):
+        session._get = MockResponse(status_code=404)
+        session._head = MockResponse(status_code=404)
+        with pytest.raises(HTTPException) as e_info:
+            self._load(_run())
+        assert e_info.value.status_code == 404
+        assert e_info.value.detail.startswith("Output location doesn't exist")
+        assert session.calls == [
+            ('get', 'https://foo.com/bluesky-output/abc/output.json'),
+            ('head', 'https://foo.com/bluesky-output/abc')
+        ]
+
+    def test_remote_output_file_missing(self, session, threads):
+        session._get = MockResponse(status_code=404)
+        with pytest.raises(HTTPException) as e_info:
+            self._load(_run())
+        assert e_info.value.status_code == 404
+        assert e_info.value.detail.startswith("Output file doesn't exist")
+
+    def test_remote_output_location_check_failed(self, session, threads):
+        session._get = MockResponse(status_code=404)
+        session._head = requests.ConnectionError("failed")
+        with pytest.raises(HTTPException) as e_info:
+            self._load(_run())
+        assert e_info.value.status_code == 404
+        assert e_info.value.detail.startswith("Output file doesn't exist")
+
+    def test_remote_request_failed(self, session, threads):
+        session._get = requests.ConnectionError("failed")
+        with pytest.raises(HTTPException) as e_info:
+            self._load(_run())
+        assert e_info.value.status_code == 500
@@ -0,0 +1,177 @@
+import asyncio
+import threading
+
+import pytest
+
+from blueskyweb.lib.runs import pool
+
+
+class Runner(threading.Thread):
+
+    def __init__(self, release):
+        super().__init__()
+        self.release = release
+        self.ran = False
+
+    def run(self):
+        self.release.wait(5)
+        self.ran = True
+
+
+class TestInProcessRunPool(object):
+
+    def test_runs_and_waits(self):
+        p = pool.InProcessRunPool(max_running=1)
+        release = threading.Event()
+        release.set()
+        started = []
+        r = Runner(release)
+        asyncio.run(p.run(r, on_start=lambda: started.append(True)))
+        assert r.ran
+        assert started == [True]
+        assert p.stats['completed'] == 1
+        assert p.stats['running'] == 0
+
+    def test_rejects_when_full(self):
+        p = pool.InProcessRunPool(max_running=1, max_waiting=1,
+            queue_timeout=0.05, retry_after=7)
+        release = threading.Event()
+        async def go():
+            first = asyncio.ensure_future(p.run(Runner(release)))
+            await asyncio.sleep(0.01)
+            assert p.stats['saturated']
+            # waits, then times out
+            second = asyncio.ensure_future(p.run(Runner(release)))
+            await asyncio.sleep(0)
+            # rejected immediately, since one is already waiting
+            with pytest.raises(pool.RunPoolFullError) as e_info:
+                await p.run(Runner(release))
+            assert e_info.value.retry_after == 7
+            with pytest.raises(pool.RunPoolFullError):
+                await second
+            release.set()
+            await first
+        asyncio.run(go())
+        assert p.stats['rejected'] == 1
+        assert p.stats['timed_out'] == 1
+        assert p.stats['completed'] == 1
+
+    def test_failed_start(self):
+        p = pool.InProcessRunPool(max_running=1)
+        release = threading.Event()
+        release.set()
+        def on_start():
+            raise RuntimeError("failed to record run")
+        async def go():
+            with pytest.raises(RuntimeError):
+                await p.run(Runner(release), on_start=on_start)
+            # the slot is released
+            await p.run(Runner(release))
+        asyncio.run(go())
+        assert p.stats['failed_to_start'] == 1
+        assert p.stats['completed'] == 1
+        assert p.stats['running'] == 0
+
+    def test_shutdown_waits_for_executing_runs(self):
+        p = pool.InProcessRunPool(max_running=1)
+        release = threading.Event()
+        r = Runner(release)
+        async def go():
+            running = asyncio.ensure_future(p.run(r))
+            await asyncio.sleep(0.01)
+            shutdown = asyncio.ensure_future(p.shutdown(wait=True, timeout=5))
+            await asyncio.sleep(0.01)
+            assert not shutdown.done()
+            # new runs are rejected
+            with pytest.raises(pool.RunPoolFullError):
+                await p.run(Runner(release))
+            release.set()
+            await shutdown
+            assert r.ran
+            await running
+        asyncio.run(go())
+        assert p.stats['completed'] == 1
+        assert p.stats['rejected'] == 1
+        assert p.stats['running'] == 0
+
+    def test_shutdown_rejects_waiting_runs(self):
+        p = pool.InProcessRunPool(max_running=1, queue_timeout=5)
+        release = threading.Event()
+        waiting_runner = Runner(release)
+        async def go():
+            running = asyncio.ensure_future(p.run(Runner(release)))
+            await asyncio.sleep(0.01)
+            waiting = asyncio.ensure_future(p.run(waiting_runner))
+            await asyncio.sleep(0.01)
+            shutdown = asyncio.ensure_future(p.shutdown(wait=True, timeout=5))
+            await asyncio.sleep(0.01)
+            release.set()
+            await shutdown
+            await running
+            with pytest.raises(pool.RunPoolFullError):
+                await waiting
+        asyncio.run(go())
+        assert not waiting_runner.is_alive() and not waiting_runner.ran
+        assert p.stats['running'] == 0
+
+    def test_shutdown_timeout(self):
+        p = pool.InProcessRunPool(max_running=1)
+        release = threading.Event()
+        async def go():
+            running = asyncio.ensure_future(p.run(Runner(release)))
+            await asyncio.sleep(0.01)
+            await p.shutdown(wait=True, timeout=0.01)
+            assert p.stats['running'] == 1
+            release.set()
+            await running
+        asyncio.run(go())
+        assert p.stats['running'] == 0
+
+    def test_shutdown_without_runs(self):
+        p = pool.InProcessRunPool()
+        asyncio.run(p.shutdown(wait=True, timeout=1))
+        with pytest.raises(pool.RunPoolFullError):
+            asyncio.run(p.run(Runner(threading.Event())))
+
+    def test_on_done(self):
+        p = pool.InProcessRunPool(max_running=1)
+        release = threading.Event()
+        release.set()
+        done = []
+        r = Runner(release)
+        asyncio.run(p.run(r, on_done=lambda: done.append(r.ran)))
+        assert done == [True]
+
+    def test_on_done_after_cancel(self):
+        p = pool.InProcessRunPool(max_running=1)
+        release = threading.Event()
+        done = []
+        r = Runner(release)
+        async def go():
+            running = asyncio.ensure_future(p.run(r,
+                on_done=lambda: done.append(r.ran)))
+            await asyncio.sleep(0.01)
+            running.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await running
+            assert done == []
+            release.set()
+            await p.shutdown(wait=True, timeout=5)
+        asyncio.run(go())
+        assert done == [True]
+        assert p.stats['completed'] == 1
+        assert p.stats['running'] == 0
+
+    def test_on_done_failure(self):
+        p = pool.InProcessRunPool(max_running=1)
+        release = threading.Event()
+        release.set()
+        def on_done():
+            raise RuntimeError("failed to record run")
+        async def go():
+            await p.run(Runner(release), on_done=on_done)
+            # the slot is still released
+            await p.run(Runner(release))
+        asyncio.run(go())
+        assert p.stats['completed'] == 2
+        assert p.stats['running'] == 0
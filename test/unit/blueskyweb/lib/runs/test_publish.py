@@ -0,0 +1,80 @@
+import asyncio
+import threading
+
+import pytest
+
+from blueskyweb.lib.runs import publish
+
+
+class MockTask(object):
+
+    name = 'mock_task'
+
+    def __init__(self, release=None):
+        self.calls = []
+        self.release = release
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        if self.release:
+            self.release.wait(5)
+        self.calls.append((args, kwargs, options))
+        return 'result'
+
+
+class TestRunPublisher(object):
+
+    def test_publish(self):
+        publisher = publish.RunPublisher()
+        task = MockTask()
+        published = []
+        async def go():
+            return await publisher.publish(task, (1,), {'a': 1},
+                on_published=lambda: published.append(True), queue='q')
+        assert asyncio.run(go()) == 'result'
+        assert task.calls == [((1,), {'a': 1}, {'queue': 'q'})]
+        assert published == [True]
+        assert publisher.stats['published'] == 1
+        assert publisher.stats['pending'] == 0
+
+    def test_timeout_still_publishes(self):
+        publisher = publish.RunPublisher(timeout=0.01)
+        release = threading.Event()
+        task = MockTask(release)
+        published = threading.Event()
+        async def go():
+            await publisher.publish(task, (), {},
+                on_published=published.set)
+        with pytest.raises(publish.PublishTimeoutError):
+            asyncio.run(go())
+        release.set()
+        assert published.wait(5)
+        assert publisher.stats['timed_out'] == 1
+
+    def test_failure(self):
+        publisher = publish.RunPublisher()
+        task = MockTask()
+        task.apply_async = lambda **kwargs: 1 / 0
+        failed = []
+        async def go():
+            await publisher.publish(task, (), {}, on_failed=failed.append)
+        with pytest.raises(ZeroDivisionError):
+            asyncio.run(go())
+        assert [type(e) for e in failed] == [ZeroDivisionError]
+        assert publisher.stats['failed'] == 1
+
+    def test_outbox_full(self):
+        publisher = publish.RunPublisher(max_pending=1, timeout=0.01)
+        release = threading.Event()
+        task = MockTask(release)
+        async def go():
+            first = asyncio.ensure_future(publisher.publish(task, (), {}))
+            await asyncio.sleep(0)
+            with pytest.raises(publish.OutboxFullError):
+                await publisher.publish(task, (), {})
+            with pytest.raises(publish.PublishTimeoutError):
+                await first
+        asyncio.run(go())
+        release.set()
+        publisher.shutdown()
+        assert publisher.stats['rejected'] == 1
+        assert len(task.calls) == 1
@@ -0,0 +1,60 @@
+from blueskyweb.lib.cache import TTLCache
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(object):
+
+    def test_hit_and_miss(self):
+        c = TTLCache(maxsize=2, ttl=10, timer=Timer())
+        assert c.get('a') is None
+        c.set('a', 1)
+        assert c.get('a') == 1
+        stats = c.stats
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['size'] == 1
+
+    def test_expiration(self):
+        timer = Timer()
+        c = TTLCache(maxsize=2, ttl=10, timer=timer)
+        c.set('a', 1)
+        timer.now = 9
+        assert c.get('a') == 1
+        timer.now = 10
+        assert c.get('a', TTLCache.MISSING) is TTLCache.MISSING
+        assert c.stats['expirations'] == 1
+        assert len(c) == 0
+
+    def test_lru_eviction(self):
+        c = TTLCache(maxsize=2, ttl=10, timer=Timer())
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+        assert c.get('b') is None
+        assert c.get('a') == 1
+        assert c.get('c') == 3
+        assert c.stats['evictions'] == 1
+
+    def test_disabled(self):
+        c = TTLCache(maxsize=2, ttl=0, timer=Timer())
+        c.set('a', 1)
+        assert c.get('a') is None
+
+    def test_invalidate(self):
+        c = TTLCache(maxsize=4, ttl=10, timer=Timer())
+        c.set(('a', 1), 1)
+        c.set(('b', 1), 2)
+        c.set(('a', 2), 3)
+        assert c.invalidate(lambda k: k[0] == 'a') == 2
+        assert c.get(('b', 1)) == 2
+        assert c.invalidate() == 1
+        assert len(c) == 0
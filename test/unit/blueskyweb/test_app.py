@@ -0,0 +1,149 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import blueskyconfig
+from blueskyweb import app as bsw_app
+
+
+@pytest.fixture
+def config_file(tmpdir, monkeypatch):
+    config_file = tmpdir.join('defaults.json')
+    config_file.write(json.dumps({'cache_ttl_minutes': 0,
+        'foo': {'bar': 1, 'baz': 2, 'qux': 3}}))
+    monkeypatch.setattr(blueskyconfig.ConfigManagerSingleton, '_instance', None)
+    monkeypatch.setattr(blueskyconfig.ConfigManagerSingleton,
+        'DEFAULT_CONFIG_JSON_FILE', str(config_file))
+    return config_file
+
+
+@pytest.fixture
+def overrides_file(tmpdir):
+    overrides_file = tmpdir.join('overrides.json')
+    overrides_file.write(json.dumps({'foo': {'bar': 11, 'baz': 22}}))
+    return overrides_file
+
+
+@pytest.fixture
+def settings(overrides_file):
+    return dict(bsw_app.DEFAULT_SETTINGS,
+        path_prefix='/bluesky',
+        config_overrides_files=[str(overrides_file)],
+        config_file_options={'foo': {'baz': 222}},
+        config_options={'foo': {'qux': 333}})
+
+
+class TestAddConfigOverrides(object):
+
+    def test_overrides(self, config_file, settings):
+        bsw_app._add_config_overrides(settings)
+        # config options take precedence over config file options,
+        # which take precedence over overrides files
+        assert blueskyconfig.get('foo') == {'bar': 11, 'baz': 222, 'qux': 333}
+
+    def test_no_overrides(self, config_file):
+        bsw_app._add_config_overrides(dict(bsw_app.DEFAULT_SETTINGS))
+        assert blueskyconfig.get('foo') == {'bar': 1, 'baz': 2, 'qux': 3}
+
+
+class TestCreateWorkerApp(object):
+
+    def test_settings_round_trip(self, config_file, settings, monkeypatch):
+        logging_settings = []
+        monkeypatch.setattr(bsw_app, 'configure_logging',
+            lambda **s: logging_settings.append(s))
+        monkeypatch.setenv(bsw_app.SETTINGS_ENV_VAR, json.dumps(settings))
+
+        app = bsw_app.create_worker_app()
+
+        assert app.state.settings == settings
+        assert logging_settings == [settings]
+        assert blueskyconfig.get('foo') == {'bar': 11, 'baz': 222, 'qux': 333}
+        paths = app.openapi()['paths']
+        assert '/bluesky/api/ping' in paths
+        assert '/api/ping' not in paths
+
+
+class MockRunPool(object):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    async def shutdown(self, wait=True, timeout=None):
+        self.calls.append(('run_pool.shutdown', wait, timeout))
+
+
+class MockRunPublisher(object):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def shutdown(self):
+        self.calls.append(('run_publisher.shutdown',))
+
+
+class MockMongoDB(object):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def start_writer(self):
+        self.calls.append(('mongo_db.start_writer',))
+
+    async def ensure_indexes(self):
+        pass
+
+    async def close(self):
+        self.calls.append(('mongo_db.close',))
+
+
+class TestLifespan(object):
+
+    def test_shutdown_order(self, monkeypatch):
+        calls = []
+        def create_process_resources(settings):
+            settings['mongo_db'] = MockMongoDB(calls)
+            settings['run_publisher'] = MockRunPublisher(calls)
+            settings['run_pool'] = MockRunPool(calls)
+        monkeypatch.setattr(bsw_app, '_create_process_resources',
+            create_process_resources)
+        monkeypatch.setattr(bsw_app, 'close_mongo_clients',
+            lambda: calls.append(('close_mongo_clients',)))
+        warmed_up = threading.Event()
+        monkeypatch.setattr(bsw_app, '_warm_up_imports', warmed_up.set)
+
+        app = bsw_app.create_app(dict(bsw_app.DEFAULT_SETTINGS,
+            in_process_shutdown_timeout=5))
+        async def go():
+            async with app.router.lifespan_context(app):
+                calls.append(('serving',))
+                # deferred imports are warmed up in the background
+                assert await asyncio.to_thread(warmed_up.wait, 5)
+        asyncio.run(go())
+
+        assert calls == [
+            ('mongo_db.start_writer',),
+            ('serving',),
+            ('run_publisher.shutdown',),
+            # in-process runs are drained before the writer is closed
+            ('run_pool.shutdown', True, 5.0),
+            ('mongo_db.close',),
+            ('close_mongo_clients',)
+        ]
+
+
+class TestWarmUpImports(object):
+
+    def test_imports_deferred_modules(self, monkeypatch):
+        imported = []
+        def import_module(m):
+            if m == 'foo':
+                raise ImportError("No module named 'foo'")
+            imported.append(m)
+        monkeypatch.setattr(bsw_app, 'DEFERRED_MODULES', ('foo', 'json'))
+        monkeypatch.setattr(bsw_app.importlib, 'import_module', import_module)
+        # failures are logged, not raised
+        bsw_app._warm_up_imports()
+        assert imported == ['json']
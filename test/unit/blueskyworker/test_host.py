@@ -0,0 +1,44 @@
+import socket
+
+from blueskyworker import host
+
+
+class TestHostIdentity(object):
+
+    def test_configured(self, monkeypatch):
+        def fail():
+            raise AssertionError("shouldn't look up ip")
+        monkeypatch.setattr(host.HostIdentity, '_lookup_ip', fail)
+        h = host.HostIdentity(hostname='foo.com', ip='1.2.3.4')
+        assert h.hostname == 'foo.com'
+        assert h.to_record() == {'hostname': 'foo.com', 'ip': '1.2.3.4'}
+
+    def test_configured_hostname_does_not_look_up_ip(self, monkeypatch):
+        lookups = []
+        monkeypatch.setattr(host.HostIdentity, '_lookup_ip',
+            lambda self: lookups.append(1) or '5.6.7.8')
+        h = host.HostIdentity(hostname='foo.com')
+        assert h.to_record() == {'hostname': 'foo.com', 'ip': None}
+        assert lookups == []
+
+    def test_looks_up_ip_once(self, monkeypatch):
+        lookups = []
+        monkeypatch.setattr(host.HostIdentity, '_lookup_ip',
+            lambda self: lookups.append(1) or '5.6.7.8')
+        h = host.HostIdentity()
+        assert h.hostname == '5.6.7.8'
+        assert h.ip == '5.6.7.8'
+        assert lookups == [1]
+
+    def test_lookup_disabled(self, monkeypatch):
+        monkeypatch.setattr(socket, 'getfqdn', lambda: 'local.host')
+        h = host.HostIdentity(ip_lookup=False)
+        assert h.to_record() == {'hostname': 'local.host', 'ip': None}
+
+    def test_from_env(self, monkeypatch):
+        monkeypatch.setenv('PUBLIC_HOSTNAME', 'foo.com')
+        monkeypatch.setenv('HOST_IP_LOOKUP', 'none')
+        monkeypatch.delenv('PUBLIC_IP', raising=False)
+        h = host.HostIdentity.from_env()
+        assert h.hostname == 'foo.com'
+        assert h.ip is None
@@ -0,0 +1,91 @@
+import os
+
+from blueskyworker.hysplitmessages import HysplitMessageTailer
+
+
+def _append(d, name, text):
+    with open(os.path.join(str(d), name), 'a') as f:
+        f.write(text)
+
+OUTPUT_LINE = " NOTICE   main: output at hour 1\n"
+OTHER_LINE = " NOTICE   main: pollutant initialization\n"
+
+
+class TestHysplitMessageTailer(object):
+
+    def test_no_files(self, tmpdir):
+        t = HysplitMessageTailer(str(tmpdir))
+        assert t.update() is None
+        assert HysplitMessageTailer(None).update() is None
+
+    def test_single_file(self, tmpdir):
+        t = HysplitMessageTailer(str(tmpdir))
+        _append(tmpdir, 'MESSAGE', OTHER_LINE + OUTPUT_LINE)
+        assert t.update() == 1
+        assert t.update() == 1
+        _append(tmpdir, 'MESSAGE', OUTPUT_LINE + OTHER_LINE + OUTPUT_LINE)
+        assert t.update() == 3
+
+    def test_partial_lines(self, tmpdir):
+        t = HysplitMessageTailer(str(tmpdir))
+        _append(tmpdir, 'MESSAGE', OUTPUT_LINE + " NOTICE   main: out")
+        assert t.update() == 1
+        _append(tmpdir, 'MESSAGE', "put at hour 2\n")
+        assert t.update() == 2
+
+    def test_truncated(self, tmpdir):
+        t = HysplitMessageTailer(str(tmpdir))
+        _append(tmpdir, 'MESSAGE', OUTPUT_LINE * 3)
+        assert t.update() == 3
+        with open(os.path.join(str(tmpdir), 'MESSAGE'), 'w') as f:
+            f.write(OUTPUT_LINE)
+        # progress isn't reported to decrease
+        assert t.update() == 3
+        _append(tmpdir, 'MESSAGE', OUTPUT_LINE * 3)
+        assert t.update() == 4
+
+    def test_slowest_of_mpi_processes(self, tmpdir):
+        t = HysplitMessageTailer(str(tmpdir))
+        _append(tmpdir, 'MESSAGE.001', OUTPUT_LINE * 3)
+        _append(tmpdir, 'MESSAGE.002', OUTPUT_LINE * 2)
+        # ignored in favor of process specific files
+        _append(tmpdir, 'MESSAGE', OTHER_LINE)
+        assert t.update() == 2
+        _append(tmpdir, 'MESSAGE.002', OUTPUT_LINE * 2)
+        assert t.update() == 3
+        # progress isn't reported to decrease
+        _append(tmpdir, 'MESSAGE.003', '')
+        assert t.update() == 3
+        _append(tmpdir, 'MESSAGE.001', OUTPUT_LINE)
+        _append(tmpdir, 'MESSAGE.003', OUTPUT_LINE * 4)
+        assert t.update() == 4
+
+    def test_process_sub_directories(self, tmpdir):
+        t = HysplitMessageTailer(str(tmpdir))
+        _append(tmpdir.mkdir('0'), 'MESSAGE', OUTPUT_LINE * 4)
+        _append(tmpdir.mkdir('1'), 'MESSAGE', OUTPUT_LINE * 2)
+        assert t.update() == 2
+
+    def test_switch_to_mpi_process_files(self, tmpdir):
+        t = HysplitMessageTailer(str(tmpdir))
+        _append(tmpdir, 'MESSAGE', OTHER_LINE)
+        assert t.update() == 0
+        _append(tmpdir, 'MESSAGE.001', OUTPUT_LINE * 2)
+        _append(tmpdir, 'MESSAGE.002', OUTPUT_LINE * 3)
+        # the stale MESSAGE file no longer holds back progress
+        assert t.update() == 2
+        assert sorted(os.path.basename(f) for f in t._hours) == [
+            'MESSAGE.001', 'MESSAGE.002']
+        assert sorted(os.path.basename(f) for f in t._offsets) == [
+            'MESSAGE.001', 'MESSAGE.002']
+        _append(tmpdir, 'MESSAGE.001', OUTPUT_LINE * 2)
+        assert t.update() == 3
+
+    def test_removed_files_forgotten(self, tmpdir):
+        t = HysplitMessageTailer(str(tmpdir))
+        _append(tmpdir.mkdir('0'), 'MESSAGE', OUTPUT_LINE * 4)
+        _append(tmpdir.mkdir('1'), 'MESSAGE', OUTPUT_LINE)
+        assert t.update() == 1
+        tmpdir.join('1', 'MESSAGE').remove()
+        assert t.update() == 4
+        assert len(t._hours) == 1
@@ -0,0 +1,37 @@
+from blueskyworker import monitor
+
+
+class MockConfig(object):
+
+    CONFIG = {'start': '2024-05-01T00:00:00', 'num_hours': 10,
+        'working_dir': '/tmp/abc'}
+
+    def get(self, *keys):
+        return self.CONFIG[keys[-1]]
+
+
+class MockFiresManager(object):
+    run_id = 'abc'
+
+
+class TestHysplitMonitor(object):
+
+    def _monitor(self, monkeypatch):
+        monkeypatch.setattr(monitor, 'Config', MockConfig)
+        self.recorded = []
+        def record_run(status, **kwargs):
+            self.recorded.append((status, kwargs))
+        return monitor.HysplitMonitor('dispersion', MockFiresManager(),
+            record_run)
+
+    def test_progress_from_watcher_thread_not_waited_on(self, monkeypatch):
+        m = self._monitor(monkeypatch)
+        m.on_hour(5)
+        assert self.recorded == [(monitor.RunStatuses.RunningModule,
+            {'module': 'dispersion', 'percent_complete': 47, 'put_timeout': 0})]
+
+    def test_record_progress(self, monkeypatch):
+        m = self._monitor(monkeypatch)
+        m.record_progress(2)
+        assert self.recorded == [(monitor.RunStatuses.RunningModule,
+            {'module': 'dispersion', 'percent_complete': 2, 'put_timeout': None})]
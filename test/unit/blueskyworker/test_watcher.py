@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+
+import pytest
+
+from blueskyworker.watcher import HysplitProgressWatcher
+
+OUTPUT_LINE = " NOTICE   main: output at hour 1\n"
+
+
+class Hours(object):
+
+    def __init__(self):
+        self.hours = []
+        self.event = threading.Event()
+
+    def __call__(self, hour):
+        self.hours.append(hour)
+        self.event.set()
+
+    def wait_for(self, hours, timeout=5):
+        for i in range(int(timeout * 10)):
+            if self.hours == hours:
+                return True
+            self.event.wait(0.1)
+            self.event.clear()
+        return False
+
+
+def _append(d, name, text):
+    with open(os.path.join(str(d), name), 'a') as f:
+        f.write(text)
+
+
+@pytest.fixture(params=[True, False], ids=['inotify', 'polling'])
+def watcher(request):
+    w = HysplitProgressWatcher(poll_interval=0.05, rescan_interval=10,
+        use_inotify=request.param)
+    if request.param and not w.uses_inotify:
+        pytest.skip("inotify isn't available")
+    yield w
+    w.shutdown()
+
+
+class TestHysplitProgressWatcher(object):
+
+    def test_reports_only_new_hours(self, watcher, tmpdir):
+        hours = Hours()
+        key = watcher.watch(str(tmpdir), hours)
+        _append(tmpdir, 'MESSAGE', OUTPUT_LINE)
+        assert hours.wait_for([1])
+        _append(tmpdir, 'MESSAGE', " NOTICE   main: not an hour\n")
+        _append(tmpdir, 'MESSAGE', OUTPUT_LINE)
+        assert hours.wait_for([1, 2])
+        watcher.unwatch(key)
+        _append(tmpdir, 'MESSAGE', OUTPUT_LINE)
+        assert not hours.wait_for([1, 2, 3], timeout=0.5)
+
+    def test_working_dir_created_later(self, watcher, tmpdir):
+        hours = Hours()
+        working_dir = os.path.join(str(tmpdir), 'hysplit')
+        watcher.watch(working_dir, hours)
+        os.makedirs(os.path.join(working_dir, '0'))
+        _append(os.path.join(working_dir, '0'), 'MESSAGE', OUTPUT_LINE * 2)
+        assert hours.wait_for([2])
+
+    def test_multiple_runs(self, watcher, tmpdir):
+        a, b = Hours(), Hours()
+        watcher.watch(str(tmpdir.mkdir('a')), a)
+        watcher.watch(str(tmpdir.mkdir('b')), b)
+        _append(tmpdir.join('a'), 'MESSAGE.001', OUTPUT_LINE)
+        _append(tmpdir.join('b'), 'MESSAGE.001', OUTPUT_LINE * 3)
+        assert a.wait_for([1])
+        assert b.wait_for([3])
+        assert threading.active_count() < 10
+
+    def test_reporting_doesnt_block_other_runs(self, watcher, tmpdir):
+        entered, release = threading.Event(), threading.Event()
+        def slow(hour):
+            entered.set()
+            release.wait(5)
+        key_a = watcher.watch(str(tmpdir.mkdir('a')), slow)
+        key_b = watcher.watch(str(tmpdir.mkdir('b')), Hours())
+        _append(tmpdir.join('a'), 'MESSAGE', OUTPUT_LINE)
+        assert entered.wait(5)
+        # returns while run a's progress is being reported
+        watcher.unwatch(key_b)
+        # waits for run a's progress to be reported
+        t = threading.Thread(target=watcher.unwatch, args=(key_a,))
+        t.start()
+        t.join(0.2)
+        assert t.is_alive()
+        release.set()
+        t.join(5)
+        assert not t.is_alive()
+
+
+def test_ignores_other_files(tmpdir):
+    watcher = HysplitProgressWatcher(poll_interval=0.05, rescan_interval=10)
+    if not watcher.uses_inotify:
+        pytest.skip("inotify isn't available")
+    checked = []
+    check = watcher._check
+    watcher._check = lambda key: checked.append(key) or check(key)
+    hours = Hours()
+    try:
+        watcher.watch(str(tmpdir), hours)
+        for i in range(10):
+            _append(tmpdir, 'cdump', 'x' * 100)
+        time.sleep(0.3)
+        assert checked == []
+        _append(tmpdir, 'MESSAGE', OUTPUT_LINE)
+        assert hours.wait_for([1])
+    finally:
+        watcher.shutdown()